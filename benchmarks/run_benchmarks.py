@@ -0,0 +1,222 @@
+""" Benchmarks of the registration, rendering and I/O hot paths on synthetic layouts and scans.
+
+Runs headless, from the project directory:
+
+    python -m benchmarks.run_benchmarks --output results.json
+    python -m benchmarks.run_benchmarks --output results.json --compare baseline.json
+
+Each benchmark is named after the timed function and the size of its input, e.g. dxf.load[10000]. Results are written
+as json with the median and minimum of the repeats. With --compare, every benchmark whose median exceeds the median of
+the baseline file by more than the tolerance is reported as regression and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import scipy
+from scipy import optimize as opt
+from PyQt5 import QtWidgets
+
+from benchmarks.synthetic import affine_matrix, marker_positions, synthetic_scan, write_layout, write_stencil
+from helper_classes.clearance import ClearanceChecker
+from helper_classes.dwg_xch_file import DwgXchFile
+from helper_classes.dxf_writer import write_geometry
+from helper_classes.gds_file import GDSLibrary
+from helper_classes.mat_file import MatFile
+from plot_classes.color_plot import ColorPlot
+from plot_classes.scene_plot import ScenePlot
+from utility.peak_fit import fit_scan
+from utility.utility_functions import affine_trafo, kd_nearest, two_d_gaussian_sym
+
+
+def measure(function, repeats=5, setup=None):
+    """ Times function over repeats calls and returns median, min and repeats.
+
+        Args:
+            function: Called with the return value of setup, or without arguments if setup is None.
+            repeats (int): Number of timed calls.
+            setup: Called before every call outside of the timing, e.g. to copy data changed by function.
+    """
+    durations = []
+    for _ in range(repeats):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - start)
+    return {'median': float(np.median(durations)), 'min': float(min(durations)), 'repeats': repeats}
+
+
+def load_layout(file_name):
+    dxf_file = DwgXchFile()
+    dxf_file.load(None, file_type='stencil', file_name=file_name)
+    return dxf_file
+
+
+def pan(scene, steps=10):
+    """ Shifts the view of a ScenePlot by steps of a tenth of its width, rendering every frame. """
+    (x0, x1), y_limits = scene.plot_limits
+    for step in range(1, steps + 1):
+        scene.set_plot_limits([[x0 + (x1 - x0) * step / 10., x1 + (x1 - x0) * step / 10.], y_limits])
+        scene.viewport().grab()
+    scene.set_plot_limits([[x0, x1], y_limits])
+
+
+def layout_benchmarks(n_entities, directory, repeats, canvas=None, scene=None):
+    file_name = write_layout(os.path.join(directory, 'layout_{0}.dxf'.format(n_entities)), n_entities)
+    stencil = load_layout(write_stencil(os.path.join(directory, 'stencil.dxf')))
+    dxf_file = load_layout(file_name)
+    coordinates = dxf_file.points().coordinates()
+    query = [coordinates[len(coordinates) // 2][0] + 0.1, coordinates[len(coordinates) // 2][1] - 0.1]
+    key = '[{0}]'.format(n_entities)
+    gds_name = os.path.join(directory, 'written.gds')
+    library = GDSLibrary.from_geometry(dxf_file.geometry())
+    results = {'dxf.load' + key: measure(lambda: load_layout(file_name), repeats),
+               'dxf.points' + key: measure(dxf_file.points, repeats),
+               'dxf.add_stencil' + key: measure(lambda: dxf_file.add_stencil(stencil, [5., 5.]), repeats),
+               'kd_nearest' + key: measure(lambda: kd_nearest(coordinates, query), repeats),
+               'dxf.write' + key: measure(lambda: write_geometry(os.path.join(directory, 'written.dxf'),
+                                                                 dxf_file.geometry()), repeats),
+               'dxf.transform' + key: measure(lambda: dxf_file.geometry().transformed(affine_matrix()), repeats),
+               'gds.write' + key: measure(lambda: library.write(gds_name), repeats),
+               'gds.read' + key: measure(lambda: GDSLibrary.read(gds_name).geometry(), repeats),
+               'clearance.check' + key: measure(lambda: ClearanceChecker(dxf_file.geometry()).check(0.5), repeats)}
+    if canvas is not None:
+        results['draw_canvas' + key] = measure(lambda: canvas.draw_canvas(dxf=dxf_file), repeats)
+        canvas.draw_canvas(dxf=None)
+    if scene is not None:
+        results['scene.draw_canvas' + key] = measure(lambda layout: scene.draw_canvas(dxf=layout), repeats,
+                                                     setup=lambda: scene.clear_dxf() or dxf_file)  # no retained items
+        results['scene.pan' + key] = measure(lambda: pan(scene), repeats)
+        scene.draw_canvas(dxf=None)
+    return results
+
+
+def scan_benchmarks(n_pixels, repeats, canvas=None, fit=True):
+    mat_file = synthetic_scan(n_pixels)
+    key = '[{0}]'.format(n_pixels)
+    trafo = affine_matrix()
+
+    def fresh_scan():  # transform replaces the arrays of the scan
+        scan = MatFile()
+        scan.graph = {k: np.array(v) for k, v in mat_file.graph.items()}
+        return scan
+
+    results = {'mat.transform' + key: measure(lambda scan: scan.transform(trafo), repeats, setup=fresh_scan)}
+    if fit:
+        x_ax, y_ax = np.meshgrid(mat_file.graph['x'][0], mat_file.graph['y'][0][::-1])
+        x0, y0 = marker_positions()[len(marker_positions()) // 2]
+        p0 = (1000., x0 + 0.1, y0 - 0.1, 0.2, 20.)  # amplitude, x0, y0, sigma, offset
+        bounds = ([0, x0 - 1, y0 - 1, 0, -np.inf], [np.inf, x0 + 1, y0 + 1, np.inf, np.inf])
+        results['gaussian_fit' + key] = measure(
+            lambda: opt.curve_fit(two_d_gaussian_sym, [x_ax, y_ax], mat_file.graph['result'].ravel(), p0=p0,
+                                  bounds=bounds), repeats)
+        results['fit_scan' + key] = measure(
+            lambda: fit_scan(mat_file.graph['x'][0], mat_file.graph['y'][0], mat_file.graph['result'], 0.3, 200.),
+            repeats)
+    if canvas is not None:
+        results['draw_canvas.mat' + key] = measure(lambda: canvas.draw_canvas(mat=mat_file), repeats)
+        canvas.draw_canvas(mat=None)
+    return results
+
+
+def trafo_benchmarks(n_points, repeats):
+    random = np.random.RandomState(n_points)
+    raw = random.uniform(0, 100, (n_points, 2))
+    real = np.dot(np.column_stack([raw, np.ones(n_points)]), affine_matrix())[:, :2] + random.normal(0, 0.05, raw.shape)
+    return {'affine_trafo[{0}]'.format(n_points): measure(lambda: affine_trafo(raw, real), repeats)}
+
+
+def run(args):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    canvas = ColorPlot()
+    canvas.resize(800, 800)
+    scene = ScenePlot()
+    scene.resize(800, 800)
+    results = {}
+    directory = tempfile.mkdtemp(prefix='pykaboo_benchmarks_')
+    for n_entities in args.entities:
+        print('layout with {0} entities'.format(n_entities))
+        drawn = n_entities <= args.max_draw_entities
+        results.update(layout_benchmarks(n_entities, directory, args.repeats, canvas if drawn else None,
+                                         scene if drawn else None))
+    for n_pixels in args.pixels:
+        print('scan of {0} x {0} pixels'.format(n_pixels))
+        results.update(scan_benchmarks(n_pixels, args.repeats, canvas, fit=n_pixels <= args.max_fit_pixels))
+    for n_points in args.points:
+        results.update(trafo_benchmarks(n_points, args.repeats))
+    app.processEvents()
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """ Returns the names of all benchmarks slower than in baseline by more than tolerance and min_delta seconds. """
+    regressions = []
+    print('{0:<28}{1:>12}{2:>12}{3:>9}'.format('benchmark', 'base ms', 'now ms', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        base, now = baseline[name]['median'], results[name]['median']
+        ratio = now / base if base > 0 else float('inf')
+        regressed = ratio > 1 + tolerance and now - base > min_delta
+        if regressed:
+            regressions.append(name)
+        print('{0:<28}{1:>12.2f}{2:>12.2f}{3:>9.2f}{4}'.format(name, base * 1e3, now * 1e3, ratio,
+                                                               '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of registration, rendering and I/O.')
+    parser.add_argument('--entities', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of entities of the synthetic layouts')
+    parser.add_argument('--pixels', type=int, nargs='+', default=[256, 1024, 4096],
+                        help='numbers of pixels along x and y of the synthetic scans')
+    parser.add_argument('--points', type=int, nargs='+', default=[4, 32, 256],
+                        help='numbers of point pairs of the affine fits')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max-draw-entities', type=int, default=10000,
+                        help='largest layout drawn with draw_canvas')
+    parser.add_argument('--max-fit-pixels', type=int, default=1024,
+                        help='largest scan used for Gaussian fits, which fit the whole image')
+    parser.add_argument('--quick', action='store_true', help='smallest sizes only, three repeats')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='baseline json written by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slow down of the median reported as regression')
+    parser.add_argument('--min-delta', type=float, default=1e-3,
+                        help='smaller slow downs in seconds are never reported, they are mostly timer noise')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.entities, args.pixels, args.points, args.repeats = args.entities[:1], args.pixels[:1], args.points[:1], 3
+
+    results = run(args)
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'matplotlib': matplotlib.__version__}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+    print('Results written to {0}.'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print('{0} regressions: {1}'.format(len(regressions), ', '.join(regressions)))
+            return 1
+        print('No regressions.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
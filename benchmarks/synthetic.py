@@ -0,0 +1,76 @@
+import numpy as np
+
+from helper_classes.dxf_geometry import DXFGeometry
+from helper_classes.dxf_writer import BY_LAYER, DXFWriter
+from helper_classes.mat_file import MatFile
+
+
+def write_layout(file_name, n_entities, pitch=10.):
+    """ Writes an R12 layout of n_entities on a square grid, circles and closed squares at alternate positions.
+
+        Coordinates have z = 0 like the layouts drawn by add_stencil. Every fourth entity is on a second layer with
+        color by layer, the others carry their own color, so both color paths of the readers are used. The layout is
+        written with the streaming DXFWriter, circles first.
+    """
+    i = np.arange(n_entities)
+    n_columns = int(np.ceil(np.sqrt(n_entities)))
+    positions = np.stack([(i % n_columns) * pitch, (i // n_columns) * pitch], axis=1)
+    is_circle = i % 2 == 1
+    half = pitch / 4.
+    square = np.array([[-half, -half], [half, -half], [half, half], [-half, half]])
+    n_squares = np.count_nonzero(~is_circle)
+    order = np.concatenate([i[is_circle], i[~is_circle]])
+    geometry = DXFGeometry.from_arrays(positions[is_circle], pitch / 4.,
+                                       (positions[~is_circle][:, np.newaxis] + square).reshape(-1, 2),
+                                       np.arange(0, 4 * n_squares + 1, 4),
+                                       layers=(order % 4 == 3).astype(int), layer_names=['0', 'MARKERS'])
+    colors = np.where(order % 4 == 3, BY_LAYER, 1 + order % 7)
+    with DXFWriter(file_name, layers=[('0', 7), ('MARKERS', 3)]) as writer:
+        writer.write(geometry, colors)
+    return file_name
+
+
+def write_stencil(file_name, n_entities=20):
+    """ Writes a small stencil of circles and polylines for add_stencil. """
+    return write_layout(file_name, n_entities, pitch=1.)
+
+
+def marker_positions(extent=100., pitch=10.):
+    """ Returns the centres of the Gaussian markers of synthetic_scan, shape (n, 2). """
+    ax = np.arange(pitch / 2., extent, pitch)
+    x, y = np.meshgrid(ax, ax)
+    return np.stack([x.ravel(), y.ravel()], axis=1)
+
+
+def synthetic_scan(n_pixels, extent=100., sigma=0.3, amplitude=1000., background=20., seed=0):
+    """ Returns a MatFile of n_pixels x n_pixels with Gaussian markers on a grid and Poisson noise.
+
+        Args:
+            n_pixels (int): Number of pixels along x and y.
+            extent (float): Size of the scan in um, the axes run from 0 to extent.
+            sigma (float): Width of the markers in um.
+            amplitude (float): Peak counts of the markers above background.
+            background (float): Mean background counts.
+            seed (int): Seed of the noise, equal seeds give equal scans.
+    """
+    ax = np.linspace(0, extent, n_pixels)
+    image = np.full((n_pixels, n_pixels), background)
+    radius = int(np.ceil(4 * sigma / (ax[1] - ax[0])))
+    for x0, y0 in marker_positions(extent):
+        col, row = int(round(x0 / ax[1])), (n_pixels - 1) - int(round(y0 / ax[1]))  # rows run from y max to y min
+        rows = slice(max(row - radius, 0), row + radius + 1)
+        cols = slice(max(col - radius, 0), col + radius + 1)
+        x, y = np.meshgrid(ax[cols], ax[::-1][rows])
+        image[rows, cols] += amplitude * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / (2 * sigma ** 2))
+    mat_file = MatFile()
+    mat_file.file_name = 'synthetic_{0}.mat'.format(n_pixels)
+    mat_file.graph = {'N': np.array([[n_pixels, n_pixels, 1]]), 'x': np.array([ax]), 'y': np.array([ax]),
+                      'z': np.array([[0.]]),
+                      'result': np.random.RandomState(seed).poisson(image).astype(float)}
+    return mat_file
+
+
+def affine_matrix(angle=1., scale=1.01, shift=(2., -3.)):
+    """ Returns the 3x3 matrix of a rotation by angle degrees, scaling and shift, for row vectors [x y 1]. """
+    c, s = scale * np.cos(np.radians(angle)), scale * np.sin(np.radians(angle))
+    return np.array([[c, s, 0.], [-s, c, 0.], [shift[0], shift[1], 1.]])
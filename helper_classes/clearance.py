@@ -0,0 +1,271 @@
+from collections import namedtuple
+
+import numpy as np
+
+from utility.profiling import timed
+
+Conflicts = namedtuple('Conflicts', ['first', 'second', 'distances'])
+Conflicts.__doc__ = """ Pairs of entities closer than the clearance, as arrays with one entry per pair.
+
+    Attributes:
+        first (np.array): Entity number of the first entity of each pair, or placement number for placements.
+        second (np.array): Entity number of the second entity of each pair, or placement number for placements.
+        distances (np.array): Distance of the shapes, 0 where they touch, overlap or contain each other.
+"""
+
+MAX_EDGE_PAIRS = 2 ** 21  # edge pairs compared at once in the narrow phase
+
+
+def expand(starts, counts):
+    """ Returns the owner and the index of each element of the ranges starts[i]:starts[i] + counts[i] concatenated. """
+    owners = np.repeat(np.arange(counts.size), counts)
+    firsts = np.cumsum(counts) - counts
+    return owners, np.arange(owners.size) - np.repeat(firsts, counts) + np.repeat(starts, counts)
+
+
+def point_segment_distances(points, starts, ends):
+    edges = ends - starts
+    lengths = np.maximum(np.sum(edges ** 2, axis=1), 1e-300)
+    t = np.clip(np.sum((points - starts) * edges, axis=1) / lengths, 0, 1)
+    return np.hypot(*(starts + t[:, np.newaxis] * edges - points).T)
+
+
+def segment_distances(p0, p1, q0, q1):
+    """ Distance of the segments p0-p1 and q0-q1 of each row, 0 for crossing or touching segments. """
+    def cross(o, a, b):
+        return (a[:, 0] - o[:, 0]) * (b[:, 1] - o[:, 1]) - (a[:, 1] - o[:, 1]) * (b[:, 0] - o[:, 0])
+    d1, d2, d3, d4 = cross(q0, q1, p0), cross(q0, q1, p1), cross(p0, p1, q0), cross(p0, p1, q1)
+    crossing = (((d1 > 0) & (d2 < 0)) | ((d1 < 0) & (d2 > 0))) & (((d3 > 0) & (d4 < 0)) | ((d3 < 0) & (d4 > 0)))
+    distances = np.minimum(np.minimum(point_segment_distances(p0, q0, q1), point_segment_distances(p1, q0, q1)),
+                           np.minimum(point_segment_distances(q0, p0, p1), point_segment_distances(q1, p0, p1)))
+    distances[crossing] = 0.
+    return distances
+
+
+class ClearanceChecker:
+    """ Overlap and minimum spacing checks between the entities of a DXFGeometry.
+
+        Closed polylines and circles are filled shapes, open polylines are curves. The broad phase collects candidate
+        pairs from the R-tree of the bounding boxes grown by the clearance, all boxes at once. The narrow phase
+        computes the exact distances of all candidates in array operations: circle to circle from the centres,
+        circle to outline from the centre to the edges, outline to outline from all pairs of edges. Shapes touching,
+        overlapping or containing each other have distance 0. Ellipses of transformed geometries are checked as
+        inscribed polygons.
+
+        Example:
+            checker = ClearanceChecker(dxf_file.geometry())
+            conflicts = checker.check(clearance=0.5)
+            pairs = [(checker.handles[i], checker.handles[j]) for i, j in zip(conflicts.first, conflicts.second)]
+
+        Attributes:
+            geometry (DXFGeometry): Checked entities.
+            handles (list of string): Handle of each entity.
+            bounds (np.array): Bounding box of each entity.
+            circles (np.array): True for each entity checked as exact circle.
+            filled (np.array): True for each entity with an inside, circles and closed polylines of three or more
+                vertices.
+            edge_offsets (np.array): Edges of entity i are edges edge_offsets[i]:edge_offsets[i + 1].
+            edge_starts (np.array): Start point of each edge, shape (n_edges, 2).
+            edge_ends (np.array): End point of each edge, a single vertex is an edge of length 0.
+    """
+    def __init__(self, geometry, ellipse_points=64):
+        n = len(geometry)
+        self.geometry = geometry
+        self.handles = geometry.handles
+        self.bounds = geometry.bounds()
+        self.circles = np.zeros(n, dtype=bool)
+        self.filled = np.zeros(n, dtype=bool)
+        self.filled[geometry.circle_entities] = True
+        self.centers = np.zeros((n, 2))
+        self.radii = np.zeros(n)
+
+        lengths = np.diff(geometry.offsets)
+        self.filled[geometry.polyline_entities] = geometry.closed & (lengths > 2)
+        n_edges = np.where(geometry.closed & (lengths > 2), lengths, np.maximum(lengths - 1, np.minimum(lengths, 1)))
+        polylines, index = expand(np.zeros(lengths.size, dtype=int), n_edges)
+        starts = geometry.offsets[polylines] + index
+        ends = geometry.offsets[polylines] + (index + 1) % np.maximum(lengths[polylines], 1)
+        edge_starts, edge_ends = [geometry.vertices[starts]], [geometry.vertices[ends]]
+        owners = [geometry.polyline_entities[polylines]]
+        if geometry.circle_axes is None:
+            self.circles[geometry.circle_entities] = True
+            self.centers[geometry.circle_entities] = geometry.centers
+            self.radii[geometry.circle_entities] = geometry.radii
+        else:
+            rims = geometry.circle_points(np.arange(geometry.radii.size),
+                                          np.linspace(0, 2 * np.pi, ellipse_points, endpoint=False))
+            edge_starts.append(rims.reshape(-1, 2))
+            edge_ends.append(np.roll(rims, -1, axis=1).reshape(-1, 2))
+            owners.append(np.repeat(geometry.circle_entities, ellipse_points))
+        owners = np.concatenate(owners)
+        order = np.argsort(owners, kind='mergesort')
+        self.edge_starts = np.concatenate(edge_starts)[order]
+        self.edge_ends = np.concatenate(edge_ends)[order]
+        self.edge_offsets = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=n))]).astype(int)
+
+    def __len__(self):
+        return len(self.handles)
+
+    def rtree(self):
+        return self.geometry.rtree()
+
+    def edge_counts(self, entities):
+        return self.edge_offsets[entities + 1] - self.edge_offsets[entities]
+
+    def first_points(self, entities):
+        """ First vertex of each entity, a point inside any shape containing the entity. """
+        if not self.edge_starts.shape[0]:
+            return np.zeros((len(entities), 2))
+        return self.edge_starts[np.minimum(self.edge_offsets[entities], self.edge_starts.shape[0] - 1)]
+
+    def contains(self, entities, points):
+        """ True for each point inside the filled entity of the same row, by the crossing number of its edges. """
+        pairs, edges = expand(self.edge_offsets[entities], self.edge_counts(entities))
+        p, a, b = points[pairs], self.edge_starts[edges], self.edge_ends[edges]
+        crosses = ((a[:, 1] > p[:, 1]) != (b[:, 1] > p[:, 1])) & (
+            p[:, 0] < a[:, 0] + (p[:, 1] - a[:, 1]) * (b[:, 0] - a[:, 0]) / np.where(b[:, 1] == a[:, 1], 1.,
+                                                                                     b[:, 1] - a[:, 1]))
+        inside = np.bincount(pairs, weights=crosses, minlength=len(entities)) % 2 == 1
+        return inside & self.filled[entities]
+
+    def edge_distances(self, entities, points):
+        """ Distance of each point from the edges of the entity of the same row. """
+        counts = self.edge_counts(entities)
+        pairs, edges = expand(self.edge_offsets[entities], counts)
+        distances = np.full(len(entities), np.inf)
+        if edges.size:
+            values = point_segment_distances(points[pairs], self.edge_starts[edges], self.edge_ends[edges])
+            distances[counts > 0] = np.minimum.reduceat(values, (np.cumsum(counts) - counts)[counts > 0])
+        return distances
+
+    @timed('clearance.distances')
+    def distances(self, first, other, second):
+        """ Returns the distances of the entities first of this checker and second of other, row by row.
+
+            Args:
+                first (np.array): Entity numbers of this checker.
+                other (ClearanceChecker): Checker of the second entities, may be this checker.
+                second (np.array): Entity numbers of other.
+        """
+        first, second = np.asarray(first, dtype=int), np.asarray(second, dtype=int)
+        distances = np.zeros(first.size)
+        circle_a, circle_b = self.circles[first], other.circles[second]
+
+        both = circle_a & circle_b
+        distances[both] = (np.hypot(*(self.centers[first[both]] - other.centers[second[both]]).T) -
+                           self.radii[first[both]] - other.radii[second[both]])
+
+        for rows, circle_checker, circles, outline_checker, outlines in (
+                (np.flatnonzero(circle_a & ~circle_b), self, first, other, second),
+                (np.flatnonzero(~circle_a & circle_b), other, second, self, first)):
+            if not rows.size:
+                continue
+            centers = circle_checker.centers[circles[rows]]
+            d = outline_checker.edge_distances(outlines[rows], centers) - circle_checker.radii[circles[rows]]
+            d[outline_checker.contains(outlines[rows], centers)] = 0.
+            distances[rows] = d
+
+        rows = np.flatnonzero(~circle_a & ~circle_b)
+        if rows.size:
+            distances[rows] = self.outline_distances(first[rows], other, second[rows])
+        return np.maximum(distances, 0.)
+
+    def outline_distances(self, first, other, second):
+        """ Distances of entities with edges, the smallest distance of their edges, 0 if one contains the other. """
+        counts_a, counts_b = self.edge_counts(first), other.edge_counts(second)
+        products = counts_a * counts_b
+        distances = np.full(first.size, np.inf)
+        cumulative = np.cumsum(products)
+        start = 0
+        while start < first.size:  # chunks of at most MAX_EDGE_PAIRS edge pairs, at least one entity pair
+            done = cumulative[start - 1] if start else 0
+            stop = max(start + 1, int(np.searchsorted(cumulative, done + MAX_EDGE_PAIRS, side='right')))
+            rows = np.arange(start, min(stop, first.size))
+            pairs, k = expand(np.zeros(rows.size, dtype=int), products[rows])
+            edges_a = self.edge_offsets[first[rows]][pairs] + k // counts_b[rows][pairs]
+            edges_b = other.edge_offsets[second[rows]][pairs] + k % counts_b[rows][pairs]
+            values = segment_distances(self.edge_starts[edges_a], self.edge_ends[edges_a],
+                                       other.edge_starts[edges_b], other.edge_ends[edges_b])
+            nonempty = products[rows] > 0
+            if values.size:
+                distances[rows[nonempty]] = np.minimum.reduceat(
+                    values, (np.cumsum(products[rows]) - products[rows])[nonempty])
+            start = rows[-1] + 1
+        inside = other.contains(second, self.first_points(first)) | self.contains(first, other.first_points(second))
+        distances[inside] = 0.
+        return distances
+
+    @timed('clearance.check')
+    def check(self, clearance=0., layers=None):
+        """ Returns all pairs of entities closer than clearance, overlapping or touching pairs for clearance 0.
+
+            Entities of the same block reference, sharing a handle, are not checked against each other.
+
+            Args:
+                clearance (float): Minimum spacing in um.
+                layers (list of string): Check only entities on these layers, default all.
+
+            Returns:
+                Conflicts: Entity numbers, first < second, and distances.
+        """
+        grown = self.bounds + np.array([-clearance, -clearance, clearance, clearance])
+        first, second = self.rtree().query_pairs(grown)
+        keep = first < second
+        if layers is not None:
+            mask = self.geometry.layer_mask(layers)
+            keep &= mask[first] & mask[second]
+        first, second = first[keep], second[keep]
+        handles = np.array(self.handles, dtype=object)
+        keep = (handles[first] != handles[second]) | (handles[first] == '')
+        return self.conflicts(first[keep], self, second[keep], clearance)
+
+    def conflicts(self, first, other, second, clearance):
+        distances = self.distances(first, other, second) if first.size else np.zeros(0)
+        bad = (distances < clearance) | (distances <= 0)
+        return Conflicts(first[bad], second[bad], distances[bad])
+
+    @timed('clearance.placement')
+    def check_placement(self, stencil, positions, clearance=0., layers=None):
+        """ Checks a stencil placed at each position against the entities of this checker and the other placements.
+
+            Args:
+                stencil (DXFGeometry): Geometry of the stencil, with its origin at the position.
+                positions (np.array): Positions [x, y] of the placements, shape (n_placements, 2).
+                clearance (float): Minimum spacing in um.
+                layers (list of string): Check only against entities on these layers, default all.
+
+            Returns:
+                Conflicts: Placement number and entity number of this checker of each conflict.
+                Conflicts: Pairs of placement numbers closer than clearance, first < second.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        if not len(stencil) or not positions.shape[0]:
+            empty = Conflicts(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+            return empty, empty
+        matrices = np.repeat(np.eye(3)[np.newaxis], positions.shape[0], axis=0)
+        matrices[:, 2, :2] = positions
+        placed = ClearanceChecker(stencil.instances(matrices))
+        n_stencil = len(stencil)
+        grown = placed.bounds + np.array([-clearance, -clearance, clearance, clearance])
+
+        entities, layout = self.rtree().query_pairs(grown)
+        if layers is not None:
+            keep = self.geometry.layer_mask(layers)[layout]
+            entities, layout = entities[keep], layout[keep]
+        found = placed.conflicts(entities, self, layout, clearance)
+        with_layout = unique_conflicts(found.first // n_stencil, found.second, found.distances)
+
+        first, second = placed.rtree().query_pairs(grown)
+        keep = first // n_stencil < second // n_stencil
+        found = placed.conflicts(first[keep], placed, second[keep], clearance)
+        mutual = unique_conflicts(found.first // n_stencil, found.second // n_stencil, found.distances)
+        return with_layout, mutual
+
+
+def unique_conflicts(first, second, distances):
+    """ Merges conflicts of the same pair, keeping the smallest distance. """
+    order = np.lexsort((distances, second, first))
+    first, second, distances = first[order], second[order], distances[order]
+    new = np.ones(first.size, dtype=bool)
+    new[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+    return Conflicts(first[new], second[new], distances[new])
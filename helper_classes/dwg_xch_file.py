@@ -1,10 +1,44 @@
+import os
+import re
+from collections import OrderedDict
+
 from PyQt5 import QtWidgets
 
 import ezdxf
+import numpy as np
 
 from utility.config import paths
+from helper_classes.clearance import ClearanceChecker
+from helper_classes.dxf_geometry import DXFGeometry
 from helper_classes.dxf_point import DXFPoint
+from helper_classes.dxf_writer import write_geometry
+from helper_classes.gds_file import GDSLibrary
 from helper_classes.stack import Stack
+from utility.profiling import timed, timer
+
+LAYOUT_FILTER = "Drawing interchange files (*.dxf);;GDSII stream files (*.gds *.gds2)"
+
+
+def is_gds(file_name):
+    return file_name.lower().endswith(('.gds', '.gds2'))
+
+
+def recolor(geometry, layer, color):
+    """ Sets the color of the entities of a geometry drawn in the color of layer. """
+    geometry.colors[geometry.layer_mask([layer]) & geometry.by_layer] = color
+
+
+def block_content(entities):
+    """ Layer and coordinates of the circles and polylines a stencil block is made of, to compare blocks. """
+    content = []
+    for e in entities:
+        if e.dxftype() == 'CIRCLE':
+            content.append(('CIRCLE', e.dxf.layer, tuple(e.dxf.center)[:2] + (e.dxf.radius,)))
+        elif e.dxftype() == 'POLYLINE':
+            content.append(('POLYLINE', e.dxf.layer, tuple(tuple(p)[:2] for p in e.points())))
+        elif e.dxftype() == 'LWPOLYLINE':
+            content.append(('POLYLINE', e.dxf.layer, tuple(tuple(p)[:2] for p in e.get_rstrip_points())))
+    return content
 
 
 # noinspection PyArgumentList
@@ -14,13 +48,31 @@ class DwgXchFile:
         self.file_type = 'standard'
         self.drawing = ezdxf.new('R2010')
         self.added_objects = Stack()
+        self.geometry_cache = None
+        self.shared_cache = None
+        self.library = None  # GDSLibrary of layouts read from GDSII, drawing then holds only the added stencils
+        self.layer_filter = None  # names of the only layers read into the geometry, None for all
+        self.source_name = None  # GDSII file read with a layer filter, never overwritten by the partial library
+        self.hidden_layers = set()
+        self.layer_colors = {}  # layer name -> color set in the layer dialog
+        self.checker_cache = None
+        self.stencil_blocks = {}  # stencil -> name of its block in drawing
 
     def load(self, parent, file_type='standard', **kwargs):
+        """ Loads a dxf or GDSII file.
+
+            Args:
+                file_name (string): File loaded without dialog for stencils.
+                layers (list): Names of the only layers put into the geometry. GDSII elements on other layers are
+                    not read at all, so save asks for a new file name instead of overwriting the GDSII file with the
+                    partial library. Dxf files are parsed completely, the layers only limit the geometry.
+                select_layers: Called with the layer names of a GDSII file before reading it, returns the layers to
+                    read or None to cancel loading.
+        """
         self.file_name = kwargs.get('file_name', self.file_name)
         self.file_type = file_type
         if self.file_type == 'standard':
-            fname = QtWidgets.QFileDialog.getOpenFileName(parent, 'Open file', paths['registration'],
-                                                          "Drawing interchange files (*.dxf)")[0]
+            fname = QtWidgets.QFileDialog.getOpenFileName(parent, 'Open file', paths['registration'], LAYOUT_FILTER)[0]
         elif self.file_type == 'template':
             fname = QtWidgets.QFileDialog.getOpenFileName(parent, 'Open file', paths['templates'],
                                                           "Drawing interchange files (*.dxf)")[0]
@@ -33,55 +85,186 @@ class DwgXchFile:
             fname = None
         if not fname:  # capture cancel in dialog
             return
+        layers = kwargs.get('layers', None)
+        if kwargs.get('select_layers') and is_gds(fname):
+            names = GDSLibrary.layer_names(fname)
+            if len(names) > 1:
+                layers = kwargs['select_layers'](names)
+                if layers is None:
+                    return
+                layers = layers if len(layers) < len(names) else None
         self.file_name = fname
-        self.drawing = ezdxf.readfile(self.file_name)
+        self.layer_filter = layers
+        self.hidden_layers, self.layer_colors = set(), {}
+        self.stencil_blocks = {}
+        if is_gds(self.file_name):
+            self.library = GDSLibrary.read(self.file_name, self.layer_filter)
+            self.drawing = ezdxf.new('R2010')
+            self.source_name = self.file_name if self.layer_filter is not None else None
+        else:
+            self.library = None
+            self.source_name = None
+            with timer('dxf.load'):
+                self.drawing = ezdxf.readfile(self.file_name)
+        self.geometry_cache = self.shared_cache = None
+
+    def is_source(self, file_name):
+        """ True if file_name is the GDSII file read with a layer filter. """
+        return self.source_name is not None and os.path.abspath(file_name) == os.path.abspath(self.source_name)
 
     def save(self, parent, overwrite=True):
-        if any([not overwrite, not self.file_name, not self.file_type == 'standard']):
-            fname = QtWidgets.QFileDialog.getSaveFileName(parent, 'Save File', paths['registration'],
-                                                          "Drawing interchange files (*.dxf)")[0]
-            if not fname:  # capture cancel in dialog
-                return
+        if any([not overwrite, not self.file_name, not self.file_type == 'standard', self.is_source(self.file_name)]):
+            fname = self.file_name if self.is_source(self.file_name) else ''
+            while not fname or self.is_source(fname):  # the layers not read would be deleted from the source
+                caption = 'Save File' if not fname else 'Save File - only some layers of {0} were read, ' \
+                                                        'choose a new name'.format(os.path.basename(fname))
+                fname = QtWidgets.QFileDialog.getSaveFileName(parent, caption, paths['registration'],
+                                                              LAYOUT_FILTER)[0]
+                if not fname:  # capture cancel in dialog
+                    return
             self.file_name = fname
             self.file_type = 'standard'
-            self.drawing.saveas(self.file_name)
+        with timer('dxf.save'):
+            if is_gds(self.file_name):
+                library = self.library or GDSLibrary.from_geometry(DXFGeometry.from_drawing(self.drawing))
+                library.write(self.file_name, extra=DXFGeometry.from_drawing(self.drawing) if self.library else None)
+            elif self.library:  # layouts read from GDSII are written flat
+                write_geometry(self.file_name, self.geometry())
+            else:
+                self.drawing.saveas(self.file_name)
+
+    def geometry(self):
+        """ Returns the DXFGeometry of the drawing, rebuilt only after the drawing changed. """
+        if self.geometry_cache is None:
+            self.geometry_cache = DXFGeometry.concatenate([self.shared_geometry(), DXFGeometry.from_drawing(
+                self.drawing, references=False, layers=self.layer_filter)])
+            for name, color in self.layer_colors.items():
+                recolor(self.geometry_cache, name, color)
+        return self.geometry_cache
+
+    def shared_geometry(self):
+        """ Returns the geometry placed from shared definitions, the GDSII library and the block references. """
+        if self.shared_cache is None:
+            parts = [self.library.geometry()] if self.library else []
+            self.shared_cache = DXFGeometry.concatenate(parts + [DXFGeometry.from_references(
+                self.drawing, layers=self.layer_filter)])
+        return self.shared_cache
+
+    def layer_names(self):
+        """ Names of the layers of the drawing, followed by the layers only used by the GDSII library. """
+        names = [layer.dxf.name for layer in self.drawing.layers]
+        return names + [name for name in self.geometry().layer_names if name not in names]
+
+    def layer_color(self, name):
+        if name in self.layer_colors:
+            return self.layer_colors[name]
+        if name in self.drawing.layers:
+            return self.drawing.layers.get(name).get_color()
+        geometry = self.geometry()
+        colors = geometry.colors[geometry.layer_mask([name])]
+        return int(colors[0]) if colors.size else 7
+
+    def set_layer_color(self, name, color):
+        """ Sets the color of a layer, also in the drawing, and recolors its entities drawn by layer in place. """
+        self.layer_colors[name] = color
+        if name in self.drawing.layers:
+            self.drawing.layers.get(name).set_color(color)
+        if self.geometry_cache is not None:
+            recolor(self.geometry_cache, name, color)
+
+    def layer_visible(self, name):
+        return name not in self.hidden_layers
+
+    def set_layer_visible(self, name, visible):
+        if visible:
+            self.hidden_layers.discard(name)
         else:
-            self.drawing.save()
+            self.hidden_layers.add(name)
+
+    def selectable(self):
+        """ Returns True for each entity of the geometry on a visible layer, None if all layers are visible. """
+        if not self.hidden_layers:
+            return None
+        return ~self.geometry().layer_mask(self.hidden_layers)
 
+    @timed('dxf.points')
     def points(self):
         pt_list = DXFPoint()
-        for e in self.drawing.entities:
-            if e.dxftype() == 'CIRCLE':
-                pt_list.add(e.dxf.center[:-1], e.dxf.handle)
-            elif e.dxftype() == 'POLYLINE':
-                for pt in e.points():
-                    pt_list.add(pt[:-1], e.dxf.handle)
-            elif e.dxftype() == 'LWPOLYLINE':  # TODO: Test 'LWPOLYLINE'
-                for pt in e.get_rstrip_points():
-                    pt_list.add(pt, e.dxf.handle)
+        geometry = self.geometry()
+        handles = np.array(geometry.handles, dtype=object)
+        for pt, handle in zip(geometry.centers.tolist(), handles[geometry.circle_entities].tolist()):
+            pt_list.add(pt, handle)
+        vertex_entities = np.repeat(geometry.polyline_entities, np.diff(geometry.offsets))
+        for pt, handle in zip(geometry.vertices.tolist(), handles[vertex_entities].tolist()):
+            pt_list.add(pt, handle)
         return pt_list
 
-    def add_stencil(self, stencil, position):  # TODO: Change all DXF formats to beyond R12! Then implement Import Fct
-        msp = self.drawing.modelspace()
-        n_entities = len(self.drawing.entities)  # TODO: Clean way for undoing dxf insertion
+    @timed('dxf.add_stencil')
+    def add_stencil(self, stencil, position):
+        """ Places a stencil as block reference, the block is defined from the stencil when it is placed first. """
+        self.drawing.modelspace().add_blockref(self.define_block(stencil), (position[0], position[1]))
+        self.added_objects.push(1)
+        self.geometry_cache = self.shared_cache = None
+
+    def define_block(self, stencil):  # TODO: Change all DXF formats to beyond R12! Then implement Import Fct
+        """ Returns the name of the block of a stencil, named after its file, and defines the block if missing.
+
+            A block of that name with other entities, e.g. of a stencil file of the same name in another directory,
+            is never reused, the new block is numbered instead, e.g. ST_1.
+        """
+        if stencil in self.stencil_blocks:
+            return self.stencil_blocks[stencil]
+        base = re.sub(r'[^\w$-]', '_', os.path.splitext(os.path.basename(stencil.file_name))[0]) or 'STENCIL'
+        content = block_content(stencil.drawing.entities)
+        name, number = base, 0
+        while name in self.drawing.blocks:
+            if block_content(self.drawing.blocks.get(name)) == content:
+                self.stencil_blocks[stencil] = name
+                return name
+            number += 1
+            name = '{0}_{1}'.format(base, number)
+        block = self.drawing.blocks.new(name=name)
         for e in stencil.drawing.entities:
             if e.dxf.layer not in self.drawing.layers:
                 self.drawing.layers.new(name=e.dxf.layer,
                                         dxfattribs={'linetype': 'CONTINUOUS', 'color': self.drawing.layers.__len__()})
             if e.dxftype() == 'CIRCLE':
-                center = (e.dxf.center[0] + position[0], e.dxf.center[1] + position[1], e.dxf.center[2])
-                msp.add_circle(center, e.dxf.radius)
-                print('circle', dxfattribs={'layer': e.dxf.layer})
+                block.add_circle(e.dxf.center, e.dxf.radius, dxfattribs={'layer': e.dxf.layer})
             elif e.dxftype() == 'POLYLINE':
-                pt_list = [(p[0] + position[0], p[1] + position[1], p[2]) for p in e.points()]
-                msp.add_polyline3d(pt_list, dxfattribs={'layer': e.dxf.layer})
+                block.add_polyline3d(list(e.points()), dxfattribs={'layer': e.dxf.layer})
             elif e.dxftype() == 'LWPOLYLINE':  # TODO: Test 'LWPOLYLINE'
-                pt_list = [(p[0] + position[0], p[1] + position[1]) for p in e.get_rstrip_points()]
-                self.drawing.modelspace().add_lwpolyline(pt_list, dxfattribs={'layer': e.dxf.layer})
-        self.added_objects.push(len(self.drawing.entities) - n_entities)
+                block.add_lwpolyline(e.get_rstrip_points(), dxfattribs={'layer': e.dxf.layer})
+        self.stencil_blocks[stencil] = name
+        return name
+
+    def clearance_checker(self):
+        """ Returns the ClearanceChecker of the geometry, rebuilt only after the geometry changed. """
+        if self.checker_cache is None or self.checker_cache.geometry is not self.geometry():
+            self.checker_cache = ClearanceChecker(self.geometry())
+        return self.checker_cache
+
+    def check_placement(self, stencil, positions, clearance=0.):
+        """ Checks placements of a stencil before adding them, against the drawing and against each other.
+
+            Args:
+                stencil (DwgXchFile): Stencil as passed to add_stencil.
+                positions (list): Positions [x, y] of the placements.
+                clearance (float): Minimum spacing in um, 0 to find overlaps only.
+
+            Returns:
+                list: (placement number, handle, distance) of each entity of the drawing in conflict with a placement.
+                list: (placement number, placement number, distance) of each pair of placements in conflict.
+        """
+        with_drawing, mutual = self.clearance_checker().check_placement(stencil.geometry(), positions, clearance)
+        handles = self.geometry().handles
+        closest = OrderedDict()  # entities of one block reference share its handle
+        for i, entity, d in zip(*[a.tolist() for a in with_drawing]):
+            closest[(i, handles[entity])] = min(d, closest.get((i, handles[entity]), d))
+        return [key + (d,) for key, d in closest.items()], list(zip(*[a.tolist() for a in mutual]))
 
     def undo_add_stencil(self):
         if not self.added_objects.is_empty():
             msp = self.drawing.modelspace()
             for e in msp.query()[-self.added_objects.pop():]:
                 msp.delete_entity(e)
+            self.geometry_cache = self.shared_cache = None
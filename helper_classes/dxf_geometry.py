@@ -0,0 +1,512 @@
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib.path import Path
+
+from helper_classes.rtree import RTree
+from helper_classes.snap_engine import SnapEngine
+from utility.profiling import timed
+from utility.xterm_hex_conv import xterm_to_hex
+
+
+def is_conformal(linear, rtol=1e-9):
+    """ True for each 2x2 matrix, shape (n, 2, 2), with orthogonal rows of equal length, mapping circles to circles. """
+    a, b = linear[:, 0], linear[:, 1]
+    aa, bb, ab = np.sum(a * a, axis=1), np.sum(b * b, axis=1), np.sum(a * b, axis=1)
+    tolerance = rtol * np.maximum(aa + bb, 1e-300)
+    return (np.abs(aa - bb) <= tolerance) & (np.abs(ab) <= tolerance)
+
+
+def insert_matrices(insert, base_point=(0., 0.)):
+    """ Returns the affine matrices placing block coordinates by an INSERT, one per cell of a MINSERT array.
+
+        The base point of the block is moved to the origin, then the block is scaled, shifted by the array spacing,
+        rotated and moved to the insertion point. Matrices are for row vectors [x y 1], shape (n_cells, 3, 3).
+    """
+    columns, rows = insert.get_dxf_attrib('column_count', 1), insert.get_dxf_attrib('row_count', 1)
+    shifts = np.stack(np.meshgrid(np.arange(columns) * insert.get_dxf_attrib('column_spacing', 0.),
+                                  np.arange(rows) * insert.get_dxf_attrib('row_spacing', 0.)), axis=-1).reshape(-1, 2)
+    angle = np.radians(insert.get_dxf_attrib('rotation', 0.))
+    rotation = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+    scale = np.diag([insert.get_dxf_attrib('xscale', 1.), insert.get_dxf_attrib('yscale', 1.)])
+    matrices = np.zeros((shifts.shape[0], 3, 3))
+    matrices[:, :2, :2] = np.dot(scale, rotation)
+    matrices[:, 2, :2] = np.dot(shifts - np.dot(base_point, scale), rotation) + insert.dxf.insert[:2]
+    matrices[:, 2, 2] = 1.
+    return matrices
+
+
+class DXFGeometry:
+    """ Outlines of the entities of a drawing as flat numpy arrays.
+
+        Entities are numbered in drawing order. Circles and polylines are stored separately, each with the number of
+        its entity, so the geometry of thousands of entities is processed without iterating over ezdxf objects.
+        Polyline vertices of all polylines are concatenated, the vertices of polyline i are
+        vertices[offsets[i]:offsets[i + 1]].
+
+        Attributes:
+            handles (list of string): Handle of each entity.
+            colors (np.array): Resolved color index of each entity, by layer colors replaced by the layer color.
+            by_layer (np.array): Boolean, True for entities drawn in the color of their layer.
+            layers (np.array): Index into layer_names of each entity.
+            layer_names (list of string): Names of the layers used by the entities.
+            circle_entities (np.array): Entity number of each circle.
+            centers (np.array): Circle centers, shape (n_circles, 2).
+            radii (np.array): Circle radii.
+            polyline_entities (np.array): Entity number of each polyline.
+            vertices (np.array): Vertices of all polylines, shape (n_vertices, 2).
+            offsets (np.array): Start of each polyline in vertices, n_polylines + 1 entries.
+            closed (np.array): Boolean, True for closed polylines.
+            circle_axes (np.array): Ellipses the circles became by a transformation, shape (n_circles, 2, 2), point t of
+                circle i is centers[i] + cos(t) * circle_axes[i, 0] + sin(t) * circle_axes[i, 1]. None while all circles
+                are circles of radii.
+            matrix (np.array): Affine 3x3 matrix for row vectors [x y 1] applied to the drawing coordinates.
+    """
+    def __init__(self):
+        self.handles = []
+        self.colors = np.zeros(0, dtype=int)
+        self.by_layer = np.zeros(0, dtype=bool)
+        self.layers = np.zeros(0, dtype=int)
+        self.layer_names = []
+        self.circle_entities = np.zeros(0, dtype=int)
+        self.centers = np.zeros((0, 2))
+        self.radii = np.zeros(0)
+        self.polyline_entities = np.zeros(0, dtype=int)
+        self.vertices = np.zeros((0, 2))
+        self.offsets = np.zeros(1, dtype=int)
+        self.closed = np.zeros(0, dtype=bool)
+        self.circle_axes = None
+        self.matrix = np.eye(3)
+        self.bounds_cache = None
+        self.rtree_cache = None
+        self.snap_cache = None
+
+    @classmethod
+    @timed('dxf.geometry')
+    def from_drawing(cls, drawing, references=True, layers=None):
+        """ Returns the geometry of the entities of a drawing, followed by the placements of its block references.
+
+            Args:
+                drawing: ezdxf drawing.
+                references (bool): Include the entities placed by block references.
+                layers (list of string): Read only entities on these layers, default all.
+        """
+        geometry = cls.from_entities(drawing.entities, drawing, layers)
+        if references:
+            geometry = cls.concatenate([geometry, cls.from_references(drawing, layers=layers)])
+        return geometry
+
+    @classmethod
+    def from_references(cls, drawing, entities=None, blocks=None, layers=None):
+        """ Returns the geometry of all block references (INSERT) among entities, default the entities of the drawing.
+
+            Each block is read once and placed by all of its references in a single call of instances, so the cost
+            grows with the unique geometry, not with the number of placements. Placed entities carry the handle of
+            their INSERT, picking selects the whole reference.
+
+            Args:
+                drawing: ezdxf drawing holding the block definitions and layers.
+                entities: Entities searched for references, e.g. the entities of a block for nested references.
+                blocks (dict): Block name -> (geometry, base point) of blocks read before, filled on the way.
+                layers (list of string): Place only entities on these layers, default all.
+        """
+        blocks = {} if blocks is None else blocks
+        placements = OrderedDict()
+        for e in drawing.entities if entities is None else entities:
+            if e.dxftype() == 'INSERT':
+                placements.setdefault(e.dxf.name, []).append(e)
+        parts = []
+        for name, inserts in placements.items():
+            if name not in blocks:
+                block = drawing.blocks.get(name)
+                blocks[name] = (cls(), (0., 0.))  # guards against blocks referencing themselves
+                blocks[name] = (cls.concatenate([cls.from_entities(block, drawing, layers),
+                                                 cls.from_references(drawing, block, blocks, layers)]),
+                                block.block.dxf.base_point[:2])
+            block_geometry, base_point = blocks[name]
+            if not len(block_geometry):
+                continue
+            matrices = [insert_matrices(e, base_point) for e in inserts]
+            part = block_geometry.instances(np.concatenate(matrices))
+            part.handles = [e.dxf.handle for e, m in zip(inserts, matrices)
+                            for _ in range(len(m) * len(block_geometry))]
+            parts.append(part)
+        return cls.concatenate(parts)
+
+    @classmethod
+    def from_entities(cls, entities, drawing, layer_filter=None):
+        """ Returns the geometry of the circles and polylines among entities, with colors by layer from drawing.
+
+            Entities on layers not in layer_filter are skipped, if given.
+        """
+        geometry = cls()
+        colors, by_layer, layers = [], [], []
+        circle_entities, centers, radii = [], [], []
+        polyline_entities, vertices, lengths, closed = [], [], [], []
+        for e in entities:
+            if layer_filter is not None and e.dxf.layer not in layer_filter:
+                continue
+            if e.dxftype() == 'CIRCLE':
+                circle_entities.append(len(colors))
+                centers.append(e.dxf.center[:2])
+                radii.append(e.dxf.radius)
+            elif e.dxftype() == 'POLYLINE':
+                pts = [p[:2] for p in e.points()]
+                polyline_entities.append(len(colors))
+                vertices.extend(pts)
+                lengths.append(len(pts))
+                closed.append(e.is_closed)
+            elif e.dxftype() == 'LWPOLYLINE':
+                pts = [p[:2] for p in e.get_rstrip_points()]
+                polyline_entities.append(len(colors))
+                vertices.extend(pts)
+                lengths.append(len(pts))
+                closed.append(e.closed)
+            else:
+                continue
+            if e.dxf.layer not in geometry.layer_names:
+                geometry.layer_names.append(e.dxf.layer)
+            layers.append(geometry.layer_names.index(e.dxf.layer))
+            by_layer.append(e.dxf.color >= 256)
+            if e.dxf.color < 256:
+                colors.append(e.dxf.color)
+            else:
+                colors.append(drawing.layers.get(e.dxf.layer).get_color())
+            geometry.handles.append(e.dxf.handle)
+        geometry.colors = np.array(colors, dtype=int)
+        geometry.by_layer = np.array(by_layer, dtype=bool)
+        geometry.layers = np.array(layers, dtype=int)
+        geometry.circle_entities = np.array(circle_entities, dtype=int)
+        geometry.centers = np.array(centers, dtype=float).reshape(-1, 2)
+        geometry.radii = np.array(radii, dtype=float)
+        geometry.polyline_entities = np.array(polyline_entities, dtype=int)
+        geometry.vertices = np.array(vertices, dtype=float).reshape(-1, 2)
+        geometry.offsets = np.concatenate([[0], np.cumsum(lengths, dtype=int)]).astype(int)
+        geometry.closed = np.array(closed, dtype=bool)
+        return geometry
+
+    @classmethod
+    def from_arrays(cls, centers=None, radii=None, vertices=None, offsets=None, closed=None, colors=7, layers=0,
+                    layer_names=None, by_layer=False):
+        """ Builds a geometry from arrays, e.g. a generated marker array, circles first, then polylines.
+
+            Args:
+                centers (np.array): Circle centres, shape (n_circles, 2).
+                radii (np.array): Circle radii.
+                vertices (np.array): Vertices of all polylines, shape (n_vertices, 2).
+                offsets (np.array): Start of each polyline in vertices, n_polylines + 1 entries.
+                closed (np.array): True for closed polylines, default all closed.
+                colors (np.array): Color of each entity or one color for all.
+                layers (np.array): Index into layer_names of each entity or one index for all.
+                layer_names (list of string): Default ['0'].
+                by_layer (bool): The colors are the colors of the layers.
+
+            Handles are empty, DXFWriter allocates them on writing.
+        """
+        geometry = cls()
+        geometry.centers = np.zeros((0, 2)) if centers is None else np.asarray(centers, dtype=float).reshape(-1, 2)
+        geometry.radii = np.broadcast_to(np.asarray(0. if radii is None else radii, dtype=float),
+                                         (geometry.centers.shape[0],)).copy()
+        geometry.vertices = np.zeros((0, 2)) if vertices is None else np.asarray(vertices, dtype=float).reshape(-1, 2)
+        geometry.offsets = np.zeros(1, dtype=int) if offsets is None else np.asarray(offsets, dtype=int)
+        n_circles, n_polylines = geometry.centers.shape[0], geometry.offsets.size - 1
+        geometry.closed = np.ones(n_polylines, dtype=bool) if closed is None else np.asarray(closed, dtype=bool)
+        geometry.circle_entities = np.arange(n_circles)
+        geometry.polyline_entities = np.arange(n_circles, n_circles + n_polylines)
+        geometry.handles = [''] * (n_circles + n_polylines)
+        geometry.colors = np.broadcast_to(np.asarray(colors, dtype=int), (len(geometry),)).copy()
+        geometry.by_layer = np.full(len(geometry), by_layer, dtype=bool)
+        geometry.layers = np.broadcast_to(np.asarray(layers, dtype=int), (len(geometry),)).copy()
+        geometry.layer_names = list(layer_names or ['0'])
+        return geometry
+
+    @classmethod
+    def concatenate(cls, geometries):
+        """ Returns one geometry holding the entities of all geometries, in the given order. """
+        geometry = cls()
+        geometries = [g for g in geometries if len(g)]
+        if not geometries:
+            return geometry
+        if len(geometries) == 1:
+            return geometries[0]
+        starts = np.cumsum([0] + [len(g) for g in geometries])
+        vertex_starts = np.cumsum([0] + [g.vertices.shape[0] for g in geometries])
+        for g in geometries:
+            geometry.layer_names.extend(name for name in g.layer_names if name not in geometry.layer_names)
+        geometry.handles = [handle for g in geometries for handle in g.handles]
+        geometry.colors = np.concatenate([g.colors for g in geometries])
+        geometry.by_layer = np.concatenate([g.by_layer for g in geometries])
+        geometry.layers = np.concatenate([np.array([geometry.layer_names.index(name) for name in g.layer_names],
+                                                   dtype=int)[g.layers] for g in geometries])
+        geometry.circle_entities = np.concatenate([g.circle_entities + s for g, s in zip(geometries, starts)])
+        geometry.centers = np.concatenate([g.centers for g in geometries])
+        geometry.radii = np.concatenate([g.radii for g in geometries])
+        if any(g.circle_axes is not None for g in geometries):
+            geometry.circle_axes = np.concatenate([g.axes() for g in geometries])
+        geometry.polyline_entities = np.concatenate([g.polyline_entities + s for g, s in zip(geometries, starts)])
+        geometry.vertices = np.concatenate([g.vertices for g in geometries])
+        geometry.offsets = np.concatenate([[0]] + [g.offsets[1:] + s for g, s in zip(geometries, vertex_starts)])
+        geometry.closed = np.concatenate([g.closed for g in geometries])
+        return geometry
+
+    def instances(self, matrices):
+        """ Returns k copies of the geometry, each transformed by one of k affine matrices, shape (k, 3, 3).
+
+            All copies are computed at once, so a cell placed thousands of times is flattened in a few array
+            operations. Copies follow each other, entity e of copy i is entity i * len(self) + e.
+        """
+        matrices = np.asarray(matrices, dtype=float).reshape(-1, 3, 3)
+        k, n = matrices.shape[0], len(self)
+        linear, shift = matrices[:, :2, :2], matrices[:, np.newaxis, 2, :2]
+        geometry = DXFGeometry()
+        geometry.handles = self.handles * k
+        geometry.colors = np.tile(self.colors, k)
+        geometry.by_layer = np.tile(self.by_layer, k)
+        geometry.layers = np.tile(self.layers, k)
+        geometry.layer_names = self.layer_names
+        copies = (np.arange(k) * n)[:, np.newaxis]
+        geometry.circle_entities = (copies + self.circle_entities).ravel()
+        geometry.polyline_entities = (copies + self.polyline_entities).ravel()
+        geometry.centers = (np.einsum('ni,kij->knj', self.centers, linear) + shift).reshape(-1, 2)
+        geometry.vertices = (np.einsum('ni,kij->knj', self.vertices, linear) + shift).reshape(-1, 2)
+        n_vertices = self.vertices.shape[0]
+        geometry.offsets = np.append((self.offsets[:-1] + (np.arange(k) * n_vertices)[:, np.newaxis]).ravel(),
+                                     k * n_vertices).astype(int)
+        geometry.closed = np.tile(self.closed, k)
+        axes = np.einsum('cij,kjl->kcil', self.axes(), linear).reshape(-1, 2, 2)
+        if is_conformal(axes).all():
+            geometry.radii = np.hypot(axes[:, 0, 0], axes[:, 0, 1])
+        else:
+            geometry.circle_axes = axes
+            geometry.radii = np.sqrt(abs(np.linalg.det(axes)))
+        return geometry
+
+    def __len__(self):
+        return len(self.handles)
+
+    @timed('dxf.transform')
+    def transformed(self, matrix):
+        """ Returns a copy of the geometry with all coordinates transformed by an affine matrix.
+
+            Circle centres and polyline vertices are transformed together in a single matrix product. Circles stay
+            circles under rotations, reflections, shifts and uniform scaling, otherwise they become ellipses, see
+            circle_axes. Entity attributes are shared with this geometry, not copied.
+
+            Args:
+                matrix (np.array): 3x3 matrix for row vectors [x y 1], as fitted by fit_trafo.
+
+            Returns:
+                DXFGeometry: The transformed geometry, geometry.transformed(np.linalg.inv(matrix)) undoes it.
+        """
+        matrix = np.asarray(matrix, dtype=float)
+        linear = matrix[:2, :2]
+        geometry = DXFGeometry()
+        for name in ('handles', 'colors', 'by_layer', 'layers', 'layer_names', 'circle_entities', 'polyline_entities',
+                     'offsets', 'closed'):
+            setattr(geometry, name, getattr(self, name))
+        n_circles = self.centers.shape[0]
+        points = np.dot(np.concatenate([self.centers, self.vertices]), linear) + matrix[2, :2]
+        geometry.centers, geometry.vertices = points[:n_circles], points[n_circles:]
+        scale = np.sqrt(abs(np.linalg.det(linear)))
+        if self.circle_axes is None and is_conformal(linear[np.newaxis])[0]:
+            geometry.radii = self.radii * scale
+        else:
+            axes = np.dot(self.axes(), linear)
+            if is_conformal(axes).all():  # back to circles, e.g. after the inverse transformation
+                geometry.radii = np.hypot(axes[:, 0, 0], axes[:, 0, 1])
+            else:
+                geometry.circle_axes = axes
+                geometry.radii = np.sqrt(abs(np.linalg.det(axes)))  # radius of the circle of equal area
+        geometry.matrix = np.dot(self.matrix, matrix)
+        return geometry
+
+    def axes(self):
+        """ Returns the axes of all circles and ellipses, see circle_axes. """
+        if self.circle_axes is not None:
+            return self.circle_axes
+        return self.radii[:, np.newaxis, np.newaxis] * np.eye(2)
+
+    def circle_points(self, circles, phase):
+        """ Returns the points at angles phase on the given circles or ellipses, shape (len(circles), len(phase), 2).
+        """
+        axes = self.axes()[circles]
+        cos, sin = np.cos(phase)[np.newaxis, :, np.newaxis], np.sin(phase)[np.newaxis, :, np.newaxis]
+        return self.centers[circles][:, np.newaxis] + cos * axes[:, np.newaxis, 0] + sin * axes[:, np.newaxis, 1]
+
+    def rgb(self):
+        """ Returns the colors of all entities as uint8 array of shape (n_entities, 3). """
+        colors, index = np.unique(self.colors, return_inverse=True)
+        table = np.array([[int(xterm_to_hex(c)[i:i + 2], 16) for i in (1, 3, 5)] for c in colors], dtype=np.uint8)
+        return table.reshape(-1, 3)[index]
+
+    def bounds(self):
+        """ Returns the bounding box [xmin, ymin, xmax, ymax] of each entity, shape (n_entities, 4). """
+        if self.bounds_cache is not None:
+            return self.bounds_cache
+        bounds = np.zeros((len(self), 4))
+        if self.circle_axes is None:
+            half = self.radii[:, np.newaxis]
+        else:
+            half = np.sqrt(self.circle_axes[:, 0] ** 2 + self.circle_axes[:, 1] ** 2)  # half size of the ellipse box
+        bounds[self.circle_entities, :2] = self.centers - half
+        bounds[self.circle_entities, 2:] = self.centers + half
+        if self.polyline_entities.size:
+            starts = self.offsets[:-1]
+            bounds[self.polyline_entities, :2] = np.minimum.reduceat(self.vertices, starts, axis=0)
+            bounds[self.polyline_entities, 2:] = np.maximum.reduceat(self.vertices, starts, axis=0)
+        self.bounds_cache = bounds
+        return bounds
+
+    def extent(self):
+        """ Returns [[xmin, xmax], [ymin, ymax]] of all entities, None for an empty drawing. """
+        if not len(self):
+            return None
+        bounds = self.bounds()
+        return [[float(bounds[:, 0].min()), float(bounds[:, 2].max())],
+                [float(bounds[:, 1].min()), float(bounds[:, 3].max())]]
+
+    def segments(self, max_error=None, circle_segments=64):
+        """ Straight segments of all outlines, circles approximated by inscribed polygons.
+
+            Args:
+                max_error (float): Largest distance of a polygon edge from its circle, sets the number of edges of
+                    each circle. Default circle_segments edges for every circle.
+                circle_segments (int): Number of polygon edges of each circle if max_error is None.
+
+            Returns:
+                np.array: Start and end point of each segment, shape (n_segments, 2, 2).
+                np.array: Entity number of each segment.
+        """
+        lengths = np.diff(self.offsets)
+        ends = self.offsets[1:] - 1
+        starts = np.arange(self.vertices.shape[0])
+        is_last = np.zeros(self.vertices.shape[0], dtype=bool)
+        is_last[ends[lengths > 0]] = True
+        nexts = starts + 1
+        nexts[ends[lengths > 0]] = self.offsets[:-1][lengths > 0]  # closing edge back to the first vertex
+        polyline_of_vertex = np.repeat(np.arange(lengths.size), lengths)
+        keep = ~is_last | self.closed[polyline_of_vertex]
+        keep &= nexts != starts  # single vertices
+        poly_segments = np.stack([self.vertices[starts[keep]], self.vertices[nexts[keep]]], axis=1)
+        poly_entities = self.polyline_entities[polyline_of_vertex[keep]]
+
+        if max_error is None:
+            n_edges = np.full(self.radii.size, circle_segments, dtype=int)
+        else:
+            radii = self.radii if self.circle_axes is None else np.sqrt(np.sum(self.circle_axes ** 2, axis=(1, 2)))
+            ratio = np.clip(1 - max_error / np.maximum(radii, 1e-12), -1, 1)
+            n_edges = np.clip(np.ceil(np.pi / np.maximum(np.arccos(ratio), 1e-6)), 8, 4096).astype(int)
+        circle_of_edge = np.repeat(np.arange(self.radii.size), n_edges)
+        first_edge = np.cumsum(n_edges) - n_edges
+        phase = 2 * np.pi * (np.arange(circle_of_edge.size) - first_edge[circle_of_edge]) / n_edges[circle_of_edge]
+        step = 2 * np.pi / n_edges[circle_of_edge]
+        centers, axes = self.centers[circle_of_edge], self.axes()[circle_of_edge]
+        circle_edges = np.stack([centers + np.einsum('ni,nij->nj', np.stack([np.cos(p), np.sin(p)], axis=1), axes)
+                                 for p in (phase, phase + step)], axis=1)
+        return (np.concatenate([poly_segments.reshape(-1, 2, 2), circle_edges.reshape(-1, 2, 2)]),
+                np.concatenate([poly_entities, self.circle_entities[circle_of_edge]]).astype(int))
+
+    def rtree(self):
+        """ Returns the RTree of the entity bounding boxes, built on first use. """
+        if self.rtree_cache is None:
+            self.rtree_cache = RTree(self.bounds())
+        return self.rtree_cache
+
+    def snap_engine(self):
+        """ Returns the SnapEngine of the drawing, built on first use. """
+        if self.snap_cache is None:
+            self.snap_cache = SnapEngine(self)
+        return self.snap_cache
+
+    def polyline_number(self, entities):
+        """ Returns the polyline number of each entity number, -1 for circles. """
+        numbers = np.full(len(self), -1, dtype=int)
+        numbers[self.polyline_entities] = np.arange(self.polyline_entities.size)
+        return numbers[entities]
+
+    def circle_number(self, entities):
+        numbers = np.full(len(self), -1, dtype=int)
+        numbers[self.circle_entities] = np.arange(self.circle_entities.size)
+        return numbers[entities]
+
+    def distances(self, point, entities):
+        """ Distance of point from the outline of each entity and whether it lies inside a closed outline. """
+        point = np.asarray(point, dtype=float)
+        distances = np.full(len(entities), np.inf)
+        inside = np.zeros(len(entities), dtype=bool)
+        circles, polylines = self.circle_number(entities), self.polyline_number(entities)
+        is_circle = circles >= 0
+        if self.circle_axes is None:
+            centre_distance = np.hypot(*(point - self.centers[circles[is_circle]]).T)
+            distances[is_circle] = np.abs(centre_distance - self.radii[circles[is_circle]])
+            inside[is_circle] = centre_distance < self.radii[circles[is_circle]]
+        else:  # ellipses, measured against inscribed polygons
+            rims = self.circle_points(circles[is_circle], np.linspace(0, 2 * np.pi, 65))
+            for i, rim in zip(np.flatnonzero(is_circle), rims):
+                distances[i], inside[i] = self.outline_distance(point, rim), Path(rim).contains_point(point)
+        for i in np.flatnonzero(~is_circle):
+            polyline = polylines[i]
+            pts = self.vertices[self.offsets[polyline]:self.offsets[polyline + 1]]
+            if self.closed[polyline]:
+                pts = np.concatenate([pts, pts[:1]])
+                inside[i] = pts.shape[0] > 3 and Path(pts).contains_point(point)
+            distances[i] = self.outline_distance(point, pts)
+        return distances, inside
+
+    @staticmethod
+    def outline_distance(point, pts):
+        """ Distance of point from the open outline through pts. """
+        if pts.shape[0] == 1:
+            return np.hypot(*(point - pts[0]))
+        starts, edges = pts[:-1], np.diff(pts, axis=0)
+        lengths = np.maximum(np.sum(edges ** 2, axis=1), 1e-300)
+        t = np.clip(np.sum((point - starts) * edges, axis=1) / lengths, 0, 1)
+        return np.min(np.hypot(*(starts + t[:, np.newaxis] * edges - point).T))
+
+    def layer_mask(self, layer_names):
+        """ Returns True for each entity on one of the layers. """
+        return np.array([name in layer_names for name in self.layer_names], dtype=bool)[self.layers]
+
+    def hit(self, point, tolerance, mask=None):
+        """ Returns the number of the entity at point, None if there is none.
+
+            Outlines within tolerance of point take precedence, the closest one wins. Otherwise the smallest closed
+            outline containing point is hit. Entities False in mask, e.g. on hidden layers, are never hit.
+        """
+        candidates = self.rtree().query_point(point, tolerance)
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        if not candidates.size:
+            return None
+        distances, inside = self.distances(point, candidates)
+        if distances.min() <= tolerance:
+            return int(candidates[np.argmin(distances)])
+        if inside.any():
+            bounds = self.bounds()[candidates[inside]]
+            areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+            return int(candidates[inside][np.argmin(areas)])
+        return None
+
+    def select_box(self, box):
+        """ Returns the numbers of all entities lying completely inside box [xmin, ymin, xmax, ymax]. """
+        candidates = self.rtree().query(box)
+        bounds = self.bounds()[candidates]
+        return candidates[(bounds[:, 0] >= box[0]) & (bounds[:, 1] >= box[1]) &
+                          (bounds[:, 2] <= box[2]) & (bounds[:, 3] <= box[3])]
+
+    def select_lasso(self, polygon, circle_points=16):
+        """ Returns the numbers of all entities lying completely inside a polygon given by its vertices. """
+        polygon = np.asarray(polygon, dtype=float)
+        lasso = Path(np.concatenate([polygon, polygon[:1]]))
+        box = np.concatenate([polygon.min(axis=0), polygon.max(axis=0)])
+        candidates = self.select_box(box)
+        circles, polylines = self.circle_number(candidates), self.polyline_number(candidates)
+        phase = np.linspace(0, 2 * np.pi, circle_points, endpoint=False)
+        selected = np.zeros(candidates.size, dtype=bool)
+        for i in range(candidates.size):
+            if circles[i] >= 0:
+                pts = self.circle_points([circles[i]], phase)[0]
+            else:
+                pts = self.vertices[self.offsets[polylines[i]]:self.offsets[polylines[i] + 1]]
+            selected[i] = lasso.contains_points(pts).all()
+        return candidates[selected]
@@ -0,0 +1,160 @@
+import numpy as np
+
+from utility.profiling import timed
+
+BY_LAYER = 256  # color of entities drawn in the color of their layer
+
+CIRCLE = '0\nCIRCLE\n5\n%X\n8\n%s\n62\n%d\n10\n%.12g\n20\n%.12g\n30\n0.0\n40\n%.12g\n'
+POLYLINE = '0\nPOLYLINE\n5\n%X\n8\n%s\n62\n%d\n66\n1\n10\n0.0\n20\n0.0\n30\n0.0\n70\n%d\n'
+VERTEX = '0\nVERTEX\n5\n%X\n8\n%s\n10\n%.12g\n20\n%.12g\n30\n0.0\n70\n32\n'
+SEQEND = '0\nSEQEND\n5\n%X\n8\n%s\n'
+EXTENT = '%+.10e'  # fixed width, so the extent is patched into the header when the file is complete
+HANDSEED = '%016X'
+
+
+class DXFWriter:
+    """ Writes R12 dxf files entity by entity, without building an ezdxf drawing.
+
+        The header and tables are written when the file is opened, the entities in chunks straight from the arrays
+        of a DXFGeometry. Handles are allocated sequentially in file order, the handle seed and the extent are written
+        into the header on close. Polylines are written as 3D polylines with z = 0, like add_stencil, and ellipses of
+        transformed geometries as closed polylines.
+
+        Example:
+            with DXFWriter('markers.dxf', layers=[('MARKERS', 3)]) as writer:
+                writer.write(geometry)
+
+        Attributes:
+            layer_names (list of string): Names of the layers in the LAYER table.
+            handle (int): Next free handle.
+            extent (np.array): [xmin, ymin, xmax, ymax] of everything written so far.
+    """
+    def __init__(self, file_name, layers=None, buffer_size=2 ** 20):
+        """ Args:
+                file_name (string): Output file, overwritten.
+                layers (list): (name, color) of every layer used, layer '0' is added if missing.
+                buffer_size (int): Bytes buffered before writing to disk.
+        """
+        layers = list(layers or [])
+        if '0' not in [name for name, _ in layers]:
+            layers.insert(0, ('0', 7))
+        self.layer_names = [name for name, _ in layers]
+        self.handle = 0x15 + len(layers)  # handles below are used by the tables
+        self.extent = np.array([np.inf, np.inf, -np.inf, -np.inf])
+        self.file = open(file_name, 'w', buffering=buffer_size)
+        self.file.write('0\nSECTION\n2\nHEADER\n9\n$ACADVER\n1\nAC1009\n9\n$INSBASE\n10\n0.0\n20\n0.0\n30\n0.0\n')
+        self.extent_position = self.file.tell()
+        self.file.write(self.header_extent())
+        self.file.write('9\n$HANDLING\n70\n1\n9\n$HANDSEED\n5\n')
+        self.seed_position = self.file.tell()
+        self.file.write(HANDSEED % 0 + '\n0\nENDSEC\n')
+        self.file.write('0\nSECTION\n2\nTABLES\n'
+                        '0\nTABLE\n2\nLTYPE\n5\n5\n70\n1\n'
+                        '0\nLTYPE\n5\n14\n2\nCONTINUOUS\n70\n0\n3\nSolid line\n72\n65\n73\n0\n40\n0.0\n0\nENDTAB\n'
+                        '0\nTABLE\n2\nLAYER\n5\n2\n70\n{0}\n'.format(len(layers)))
+        for i, (name, color) in enumerate(layers):
+            self.file.write('0\nLAYER\n5\n{0:X}\n2\n{1}\n70\n0\n62\n{2}\n6\nCONTINUOUS\n'.format(0x15 + i, name, color))
+        self.file.write('0\nENDTAB\n0\nENDSEC\n0\nSECTION\n2\nENTITIES\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def header_extent(self):
+        extent = np.where(np.isfinite(self.extent), self.extent, 0.)
+        return ('9\n$EXTMIN\n10\n{0}\n20\n{0}\n30\n0.0\n9\n$EXTMAX\n10\n{0}\n20\n{0}\n30\n0.0\n'.format(EXTENT) %
+                tuple(extent))
+
+    @timed('dxf.write')
+    def write(self, geometry, colors=None, chunk_size=65536, ellipse_points=64):
+        """ Appends all entities of a geometry in drawing order.
+
+            Args:
+                geometry (DXFGeometry): Entities to write, its layer names must be layers of the writer.
+                colors (np.array): Color of each entity, e.g. BY_LAYER. Default the resolved colors of the geometry.
+                chunk_size (int): Entities formatted at once, bounds the memory of the text.
+                ellipse_points (int): Vertices of the polylines replacing ellipses.
+        """
+        n_entities = len(geometry)
+        if not n_entities:
+            return
+        colors = np.broadcast_to(geometry.colors if colors is None else colors, (n_entities,))
+        layer_names = np.array(self.layer_names, dtype=object)[[self.layer_names.index(name)
+                                                                 for name in geometry.layer_names]]
+        if geometry.circle_axes is None:
+            ellipses = None
+        else:
+            ellipses = geometry.circle_points(np.arange(geometry.radii.size),
+                                              np.linspace(0, 2 * np.pi, ellipse_points, endpoint=False))
+        counts = np.ones(n_entities, dtype=int)  # handles of each entity, polylines with vertices and seqend
+        counts[geometry.polyline_entities] = np.diff(geometry.offsets) + 2
+        if ellipses is not None:
+            counts[geometry.circle_entities] = ellipse_points + 2
+        handles = self.handle + np.concatenate([[0], np.cumsum(counts)])
+        bounds = geometry.bounds()
+        self.extent[:2] = np.minimum(self.extent[:2], bounds[:, :2].min(axis=0))
+        self.extent[2:] = np.maximum(self.extent[2:], bounds[:, 2:].max(axis=0))
+
+        for start in range(0, n_entities, chunk_size):
+            stop = min(start + chunk_size, n_entities)
+            texts = [None] * (stop - start)
+            c0, c1 = np.searchsorted(geometry.circle_entities, [start, stop])
+            entities = geometry.circle_entities[c0:c1]
+            args = (handles[entities], layer_names[geometry.layers[entities]], colors[entities])
+            if ellipses is None:
+                circle_texts = [CIRCLE % t for t in zip(*[a.tolist() for a in args + (
+                    geometry.centers[c0:c1, 0], geometry.centers[c0:c1, 1], geometry.radii[c0:c1])])]
+            else:
+                circle_texts = self.polyline_texts(*args, vertices=ellipses[c0:c1].reshape(-1, 2),
+                                                   lengths=np.full(c1 - c0, ellipse_points),
+                                                   closed=np.ones(c1 - c0, dtype=bool))
+            for entity, text in zip((entities - start).tolist(), circle_texts):
+                texts[entity] = text
+            p0, p1 = np.searchsorted(geometry.polyline_entities, [start, stop])
+            entities = geometry.polyline_entities[p0:p1]
+            polyline_texts = self.polyline_texts(
+                handles[entities], layer_names[geometry.layers[entities]], colors[entities],
+                vertices=geometry.vertices[geometry.offsets[p0]:geometry.offsets[p1]],
+                lengths=np.diff(geometry.offsets[p0:p1 + 1]), closed=geometry.closed[p0:p1])
+            for entity, text in zip((entities - start).tolist(), polyline_texts):
+                texts[entity] = text
+            self.file.write(''.join(texts))
+        self.handle = int(handles[-1])
+
+    @staticmethod
+    def polyline_texts(handles, layers, colors, vertices, lengths, closed):
+        """ Returns the text of each polyline with its vertices and seqend, handles numbered on from handles. """
+        starts = np.concatenate([[0], np.cumsum(lengths)])
+        vertex_handles = np.arange(starts[-1]) + np.repeat(handles + 1 - starts[:-1], lengths)
+        vertex_texts = [VERTEX % t for t in zip(vertex_handles.tolist(), np.repeat(layers, lengths).tolist(),
+                                                vertices[:, 0].tolist(), vertices[:, 1].tolist())]
+        flags = np.where(closed, 9, 8)  # 3D polyline, closed
+        return [POLYLINE % (h, layer, color, flag) + ''.join(vertex_texts[s:e]) + SEQEND % (h + 1 + e - s, layer)
+                for h, layer, color, flag, s, e in zip(handles.tolist(), layers.tolist(), colors.tolist(),
+                                                       flags.tolist(), starts[:-1].tolist(), starts[1:].tolist())]
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write('0\nENDSEC\n0\nEOF\n')
+        self.file.seek(self.extent_position)
+        self.file.write(self.header_extent())
+        self.file.seek(self.seed_position)
+        self.file.write(HANDSEED % self.handle)
+        self.file.close()
+
+
+def write_geometry(file_name, geometry, layer_colors=None, colors=None):
+    """ Writes a DXFGeometry as R12 dxf file.
+
+        Args:
+            file_name (string): Output file.
+            geometry (DXFGeometry): Entities to write.
+            layer_colors (dict): Layer name -> color of the LAYER table. Default 7 for every layer.
+            colors (np.array): Color of each entity, default the resolved colors of the geometry.
+    """
+    layer_colors = layer_colors or {}
+    with DXFWriter(file_name, [(name, layer_colors.get(name, 7)) for name in geometry.layer_names]) as writer:
+        writer.write(geometry, colors)
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class FrameStack:
+    """ Read-only access to the frames of a multi-frame, multi-channel scan.
+
+        Data is either a numpy array as returned by scipy.io.loadmat with shape (ny, nx[, nz[, nc]]), or a h5py
+        dataset from a v7.3 mat file, which is stored transposed with shape ([nc, [nz, ]]nx, ny). Frames are views
+        of the array or are read from disk one at a time, so switching frames never reloads the file.
+
+        Attributes:
+            data (np.array or h5py.Dataset): Full scan data.
+            projections (dict of np.array): Cached projections, keys are tuples (kind, channel).
+            chunk_size (int): Number of frames reduced at once when computing projections.
+    """
+    def __init__(self, data, chunk_size=16):
+        self.data = data
+        self.projections = {}
+        self.chunk_size = chunk_size
+        self.on_disk = not isinstance(data, np.ndarray)
+        if self.on_disk:
+            self.shape = tuple(data.shape[::-1]) + (1,) * (4 - len(data.shape))
+        else:
+            self.shape = data.shape + (1,) * (4 - data.ndim)
+
+    def __deepcopy__(self, memo):  # data is never written, copies of a MatFile may share it
+        return self
+
+    def close(self):
+        if self.on_disk:
+            self.data.file.close()
+
+    def n_frames(self):
+        return self.shape[2]
+
+    def n_channels(self):
+        return self.shape[3]
+
+    def frame(self, index, channel=0):
+        return self.frames(index, index + 1, channel)[:, :, 0]
+
+    def frames(self, start, stop, channel=0):
+        """ Returns frames start to stop-1 of a channel as array with shape (ny, nx, stop - start). """
+        if not self.on_disk:
+            return self.data.reshape(self.shape)[:, :, start:stop, channel]
+        ndim = len(self.data.shape)
+        if ndim == 4:
+            block = self.data[channel, start:stop]
+        elif ndim == 3:
+            block = self.data[start:stop]
+        else:
+            block = self.data[()][np.newaxis]
+        return np.transpose(block, (2, 1, 0))
+
+    def projection(self, kind, channel=0):
+        """ Maximum ('max') or mean ('mean') projection along the frame axis, reduced chunk by chunk. """
+        key = (kind, channel)
+        if key not in self.projections:
+            result = None
+            for start in range(0, self.n_frames(), self.chunk_size):
+                chunk = self.frames(start, min(start + self.chunk_size, self.n_frames()), channel)
+                if kind == 'max':
+                    reduced = chunk.max(axis=2)
+                    result = reduced if result is None else np.maximum(result, reduced)
+                elif kind == 'mean':
+                    reduced = chunk.sum(axis=2, dtype=float)
+                    result = reduced if result is None else result + reduced
+                else:
+                    raise ValueError('Unknown projection {0}.'.format(kind))
+            if kind == 'mean':
+                result /= self.n_frames()
+            self.projections[key] = result
+        return self.projections[key]
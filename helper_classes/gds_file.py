@@ -0,0 +1,356 @@
+import re
+import struct
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from helper_classes.dxf_geometry import DXFGeometry
+from utility.profiling import timed
+
+# record types, the second byte of each record header is the data type
+HEADER, BGNLIB, LIBNAME, UNITS, ENDLIB, BGNSTR, STRNAME, ENDSTR = 0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07
+BOUNDARY, PATH, SREF, AREF, TEXT, LAYER, DATATYPE, WIDTH, XY, ENDEL = 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x0E, 0x0F, \
+    0x10, 0x11
+SNAME, COLROW, TEXTTYPE, STRING, STRANS, MAG, ANGLE, BOX, BOXTYPE = 0x12, 0x13, 0x16, 0x19, 0x1A, 0x1B, 0x1C, 0x2D, \
+    0x2E
+NO_DATA, BIT_ARRAY, INT16, INT32, REAL8, ASCII = 0, 1, 2, 3, 5, 6
+
+MAX_POINTS = 8190  # points of one XY record, limited by the 16 bit record length
+LAYER_NAME = re.compile(r'^L(\d+)D(\d+)$')
+
+
+def real8_to_float(data):
+    """ Converts GDSII 8 byte reals, excess-64 base-16 with 56 bit mantissa, to float. """
+    raw = np.frombuffer(data, dtype='>u8')
+    sign = np.where(raw >> np.uint64(63), -1., 1.)
+    exponent = ((raw >> np.uint64(56)) & np.uint64(0x7f)).astype(int) - 64
+    mantissa = (raw & np.uint64(0x00ffffffffffffff)).astype(float) / 2. ** 56
+    return sign * mantissa * 16. ** exponent
+
+
+def float_to_real8(values):
+    """ Converts floats to GDSII 8 byte reals. """
+    result = b''
+    for value in np.atleast_1d(values).tolist():
+        if value == 0:
+            result += b'\0' * 8
+            continue
+        exponent = int(np.floor(np.log(abs(value)) / np.log(16.))) + 1  # mantissa in [1/16, 1)
+        mantissa = int(round(abs(value) / 16. ** exponent * 2 ** 56))
+        if mantissa >= 2 ** 56:
+            mantissa, exponent = mantissa >> 4, exponent + 1
+        result += bytes([(0x80 if value < 0 else 0) | (exponent + 64)]) + mantissa.to_bytes(7, 'big')
+    return result
+
+
+def layer_name(layer, datatype):
+    return 'L{0}D{1}'.format(layer, datatype)
+
+
+def layer_numbers(names):
+    """ GDSII layer and datatype of each layer name, names not written by layer_name get the next free layers. """
+    numbers = [tuple(int(n) for n in LAYER_NAME.match(name).groups()) if LAYER_NAME.match(name) else None
+               for name in names]
+    free = iter(l for l in range(256) if l not in [n[0] for n in numbers if n])
+    return [n if n else (next(free), 0) for n in numbers]
+
+
+def transformation(origin, angle=0., magnification=1., reflection=False):
+    """ Matrix of a GDSII reference for row vectors: reflection about x, magnification, rotation, shift. """
+    c, s = np.cos(np.radians(angle)) * magnification, np.sin(np.radians(angle)) * magnification
+    linear = np.array([[c, s], [-s, c]])
+    if reflection:
+        linear[1] *= -1
+    return np.array([[linear[0, 0], linear[0, 1], 0.], [linear[1, 0], linear[1, 1], 0.], [origin[0], origin[1], 1.]])
+
+
+def element_handles(cell_name, n_elements):
+    """ Handles of the own elements of a cell, '<cell>:<element number>'. """
+    return ['{0}:{1}'.format(cell_name, i) for i in range(n_elements)]
+
+
+class GDSCell:
+    """ Structure of a GDSII library, its own elements as geometry and its references to other cells.
+
+        Attributes:
+            name (string): Structure name.
+            geometry (DXFGeometry): Boundaries and boxes as closed polylines, paths as open polylines along their
+                centre line, in um.
+            references (OrderedDict): Name of the referenced cell -> matrices of all its placements, shape (k, 3, 3).
+                Arrays of references are kept as one matrix per placement, not flattened into geometry.
+    """
+    def __init__(self, name, geometry=None):
+        self.name = name
+        self.geometry = geometry if geometry is not None else DXFGeometry()
+        self.references = OrderedDict()
+
+    def add_references(self, name, matrices):
+        matrices = np.asarray(matrices, dtype=float).reshape(-1, 3, 3)
+        if name in self.references:
+            matrices = np.concatenate([self.references[name], matrices])
+        self.references[name] = matrices
+
+
+class GDSLibrary:
+    """ GDSII stream file with its cell hierarchy.
+
+        Coordinates are converted to um on reading and back to database units on writing. Layer and datatype of each
+        element become the layer name LxDy. Cells are flattened only by geometry(), once per cell, with all
+        placements of a referenced cell transformed at once.
+
+        Attributes:
+            name (string): Library name.
+            db_unit (float): Size of a database unit in m.
+            cells (OrderedDict): Name -> GDSCell.
+    """
+    def __init__(self, name='PYKABOO', db_unit=1e-9):
+        self.name = name
+        self.db_unit = db_unit
+        self.cells = OrderedDict()
+        self.flat_cache = {}
+
+    @staticmethod
+    @timed('gds.layers')
+    def layer_names(file_name):
+        """ Names of the layers of all boundaries, boxes and paths of a GDSII file, read without their points. """
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        names, element, layer, datatype = set(), None, 0, 0
+        position = 0
+        while position + 4 <= len(data):
+            length, record = struct.unpack('>HB', data[position:position + 3])
+            if length < 4:
+                break
+            if record in (BOUNDARY, PATH, BOX, SREF, AREF, TEXT):
+                element, layer, datatype = record, 0, 0
+            elif record == LAYER:
+                layer = struct.unpack('>h', data[position + 4:position + 6])[0]
+            elif record in (DATATYPE, BOXTYPE):
+                datatype = struct.unpack('>h', data[position + 4:position + 6])[0]
+            elif record == ENDEL:
+                if element in (BOUNDARY, PATH, BOX):
+                    names.add((layer, datatype))
+                element = None
+            position += length
+        return [layer_name(*n) for n in sorted(names)]
+
+    @classmethod
+    @timed('gds.read')
+    def read(cls, file_name, layers=None):
+        """ Reads a GDSII stream file, only the elements on layers if given, e.g. ['L1D0']. """
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        library = cls()
+        scale = 1.
+        cell, element, records = None, None, {}
+        elements = []  # (layer, datatype, points, closed) of the current cell
+        references = OrderedDict()  # name -> list of matrices placed in the current cell
+        position = 0
+        while position + 4 <= len(data):
+            length, record = struct.unpack('>HB', data[position:position + 3])
+            if length < 4:
+                break
+            body = data[position + 4:position + length]
+            position += length
+            if record == UNITS:
+                library.db_unit = float(real8_to_float(body[8:16])[0])
+                scale = library.db_unit / 1e-6
+            elif record == LIBNAME:
+                library.name = body.rstrip(b'\0').decode('ascii', 'replace')
+            elif record == BGNSTR:
+                elements, references = [], OrderedDict()
+            elif record == STRNAME:
+                cell = GDSCell(body.rstrip(b'\0').decode('ascii', 'replace'))
+            elif record == ENDSTR and cell is not None:
+                cell.geometry = cls.elements_geometry(elements, cell.name)
+                for name, matrices in references.items():
+                    cell.add_references(name, np.concatenate(matrices))
+                library.cells[cell.name] = cell
+                cell = None
+            elif record in (BOUNDARY, PATH, BOX, SREF, AREF, TEXT):
+                element, records = record, {}
+            elif record == ENDEL:
+                if element in (BOUNDARY, BOX, PATH) and XY in records:
+                    points = np.frombuffer(records[XY], dtype='>i4').reshape(-1, 2) * scale
+                    if element != PATH and points.shape[0] > 1 and (points[0] == points[-1]).all():
+                        points = points[:-1]
+                    layer = int(np.frombuffer(records.get(LAYER, b'\0\0'), '>i2')[0])
+                    datatype = int(np.frombuffer(records.get(DATATYPE, records.get(BOXTYPE, b'\0\0')), '>i2')[0])
+                    if layers is None or layer_name(layer, datatype) in layers:
+                        elements.append((layer, datatype, points, element != PATH))
+                elif element in (SREF, AREF):
+                    name = records[SNAME].rstrip(b'\0').decode('ascii', 'replace')
+                    references.setdefault(name, []).append(cls.reference_matrices(element, records, scale))
+                element = None
+            elif element is not None:
+                records[record] = body
+        return library
+
+    @staticmethod
+    def elements_geometry(elements, cell_name):
+        if not elements:
+            return DXFGeometry()
+        names = sorted(set((layer, datatype) for layer, datatype, _, _ in elements))
+        lengths = [points.shape[0] for _, _, points, _ in elements]
+        layers = np.array([names.index((layer, datatype)) for layer, datatype, _, _ in elements])
+        geometry = DXFGeometry.from_arrays(vertices=np.concatenate([points for _, _, points, _ in elements]),
+                                           offsets=np.concatenate([[0], np.cumsum(lengths)]),
+                                           closed=[closed for _, _, _, closed in elements],
+                                           colors=np.array([1 + names[l][0] % 255 for l in layers]), layers=layers,
+                                           layer_names=[layer_name(*n) for n in names], by_layer=True)
+        geometry.handles = element_handles(cell_name, len(elements))
+        return geometry
+
+    @staticmethod
+    def reference_matrices(element, records, scale):
+        flags = struct.unpack('>H', records[STRANS])[0] if STRANS in records else 0
+        magnification = float(real8_to_float(records[MAG])[0]) if MAG in records else 1.
+        angle = float(real8_to_float(records[ANGLE])[0]) if ANGLE in records else 0.
+        points = np.frombuffer(records[XY], dtype='>i4').reshape(-1, 2) * scale
+        matrix = transformation(points[0], angle, magnification, bool(flags & 0x8000))
+        if element == SREF:
+            return matrix[np.newaxis]
+        columns, rows = struct.unpack('>hh', records[COLROW])
+        column_step, row_step = (points[1] - points[0]) / columns, (points[2] - points[0]) / rows
+        i, j = np.meshgrid(np.arange(columns), np.arange(rows))
+        matrices = np.repeat(matrix[np.newaxis], columns * rows, axis=0)
+        matrices[:, 2, :2] = points[0] + i.reshape(-1, 1) * column_step + j.reshape(-1, 1) * row_step
+        return matrices
+
+    def top_cells(self):
+        """ Names of the cells not referenced by any other cell. """
+        referenced = set(name for cell in self.cells.values() for name in cell.references)
+        return [name for name in self.cells if name not in referenced]
+
+    @timed('gds.flatten')
+    def geometry(self, name=None):
+        """ Returns the flattened geometry of a cell, default of all top cells, computed once per cell.
+
+            Handles are the path of placements down to the element, e.g. 'TOP/ARRAY[12]/VIA[3]:0' for element 0 of
+            placement 3 of cell VIA in placement 12 of cell ARRAY in TOP, so every flattened entity is selected on
+            its own.
+        """
+        if name is None:
+            return DXFGeometry.concatenate([self.geometry(top) for top in self.top_cells()])
+        if name not in self.flat_cache:
+            cell = self.cells[name]
+            parts = [cell.geometry]
+            for child, matrices in cell.references.items():
+                if child not in self.cells:
+                    continue
+                child_geometry = self.geometry(child)
+                part = child_geometry.instances(matrices)
+                tails = [handle[len(child):] for handle in child_geometry.handles]
+                part.handles = ['{0}/{1}[{2}]{3}'.format(name, child, i, tail)
+                                for i in range(len(matrices)) for tail in tails]
+                parts.append(part)
+            self.flat_cache[name] = DXFGeometry.concatenate(parts)
+        return self.flat_cache[name]
+
+    @classmethod
+    def from_geometry(cls, geometry, cell_name='TOP', circle_points=64):
+        """ Library of a single cell holding a geometry, circles and ellipses written as polygons. """
+        library = cls()
+        polygons = geometry.circle_points(np.arange(geometry.radii.size),
+                                          np.linspace(0, 2 * np.pi, circle_points, endpoint=False))
+        circles = DXFGeometry.from_arrays(vertices=polygons.reshape(-1, 2),
+                                          offsets=np.arange(0, polygons.shape[0] * circle_points + 1, circle_points),
+                                          colors=geometry.colors[geometry.circle_entities],
+                                          layers=geometry.layers[geometry.circle_entities],
+                                          layer_names=geometry.layer_names)
+        polylines = DXFGeometry.from_arrays(vertices=geometry.vertices, offsets=geometry.offsets,
+                                            closed=geometry.closed,
+                                            colors=geometry.colors[geometry.polyline_entities],
+                                            layers=geometry.layers[geometry.polyline_entities],
+                                            layer_names=geometry.layer_names)
+        geometry = DXFGeometry.concatenate([circles, polylines])
+        geometry.handles = element_handles(cell_name, len(geometry))
+        library.cells[cell_name] = GDSCell(cell_name, geometry)
+        return library
+
+    @timed('gds.write')
+    def write(self, file_name, extra=None):
+        """ Writes the library with its hierarchy, references stay references.
+
+            Args:
+                file_name (string): Output file.
+                extra (DXFGeometry): Further entities added to the first top cell, e.g. stencils placed on the layout.
+
+            Arrays of references are written as one SREF per placement.
+        """
+        scale = 1e-6 / self.db_unit
+        now = time.localtime()[:6]
+        with open(file_name, 'wb') as f:
+            def put(record, data_type, body=b''):
+                if len(body) % 2:
+                    body += b'\0'
+                f.write(struct.pack('>HBB', len(body) + 4, record, data_type) + body)
+
+            put(HEADER, INT16, struct.pack('>h', 600))
+            put(BGNLIB, INT16, struct.pack('>12h', *(now + now)))
+            put(LIBNAME, ASCII, self.name.encode('ascii'))
+            put(UNITS, REAL8, float_to_real8([self.db_unit / 1e-6, self.db_unit]))
+            tops = self.top_cells()
+            names = [name for cell in self.cells.values() for name in cell.geometry.layer_names]
+            names = list(OrderedDict.fromkeys(names + (extra.layer_names if extra is not None else [])))
+            numbers = dict(zip(names, layer_numbers(names)))  # one map, free layers must not collide across cells
+            for name, cell in self.cells.items():
+                put(BGNSTR, INT16, struct.pack('>12h', *(now + now)))
+                put(STRNAME, ASCII, name.encode('ascii'))
+                geometry = cell.geometry
+                if extra is not None and tops and name == tops[0]:
+                    extra_cell = GDSLibrary.from_geometry(extra).cells['TOP']
+                    geometry = DXFGeometry.concatenate([geometry, extra_cell.geometry])
+                self.write_elements(put, geometry, scale, numbers)
+                for child, matrices in cell.references.items():
+                    for matrix in matrices:
+                        self.write_reference(put, child, matrix, scale)
+                put(ENDSTR, NO_DATA)
+            put(ENDLIB, NO_DATA)
+
+    @staticmethod
+    def write_elements(put, geometry, scale, numbers):
+        """ Writes the polylines of a geometry as boundaries and paths, numbers maps layer names to GDSII layer and
+            datatype. """
+        if geometry.radii.size:
+            geometry = GDSLibrary.from_geometry(geometry).cells['TOP'].geometry
+        numbers = [numbers[name] for name in geometry.layer_names]
+        points = np.round(geometry.vertices * scale).astype('>i4')
+        for polyline in range(geometry.offsets.size - 1):
+            layer, datatype = numbers[geometry.layers[geometry.polyline_entities[polyline]]]
+            pts = points[geometry.offsets[polyline]:geometry.offsets[polyline + 1]]
+            if geometry.closed[polyline] and pts.shape[0] > 2:
+                if pts.shape[0] > MAX_POINTS - 1:
+                    raise ValueError('Polygon of {0} points exceeds the GDSII limit.'.format(pts.shape[0]))
+                GDSLibrary.write_element(put, BOUNDARY, layer, datatype, np.concatenate([pts, pts[:1]]))
+            else:  # long paths are split, consecutive parts share a point
+                for start in range(0, max(pts.shape[0] - 1, 1), MAX_POINTS - 1):
+                    GDSLibrary.write_element(put, PATH, layer, datatype, pts[start:start + MAX_POINTS])
+
+    @staticmethod
+    def write_element(put, element, layer, datatype, pts):
+        put(element, NO_DATA)
+        put(LAYER, INT16, struct.pack('>h', layer))
+        put(DATATYPE, INT16, struct.pack('>h', datatype))
+        if element == PATH:
+            put(WIDTH, INT32, struct.pack('>i', 0))
+        put(XY, INT32, pts.astype('>i4').tobytes())
+        put(ENDEL, NO_DATA)
+
+    @staticmethod
+    def write_reference(put, name, matrix, scale):
+        linear = matrix[:2, :2]
+        magnification = np.sqrt(abs(np.linalg.det(linear)))
+        reflection = np.linalg.det(linear) < 0
+        angle = np.degrees(np.arctan2(linear[0, 1], linear[0, 0]))
+        put(SREF, NO_DATA)
+        put(SNAME, ASCII, name.encode('ascii'))
+        if reflection or magnification != 1 or angle != 0:
+            put(STRANS, BIT_ARRAY, struct.pack('>H', 0x8000 if reflection else 0))
+            if magnification != 1:
+                put(MAG, REAL8, float_to_real8(magnification))
+            if angle != 0:
+                put(ANGLE, REAL8, float_to_real8(angle))
+        put(XY, INT32, np.round(matrix[2, :2] * scale).astype('>i4').tobytes())
+        put(ENDEL, NO_DATA)
@@ -1,9 +1,18 @@
+import logging
+
 from PyQt5 import QtWidgets
 import numpy as np
+try:
+    import h5py
+except ImportError:  # only needed for v7.3 mat files
+    h5py = None
 import scipy.io
-from scipy.interpolate import griddata
 
+from helper_classes.frame_stack import FrameStack
 from utility.config import paths
+from utility.profiling import timed, timer
+from utility.utility_functions import image_statistics, percentile_limits
+from utility.warp import CoordinateMap
 
 
 # noinspection PyArgumentList
@@ -19,7 +28,15 @@ class MatFile:
                 x (np.array): 2d array containing x axis coordinates. Default np.array([np.linspace(0, 10, 100)]).
                 y (np.array): 2d array containing y axis coordinates. Default np.array([np.linspace(0, 10, 100)]).
                 z (np.array): 2d array containing z axis coordinates. Default np.array([[0.]]).
-                result (np.array): 2d array containing intensity values. Default np.zeros((100, 100)).
+                result (np.array): 2d array containing intensity values of the displayed frame or projection.
+                    Default np.zeros((100, 100)).
+            stack (FrameStack): All frames and channels of the loaded scan. None before loading and after transform.
+            frame (int): Index of displayed frame (z plane or time step). Default 0.
+            channel (int): Index of displayed channel. Default 0.
+            projection (string): None to display a single frame, 'max' or 'mean' to display a projection of all
+                frames. Default None.
+            statistics_cache (dict): Histogram and percentile statistics of each displayed frame, see statistics().
+                Reset whenever the data changes on load or transform.
     """
     def __init__(self):
         self.file_name = ''
@@ -28,34 +45,155 @@ class MatFile:
                       'y': np.array([np.linspace(0, 10, 100)]),
                       'z': np.array([[0.]]),
                       'result': np.zeros((100, 100))}
+        self.stack = None
+        self.frame = 0
+        self.channel = 0
+        self.projection = None
+        self.statistics_cache = {}
 
     def load(self, parent, **kwargs):
         dialog = kwargs.get('dialog', False)
-        self.file_name = kwargs.get('file_name', self.file_name)
-        if dialog or not self.file_name:
-            fname = QtWidgets.QFileDialog.getOpenFileName(parent, 'Open file', paths['registration'],
-                                                          "Matlab data file (*.mat)")[0]
-            if not fname:  # capture cancel in dialog
+        file_name = kwargs.get('file_name', self.file_name)
+        if dialog or not file_name:
+            file_name = QtWidgets.QFileDialog.getOpenFileName(parent, 'Open file', paths['registration'],
+                                                              "Matlab data file (*.mat)")[0]
+            if not file_name:  # capture cancel in dialog
+                return
+        try:
+            graph = scipy.io.loadmat(file_name)
+        except NotImplementedError:  # v7.3 mat files are HDF5 files, their frames are read lazily with h5py
+            if h5py is None:
+                logging.getLogger('pykaboo').warning('Cannot read v7.3 mat file {0}, h5py is not installed.'.
+                                                     format(file_name))
                 return
-            self.file_name = fname
-        self.graph = scipy.io.loadmat(self.file_name)
-        parent.pick_stack.empty()
-
-    def transform(self, trafo_matrix):
-        x_ax = self.graph['x'][0]
-        y_ax = self.graph['y'][0][::-1]
-        x_ax, y_ax = np.meshgrid(x_ax, y_ax)
-        x_ax, y_ax, _ = np.dot(np.array([x_ax, y_ax, 1]), trafo_matrix)
-        x_ax, y_ax = x_ax.ravel(), y_ax.ravel()
-
-        self.graph['N'] = np.array([[300, 300, 1]])
-        # Generate a regular grid to interpolate the data.
-        xi = np.linspace(min(x_ax), max(x_ax), self.graph['N'][0, 0])
-        yi = np.linspace(min(y_ax), max(y_ax), self.graph['N'][0, 1])
-        xi, yi = np.meshgrid(xi, yi)
-
-        # Interpolate using linear triangularization
-        self.graph['result'] = griddata((x_ax, y_ax), self.graph['result'].ravel(), (xi, yi),
-                                        method='linear', fill_value=0)[::-1]
-        self.graph['x'] = np.array([xi[0]])
-        self.graph['y'] = np.array([yi.T[0]])
+            graph = self.load_hdf5(file_name)
+        if self.stack is not None:
+            self.stack.close()
+        self.file_name, self.graph = file_name, graph
+        self.stack = FrameStack(self.graph['result'])
+        self.frame, self.channel, self.projection = 0, 0, None
+        self.statistics_cache = {}
+        self.set_frame()
+        if parent is not None:  # batch processing loads files without a widget
+            parent.pick_stack.empty()
+
+    @staticmethod
+    def load_hdf5(file_name):
+        if h5py is None:
+            raise ImportError('Reading v7.3 mat files requires h5py.')
+        graph = {}
+        for key, item in h5py.File(file_name, 'r').items():
+            if key == 'result':  # kept on disk, frames are read when displayed
+                graph[key] = item
+            elif isinstance(item, h5py.Dataset):
+                graph[key] = np.array(item).T  # MATLAB stores arrays column-major
+        return graph
+
+    def n_frames(self):
+        return self.stack.n_frames() if self.stack is not None else 1
+
+    def n_channels(self):
+        return self.stack.n_channels() if self.stack is not None else 1
+
+    def set_frame(self, **kwargs):
+        """ Displays another frame, channel or projection of the stack without reloading the file.
+
+            Keyword Args:
+                frame (int): Frame index.
+                channel (int): Channel index.
+                projection (string): None, 'max' or 'mean'.
+        """
+        if self.stack is None:
+            return
+        self.frame = kwargs.get('frame', self.frame)
+        self.channel = kwargs.get('channel', self.channel)
+        self.projection = kwargs.get('projection', self.projection)
+        if self.projection:
+            self.graph['result'] = self.stack.projection(self.projection, self.channel)
+        else:
+            self.graph['result'] = self.stack.frame(self.frame, self.channel)
+
+    def statistics(self):
+        """ Returns image_statistics of result, computed once per frame and projection. """
+        key = (self.channel, self.projection or self.frame)
+        if key not in self.statistics_cache:
+            self.statistics_cache[key] = image_statistics(self.graph['result'])
+        return self.statistics_cache[key]
+
+    def count_limits(self, percentiles=None):
+        """ Returns [min, max] counts of result, or the counts at the given [lower, upper] percentiles. """
+        if percentiles:
+            return percentile_limits(self.statistics(), *percentiles)
+        return [float(self.statistics()['min']), float(self.statistics()['max'])]
+
+    @timed('mat.transform')
+    def transform(self, trafo, coordinate_map=None):
+        """ Resamples result onto a regular grid in target coordinates.
+
+            Args:
+                trafo: 3x3 matrix or warp from utility.warp, mapping scan coordinates to target coordinates.
+                coordinate_map (CoordinateMap): Map built before for the same trafo and scan axes, skips evaluating
+                    the trafo again, which may then be None.
+
+            Returns:
+                CoordinateMap: The map used, reusable for further scans of the same field.
+        """
+        if coordinate_map is None:
+            coordinate_map = CoordinateMap(trafo, self.graph['x'][0], self.graph['y'][0])
+        self.graph['result'] = coordinate_map.apply(self.graph['result'])
+        self.graph['x'] = np.array([coordinate_map.x])
+        self.graph['y'] = np.array([coordinate_map.y])
+        self.graph['N'] = np.array([[coordinate_map.x.size, coordinate_map.y.size, 1]])
+        self.stack = None
+        self.statistics_cache = {}
+        return coordinate_map
+
+    def transformed_view(self, trafo, coordinate_map=None):
+        """ Returns a TransformedView of the displayed frame, leaving this file unchanged. Arguments as transform. """
+        if coordinate_map is None:
+            coordinate_map = CoordinateMap(trafo, self.graph['x'][0], self.graph['y'][0])
+        return TransformedView(self, coordinate_map)
+
+
+class ResampledGraph(dict):
+    """ Graph dict whose result is resampled from the source image on first access. """
+    def __init__(self, source_result, coordinate_map, **items):
+        super(ResampledGraph, self).__init__(**items)
+        self.source_result = source_result
+        self.coordinate_map = coordinate_map
+
+    def __missing__(self, key):
+        if key != 'result' or self.source_result is None:
+            raise KeyError(key)
+        with timer('mat.resample'):
+            self['result'] = self.coordinate_map.apply(self.source_result)
+        self.source_result = None  # only the resampled image is kept
+        return self['result']
+
+
+class TransformedView(MatFile):
+    """ Displayed frame of a MatFile resampled into target coordinates, without copying the MatFile.
+
+        The view keeps a read-only reference to the source image only, not to the other arrays of the mat file, and
+        resamples it when result is first accessed, usually on the first draw. Loading another file or frame into
+        the source MatFile replaces its arrays and leaves the view unchanged, writing into the source image raises.
+    """
+    def __init__(self, mat_file, coordinate_map):
+        super(TransformedView, self).__init__()
+        self.file_name = mat_file.file_name
+        self.frame, self.channel, self.projection = mat_file.frame, mat_file.channel, mat_file.projection
+        source_result = mat_file.graph['result']
+        source_result.flags.writeable = False  # in place changes of the source would change the view unnoticed
+        self.graph = ResampledGraph(source_result, coordinate_map,
+                                    N=np.array([[coordinate_map.x.size, coordinate_map.y.size, 1]]),
+                                    x=np.array([coordinate_map.x]), y=np.array([coordinate_map.y]),
+                                    z=mat_file.graph.get('z', np.array([[0.]])))
+
+    def load(self, parent, **kwargs):
+        raise TypeError('A transformed view cannot load files, load the source MatFile instead.')
+
+    def release(self):
+        """ Drops the source reference and the resampled image, the view is empty afterwards. """
+        self.graph.source_result = None
+        self.graph.clear()
+        self.statistics_cache = {}
@@ -0,0 +1,298 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.io
+
+from helper_classes.mat_file import MatFile
+from utility.profiling import timed
+from utility.utility_functions import image_statistics
+from utility.warp import CoordinateMap, as_warp
+
+
+def scan_outline(warp, x_axis, y_axis, n_points=64):
+    """ Returns the border of a scan in target coordinates, shape (4 * n_points, 2). """
+    edge = np.linspace(0, 1, n_points)
+    x, y = x_axis[0] + edge * (x_axis[-1] - x_axis[0]), y_axis[0] + edge * (y_axis[-1] - y_axis[0])
+    outline = np.concatenate([np.stack([x, np.full(n_points, y_axis[0])], axis=1),
+                              np.stack([x, np.full(n_points, y_axis[-1])], axis=1),
+                              np.stack([np.full(n_points, x_axis[0]), y], axis=1),
+                              np.stack([np.full(n_points, x_axis[-1]), y], axis=1)])
+    return warp.forward(outline)
+
+
+def target_pitch(warp, x_axis, y_axis):
+    """ Pixel pitch of a scan in target coordinates, from the area of a pixel at the centre of the scan. """
+    pitch_x, pitch_y = x_axis[1] - x_axis[0], y_axis[1] - y_axis[0]
+    centre = np.array([[(x_axis[0] + x_axis[-1]) / 2., (y_axis[0] + y_axis[-1]) / 2.]])
+    corners = warp.forward(np.concatenate([centre, centre + [pitch_x, 0], centre + [0, pitch_y]]))
+    a, b = corners[1] - corners[0], corners[2] - corners[0]
+    return np.sqrt(abs(a[0] * b[1] - a[1] * b[0]))
+
+
+def sample_bilinear(image, rows, cols):
+    """ Bilinear interpolation of image at fractional rows and cols, which must lie within the image. """
+    n_rows, n_cols = image.shape
+    row0 = np.minimum(np.floor(rows), n_rows - 2).astype(np.intp)
+    col0 = np.minimum(np.floor(cols), n_cols - 2).astype(np.intp)
+    row_frac, col_frac = (rows - row0).astype(np.float32), (cols - col0).astype(np.float32)
+    flat = image.ravel()
+    index = row0 * n_cols + col0
+    top = np.take(flat, index)
+    top += (np.take(flat, index + 1) - top) * col_frac
+    bottom = np.take(flat, index + n_cols)
+    bottom += (np.take(flat, index + n_cols + 1) - bottom) * col_frac
+    top += (bottom - top) * row_frac
+    return top
+
+
+def block_mean(image):
+    """ Mean of 2 x 2 blocks ignoring nan, odd sizes padded with nan, nan where a block has no values. """
+    rows, cols = image.shape
+    padded = np.full((rows + rows % 2, cols + cols % 2), np.nan, dtype=np.float32)
+    padded[:rows, :cols] = image
+    valid = np.isfinite(padded)
+    padded[~valid] = 0
+    shape = (padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    sums = padded.reshape(shape).sum(axis=(1, 3))
+    counts = valid.reshape(shape).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+
+
+class Mosaic:
+    """ Scans composited into one image in layout coordinates, stored as memory-mapped pyramid on disk.
+
+        Every level is a float32 .npy file in the mosaic directory, opened as memory map, so mosaics larger than
+        the memory are built and viewed tile by tile. Level 0 has the pixel pitch of the mosaic, each further level
+        half the resolution of the one before, down to a single tile. Rows run from y max to y min as in
+        MatFile.graph, pixels not covered by any scan are nan.
+
+        Overlapping scans are blended with weights rising linearly from the border of each scan over feather
+        pixels, so seams between scans of slightly different brightness fade out.
+
+        Attributes:
+            directory (string): Directory of the level files and mosaic.json.
+            x_min (float): x of the centre of the first column of level 0.
+            y_max (float): y of the centre of the first row of level 0.
+            pixel_pitch (float): Pixel pitch of level 0 in layout units.
+            tile_size (int): Pixels along x and y of the tiles processed at once.
+            shapes (list of tuple): Shape of each level.
+            levels (list of np.memmap): The levels, read only.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'mosaic.json'), 'r') as f:
+            meta = json.load(f)
+        self.x_min, self.y_max = meta['x_min'], meta['y_max']
+        self.pixel_pitch, self.tile_size = meta['pixel_pitch'], meta['tile_size']
+        self.scans = meta['scans']
+        self.shapes = [tuple(shape) for shape in meta['shapes']]
+        self.levels = [np.load(self.level_file(directory, level), mmap_mode='r') for level in range(len(self.shapes))]
+
+    @staticmethod
+    def level_file(directory, level):
+        return os.path.join(directory, 'level_{0}.npy'.format(level))
+
+    @staticmethod
+    def tiles(shape, tile_size):
+        """ Yields (rows, cols) slices covering an image of shape in tiles of tile_size. """
+        for row in range(0, shape[0], tile_size):
+            for col in range(0, shape[1], tile_size):
+                yield slice(row, min(row + tile_size, shape[0])), slice(col, min(col + tile_size, shape[1]))
+
+    @classmethod
+    @timed('mosaic.build')
+    def build(cls, directory, scans, pixel_pitch=None, tile_size=1024, feather=32, n_workers=None):
+        """ Composites scans into a new mosaic in directory and returns it opened.
+
+            Scans are loaded one at a time. The tiles covered by a scan are resampled and added to the level 0 sums
+            in parallel, then the sums are divided by the weights and the pyramid is reduced, again tile by tile.
+
+            Args:
+                directory (string): Output directory, created if missing. Existing level files are overwritten.
+                scans (list): (MatFile or mat file name, trafo) pairs, trafo a 3x3 matrix or warp mapping scan
+                    coordinates to layout coordinates.
+                pixel_pitch (float): Pixel pitch of level 0. Default the finest pitch of the scans in layout units.
+                tile_size (int): Pixels along x and y of a tile.
+                feather (float): Width of the blending ramp at the scan borders in scan pixels.
+                n_workers (int): Threads processing tiles. Default the number of processors.
+
+            Returns:
+                Mosaic
+        """
+        if not scans:
+            raise ValueError('A mosaic needs at least one scan.')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        scans = [(scan, as_warp(trafo)) for scan, trafo in scans]
+        outlines, pitches = [], []
+        for scan, warp in scans:
+            x_axis, y_axis = cls.scan_axes(scan)
+            outlines.append(scan_outline(warp, x_axis, y_axis))
+            pitches.append(target_pitch(warp, x_axis, y_axis))
+        pixel_pitch = pixel_pitch or min(pitches)
+        points = np.concatenate(outlines)
+        x_min, y_min = points.min(axis=0)
+        x_max, y_max = points.max(axis=0)
+        shape = (int(np.ceil((y_max - y_min) / pixel_pitch)) + 1, int(np.ceil((x_max - x_min) / pixel_pitch)) + 1)
+
+        sums = np.lib.format.open_memmap(cls.level_file(directory, 0), mode='w+', dtype=np.float32, shape=shape)
+        weights_file = os.path.join(directory, 'weights.npy')
+        weights = np.lib.format.open_memmap(weights_file, mode='w+', dtype=np.float32, shape=shape)
+        with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+            for (scan, warp), outline in zip(scans, outlines):
+                mat_file = cls.load_scan(scan)
+                image = np.asarray(mat_file.graph['result'], dtype=np.float32)
+                x_axis, y_axis = mat_file.graph['x'][0], mat_file.graph['y'][0]
+                low, high = outline.min(axis=0), outline.max(axis=0)
+                rows = (int(np.clip(np.floor((y_max - high[1]) / pixel_pitch), 0, shape[0])),
+                        int(np.clip(np.ceil((y_max - low[1]) / pixel_pitch) + 1, 0, shape[0])))
+                cols = (int(np.clip(np.floor((low[0] - x_min) / pixel_pitch), 0, shape[1])),
+                        int(np.clip(np.ceil((high[0] - x_min) / pixel_pitch) + 1, 0, shape[1])))
+                tiles = [(slice(r.start + rows[0], r.stop + rows[0]), slice(c.start + cols[0], c.stop + cols[0]))
+                         for r, c in cls.tiles((rows[1] - rows[0], cols[1] - cols[0]), tile_size)]
+                list(pool.map(lambda tile: cls.add_tile(sums, weights, tile, image, warp, x_axis, y_axis,
+                                                        x_min, y_max, pixel_pitch, feather), tiles))
+
+            def normalize(tile):
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    sums[tile] = np.where(weights[tile] > 0, sums[tile] / weights[tile], np.nan)
+
+            list(pool.map(normalize, cls.tiles(shape, tile_size)))
+            sums.flush()
+            del weights
+            os.remove(weights_file)
+
+            shapes, level = [shape], sums
+            while max(shapes[-1]) > tile_size:
+                shapes.append(((shapes[-1][0] + 1) // 2, (shapes[-1][1] + 1) // 2))
+                reduced = np.lib.format.open_memmap(cls.level_file(directory, len(shapes) - 1), mode='w+',
+                                                    dtype=np.float32, shape=shapes[-1])
+
+                def reduce(tile, source=level, target=reduced):
+                    rows, cols = tile
+                    target[tile] = block_mean(source[2 * rows.start:2 * rows.stop, 2 * cols.start:2 * cols.stop])
+
+                list(pool.map(reduce, cls.tiles(shapes[-1], tile_size)))
+                reduced.flush()
+                level = reduced
+        meta = {'x_min': float(x_min), 'y_max': float(y_max),
+                'pixel_pitch': float(pixel_pitch), 'tile_size': tile_size, 'shapes': [list(s) for s in shapes],
+                'scans': [scan if isinstance(scan, str) else scan.file_name for scan, _ in scans]}
+        with open(os.path.join(directory, 'mosaic.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return cls(directory)
+
+    @classmethod
+    def scan_axes(cls, scan):
+        """ Returns the x and y axes of a scan, reading only the axes of mat files up to v7. """
+        if isinstance(scan, str):
+            try:
+                graph = scipy.io.loadmat(scan, variable_names=['x', 'y'])
+                return graph['x'][0], graph['y'][0]
+            except NotImplementedError:  # v7.3 mat files are read by MatFile
+                pass
+        graph = cls.load_scan(scan).graph
+        return graph['x'][0], graph['y'][0]
+
+    @staticmethod
+    def load_scan(scan):
+        if isinstance(scan, MatFile):
+            return scan
+        mat_file = MatFile()
+        mat_file.load(None, file_name=scan)
+        return mat_file
+
+    @staticmethod
+    def add_tile(sums, weights, tile, image, warp, x_axis, y_axis, x_min, y_max, pixel_pitch, feather):
+        """ Resamples a scan onto one tile of level 0 and adds its weighted counts and weights. """
+        rows, cols = tile
+        node_step = max(rows.stop - rows.start, cols.stop - cols.start) if hasattr(warp, 'matrix') else 64
+        node_rows = np.unique(np.append(np.arange(0, rows.stop - rows.start, node_step), rows.stop - rows.start - 1))
+        node_cols = np.unique(np.append(np.arange(0, cols.stop - cols.start, node_step), cols.stop - cols.start - 1))
+        node_x, node_y = np.meshgrid(x_min + (cols.start + node_cols) * pixel_pitch,
+                                     y_max - (rows.start + node_rows) * pixel_pitch)
+        src = warp.inverse(np.stack([node_x.ravel(), node_y.ravel()], axis=1))
+        pitch_x, pitch_y = x_axis[1] - x_axis[0], y_axis[1] - y_axis[0]
+        tile_shape = (rows.stop - rows.start, cols.stop - cols.start)
+        src_cols = CoordinateMap.interpolate_nodes(((src[:, 0] - x_axis[0]) / pitch_x).reshape(node_y.shape),
+                                                   node_rows, node_cols, tile_shape)
+        src_rows = CoordinateMap.interpolate_nodes(
+            ((len(y_axis) - 1) - (src[:, 1] - y_axis[0]) / pitch_y).reshape(node_y.shape), node_rows, node_cols,
+            tile_shape)
+        border = np.minimum(np.minimum(src_rows, len(y_axis) - 1 - src_rows),
+                            np.minimum(src_cols, len(x_axis) - 1 - src_cols))
+        inside = border >= -0.5
+        if not inside.any():
+            return
+        weight = np.clip((border[inside] + 0.5) / max(feather, 1e-12), 0, 1).astype(np.float32)
+        counts = sample_bilinear(image, np.clip(src_rows[inside], 0, len(y_axis) - 1),
+                                 np.clip(src_cols[inside], 0, len(x_axis) - 1))
+        tile_sums, tile_weights = sums[tile], weights[tile]  # views into the memory maps
+        tile_sums[inside] += counts * weight
+        tile_weights[inside] += weight
+
+    def level_for(self, pitch):
+        """ Returns the coarsest level whose pixel pitch is at most pitch, level 0 for finer pitches. """
+        level = int(np.floor(np.log2(max(pitch / self.pixel_pitch, 1.))))
+        return min(level, len(self.levels) - 1)
+
+    def read(self, x_limits, y_limits, max_pixels=1000):
+        """ Reads the region within the limits at the coarsest level with at least max_pixels along its larger side.
+
+            Returns:
+                np.array: Counts, rows from y max to y min.
+                np.array: x axis.
+                np.array: y axis, ascending.
+        """
+        span = max(abs(x_limits[1] - x_limits[0]), abs(y_limits[1] - y_limits[0]))
+        level = self.level_for(span / float(max(max_pixels, 1)))
+        pitch = self.pixel_pitch * 2 ** level
+        shape = self.shapes[level]
+        x_first = self.x_min + (2 ** level - 1) * self.pixel_pitch / 2.  # centre of the first block of the level
+        y_first = self.y_max - (2 ** level - 1) * self.pixel_pitch / 2.
+        x_low, x_high = sorted(x_limits)
+        y_low, y_high = sorted(y_limits)
+        col0 = int(np.clip(np.floor((x_low - x_first) / pitch), 0, shape[1] - 2))
+        col1 = int(np.clip(np.ceil((x_high - x_first) / pitch) + 1, col0 + 2, shape[1]))
+        row0 = int(np.clip(np.floor((y_first - y_high) / pitch), 0, shape[0] - 2))
+        row1 = int(np.clip(np.ceil((y_first - y_low) / pitch) + 1, row0 + 2, shape[0]))
+        x_axis = x_first + np.arange(col0, col1) * pitch
+        y_axis = (y_first - np.arange(row0, row1) * pitch)[::-1]
+        return np.array(self.levels[level][row0:row1, col0:col1]), x_axis, y_axis
+
+    def extent(self):
+        """ Returns [[xmin, xmax], [ymin, ymax]] of level 0. """
+        return [[self.x_min, self.x_min + (self.shapes[0][1] - 1) * self.pixel_pitch],
+                [self.y_max - (self.shapes[0][0] - 1) * self.pixel_pitch, self.y_max]]
+
+
+class MosaicView(MatFile):
+    """ The part of a Mosaic visible on a canvas, read again at the resolution of the canvas on every view change.
+
+        Count statistics are taken from the coarsest level, so the contrast stays the same while browsing.
+    """
+    def __init__(self, mosaic):
+        super(MosaicView, self).__init__()
+        self.mosaic = mosaic
+        self.file_name = mosaic.directory
+        self.set_view(*mosaic.extent(), max_pixels=mosaic.tile_size)
+
+    def set_view(self, x_limits, y_limits, max_pixels=1000):
+        result, x_axis, y_axis = self.mosaic.read(x_limits, y_limits, max_pixels)
+        self.graph = {'N': np.array([[x_axis.size, y_axis.size, 1]]), 'x': np.array([x_axis]),
+                      'y': np.array([y_axis]), 'z': np.array([[0.]]), 'result': result}
+
+    def statistics(self):
+        if 'mosaic' not in self.statistics_cache:
+            self.statistics_cache['mosaic'] = image_statistics(self.mosaic.levels[-1])
+        return self.statistics_cache['mosaic']
+
+    def load(self, parent, **kwargs):
+        raise TypeError('A mosaic view cannot load files, build or open a Mosaic instead.')
+
+    def release(self):
+        self.graph = {}
+        self.statistics_cache = {}
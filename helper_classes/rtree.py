@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class RTree:
+    """ Static R-tree of bounding boxes, bulk loaded with the sort-tile-recursive algorithm.
+
+        Every node holds node_size children, and the children of node i of a level are nodes
+        i * node_size to (i + 1) * node_size - 1 of the level below, so the tree is a list of bounding box arrays
+        without pointers. Queries descend one level at a time with vectorized box tests.
+
+        Attributes:
+            node_size (int): Number of children of each node.
+            order (np.array): Item numbers in leaf order.
+            levels (list of np.array): Bounding boxes [xmin, ymin, xmax, ymax] of the nodes of each level, leaves
+                first and the root last.
+    """
+    def __init__(self, bounds, node_size=16):
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.node_size = node_size
+        self.order = self.sort_tile(bounds)
+        self.levels = [bounds[self.order]]
+        while self.levels[-1].shape[0] > 1:
+            children = self.levels[-1]
+            starts = np.arange(0, children.shape[0], node_size)
+            self.levels.append(np.concatenate([np.minimum.reduceat(children[:, :2], starts, axis=0),
+                                               np.maximum.reduceat(children[:, 2:], starts, axis=0)], axis=1))
+
+    def sort_tile(self, bounds):
+        """ Orders boxes into vertical slices by x and within each slice by y. """
+        n = bounds.shape[0]
+        if n == 0:
+            return np.zeros(0, dtype=int)
+        centres = (bounds[:, :2] + bounds[:, 2:]) / 2
+        n_slices = int(np.ceil(np.sqrt(np.ceil(n / float(self.node_size)))))
+        slice_size = n_slices * self.node_size
+        by_x = np.argsort(centres[:, 0], kind='mergesort')
+        slices = np.arange(n) // slice_size
+        return by_x[np.lexsort((centres[by_x, 1], slices))]
+
+    def __len__(self):
+        return self.order.size
+
+    def query(self, box):
+        """ Returns the item numbers whose bounding boxes intersect box [xmin, ymin, xmax, ymax]. """
+        if not len(self):
+            return np.zeros(0, dtype=int)
+        nodes = np.zeros(1, dtype=int)
+        for level in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[level][nodes]
+            nodes = nodes[(boxes[:, 0] <= box[2]) & (boxes[:, 2] >= box[0]) &
+                          (boxes[:, 1] <= box[3]) & (boxes[:, 3] >= box[1])]
+            if level and nodes.size:  # expand to the children on the level below
+                n_children = self.levels[level - 1].shape[0]
+                first = nodes * self.node_size
+                counts = np.minimum(first + self.node_size, n_children) - first
+                nodes = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self.order[nodes]
+
+    def query_point(self, point, tolerance=0.):
+        return self.query([point[0] - tolerance, point[1] - tolerance, point[0] + tolerance, point[1] + tolerance])
+
+    def query_pairs(self, boxes, chunk_size=65536):
+        """ Returns all pairs of a box of boxes and an item whose bounding boxes intersect.
+
+            All boxes descend the tree together, one level at a time, so thousands of queries cost a few array
+            operations per level instead of one Python call each.
+
+            Args:
+                boxes (np.array): Query boxes [xmin, ymin, xmax, ymax], shape (n_boxes, 4).
+                chunk_size (int): Boxes descending at once, bounds the memory of the candidate pairs.
+
+            Returns:
+                np.array: Box number of each pair.
+                np.array: Item number of each pair.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        box_numbers, items = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        if not len(self):
+            return box_numbers[0], items[0]
+        for start in range(0, boxes.shape[0], chunk_size):
+            queries = np.arange(start, min(start + chunk_size, boxes.shape[0]))
+            nodes = np.zeros(queries.size, dtype=int)
+            for level in range(len(self.levels) - 1, -1, -1):
+                node_boxes, query_boxes = self.levels[level][nodes], boxes[queries]
+                keep = ((node_boxes[:, 0] <= query_boxes[:, 2]) & (node_boxes[:, 2] >= query_boxes[:, 0]) &
+                        (node_boxes[:, 1] <= query_boxes[:, 3]) & (node_boxes[:, 3] >= query_boxes[:, 1]))
+                queries, nodes = queries[keep], nodes[keep]
+                if level and nodes.size:
+                    n_children = self.levels[level - 1].shape[0]
+                    first = nodes * self.node_size
+                    counts = np.minimum(first + self.node_size, n_children) - first
+                    nodes = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                    queries = np.repeat(queries, counts)
+            box_numbers.append(queries)
+            items.append(self.order[nodes])
+        return np.concatenate(box_numbers), np.concatenate(items)
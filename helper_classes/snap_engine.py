@@ -0,0 +1,117 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utility.profiling import timed
+
+SNAP_KINDS = ['vertex', 'midpoint', 'centre', 'intersection']
+
+
+class SnapEngine:
+    """ Snap points of a DXFGeometry in one KD tree, queried on every mouse move.
+
+        Vertices, segment midpoints and circle centres are collected when the engine is built. Intersections of
+        polyline segments are found with a uniform cell grid as broad phase, segments sharing a cell are
+        intersected exactly, both vectorized over all pairs.
+
+        Attributes:
+            points (np.array): All snap points, shape (n, 2).
+            kinds (np.array): Index into SNAP_KINDS of each snap point.
+            tree (cKDTree): KD tree of points.
+            node_tree (cKDTree): KD tree of vertices and circle centres only, for picking nodes.
+            node_points (np.array): Points of node_tree.
+    """
+    @timed('snap.build')
+    def __init__(self, geometry):
+        segments, entities = geometry.segments(circle_segments=4)
+        is_polyline = geometry.polyline_number(entities) >= 0
+        segments = segments[is_polyline]
+        vertices = np.unique(geometry.vertices, axis=0) if geometry.vertices.size else np.zeros((0, 2))
+        midpoints = segments.mean(axis=1) if segments.size else np.zeros((0, 2))
+        intersections = self.intersections(segments)
+        groups = [vertices, midpoints, geometry.centers, intersections]
+        self.points = np.concatenate(groups).reshape(-1, 2)
+        self.kinds = np.repeat(np.arange(len(groups)), [g.shape[0] for g in groups])
+        self.tree = cKDTree(self.points) if self.points.size else None
+        self.node_points = np.concatenate([vertices, geometry.centers]).reshape(-1, 2)
+        self.node_tree = cKDTree(self.node_points) if self.node_points.size else None
+
+    @staticmethod
+    def intersections(segments, max_cells_per_segment=64):
+        """ Returns the points where two segments cross, end points touching other segments excluded. """
+        if segments.shape[0] < 2:
+            return np.zeros((0, 2))
+        low, high = segments.min(axis=1), segments.max(axis=1)
+        cell = max(np.median(np.max(high - low, axis=1)) * 2, 1e-9)
+        first, last = np.floor(low / cell).astype(np.int64), np.floor(high / cell).astype(np.int64)
+        spans = last - first + 1
+        n_cells = spans[:, 0] * spans[:, 1]
+        coarse = n_cells > max_cells_per_segment  # very long segments are binned into a single cell of their own
+        n_cells[coarse] = 0
+        segment = np.repeat(np.arange(segments.shape[0]), n_cells)
+        position = np.arange(segment.size) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+        cell_x = first[segment, 0] + position % spans[segment, 0]
+        cell_y = first[segment, 1] + position // spans[segment, 0]
+        pairs = [np.zeros((0, 2), dtype=int)]
+        if segment.size:
+            cell_x, cell_y = cell_x - cell_x.min(), cell_y - cell_y.min()
+            cell_id = cell_x * (cell_y.max() + 1) + cell_y
+            order = np.lexsort((segment, cell_id))
+            segment, cell_id = segment[order], cell_id[order]
+            group_start = np.flatnonzero(np.concatenate([[True], cell_id[1:] != cell_id[:-1]]))
+            group_size = np.diff(np.append(group_start, cell_id.size))
+            partners = np.repeat(group_start + group_size, group_size) - 1 - np.arange(cell_id.size)
+            a = np.repeat(np.arange(cell_id.size), partners)  # each member with the members after it in its cell
+            b = a + 1 + np.arange(a.size) - np.repeat(np.cumsum(partners) - partners, partners)
+            pairs.append(np.stack([segment[a], segment[b]], axis=1))
+        for long_segment in np.flatnonzero(coarse):  # long segments against all segments overlapping their box
+            others = np.flatnonzero((low[:, 0] <= high[long_segment, 0]) & (high[:, 0] >= low[long_segment, 0]) &
+                                    (low[:, 1] <= high[long_segment, 1]) & (high[:, 1] >= low[long_segment, 1]))
+            pairs.append(np.stack([np.full(others.size, long_segment), others], axis=1))
+        pairs = np.concatenate(pairs)
+        pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+
+        p, r = segments[pairs[:, 0], 0], segments[pairs[:, 0], 1] - segments[pairs[:, 0], 0]
+        q, s = segments[pairs[:, 1], 0], segments[pairs[:, 1], 1] - segments[pairs[:, 1], 0]
+        denominator = r[:, 0] * s[:, 1] - r[:, 1] * s[:, 0]
+        parallel = np.abs(denominator) < 1e-12 * np.hypot(*r.T) * np.hypot(*s.T)
+        denominator[parallel] = 1
+        qp = q - p
+        t = (qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]) / denominator
+        u = (qp[:, 0] * r[:, 1] - qp[:, 1] * r[:, 0]) / denominator
+        eps = 1e-9
+        crossing = ~parallel & (t > eps) & (t < 1 - eps) & (u > eps) & (u < 1 - eps)
+        points = p[crossing] + t[crossing, np.newaxis] * r[crossing]
+        return np.unique(np.round(points, 9), axis=0) if points.size else np.zeros((0, 2))
+
+    @timed('snap.query')
+    def snap(self, point, tolerance, grid_spacing=None, kinds=None):
+        """ Returns the snap point closest to point within tolerance and its kind.
+
+            Object snap points take precedence over the grid. Without any snap point in reach, point itself and
+            None are returned.
+
+            Args:
+                point (list): x, y.
+                tolerance (float): Largest snap distance.
+                grid_spacing (float): Spacing of the grid, None if the grid is not active.
+                kinds (list of string): Snap kinds to use, default all SNAP_KINDS.
+        """
+        if self.tree is not None and (kinds is None or kinds):
+            distances, indices = self.tree.query(point, k=8, distance_upper_bound=tolerance)
+            for distance, index in zip(np.atleast_1d(distances), np.atleast_1d(indices)):
+                if not np.isfinite(distance):
+                    break
+                kind = SNAP_KINDS[self.kinds[index]]
+                if kinds is None or kind in kinds:
+                    return [float(self.points[index, 0]), float(self.points[index, 1])], kind
+        if grid_spacing:
+            return [round(point[0] / grid_spacing) * grid_spacing, round(point[1] / grid_spacing) * grid_spacing], \
+                'grid'
+        return list(point), None
+
+    def nearest_node(self, point):
+        """ Returns the vertex or circle centre closest to point, None for an empty drawing. """
+        if self.node_tree is None:
+            return None
+        return [float(c) for c in self.node_points[self.node_tree.query(point)[1]]]
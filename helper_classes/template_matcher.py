@@ -0,0 +1,283 @@
+from collections import namedtuple
+
+import numpy as np
+from matplotlib.path import Path
+from scipy import ndimage
+from scipy.fftpack import next_fast_len
+
+from utility.profiling import timed
+
+Match = namedtuple('Match', ['name', 'x', 'y', 'angle', 'scale', 'score'])
+Match.__doc__ = """ Position of a stencil found in a scan.
+
+    Attributes:
+        name (string): Name of the stencil.
+        x (float): x of the stencil origin in scan coordinates, the position to pass to add_stencil.
+        y (float): y of the stencil origin.
+        angle (float): Rotation of the stencil in degrees, counterclockwise.
+        scale (float): Scale of the stencil.
+        score (float): Normalized cross-correlation, 1 for a perfect match.
+"""
+
+
+def rasterize(geometry, pixel_pitch, angle=0., scale=1., line_width=1, psf_sigma=None):
+    """ Renders the filled outlines of a stencil at the pixel pitch of a scan.
+
+        Closed polylines and circles are filled with the even-odd rule, so holes stay empty. Open polylines are drawn
+        as lines of line_width pixels.
+
+        Args:
+            geometry (DXFGeometry): Stencil.
+            pixel_pitch (float): Pixel pitch of the scan.
+            angle (float): Rotation about the stencil origin in degrees, counterclockwise.
+            scale (float): Scale about the stencil origin.
+            line_width (int): Width of open polylines in pixels.
+            psf_sigma (float): Width of the point spread function of the scan, the template is blurred with it. None
+                for a sharp template.
+
+        Returns:
+            np.array: Template, 1 inside and 0 outside if sharp, rows from y max to y min.
+            np.array: Row and column of the stencil origin in template pixels.
+    """
+    c, s = scale * np.cos(np.radians(angle)), scale * np.sin(np.radians(angle))
+    rotation = np.array([[c, s], [-s, c]])  # row vectors, as the transformation matrices
+    vertices = np.dot(geometry.vertices, rotation)
+    centers, radii = np.dot(geometry.centers, rotation), geometry.radii * scale
+    border = pixel_pitch + (2 * psf_sigma if psf_sigma else 0)
+    low = np.min(np.concatenate([vertices, centers - radii[:, np.newaxis]]), axis=0) - border
+    high = np.max(np.concatenate([vertices, centers + radii[:, np.newaxis]]), axis=0) + border
+    n_cols, n_rows = (np.ceil((high - low) / pixel_pitch).astype(int) + 1)
+    x = low[0] + np.arange(n_cols) * pixel_pitch
+    y = high[1] - np.arange(n_rows) * pixel_pitch
+    filled = np.zeros((n_rows, n_cols), dtype=bool)
+    lines = np.zeros((n_rows, n_cols), dtype=bool)
+
+    for i in range(len(geometry.closed)):
+        pts = vertices[geometry.offsets[i]:geometry.offsets[i + 1]]
+        if geometry.closed[i] and pts.shape[0] > 2:
+            cols = np.flatnonzero((x >= pts[:, 0].min()) & (x <= pts[:, 0].max()))
+            rows = np.flatnonzero((y >= pts[:, 1].min()) & (y <= pts[:, 1].max()))
+            if cols.size and rows.size:
+                grid_x, grid_y = np.meshgrid(x[cols], y[rows])
+                inside = Path(np.concatenate([pts, pts[:1]])).contains_points(
+                    np.column_stack([grid_x.ravel(), grid_y.ravel()])).reshape(rows.size, cols.size)
+                filled[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] ^= inside
+        elif pts.shape[0] > 1:
+            length = np.hypot(*np.diff(pts, axis=0).T) / pixel_pitch
+            for start, end, n in zip(pts[:-1], pts[1:], np.ceil(2 * length).astype(int) + 1):
+                t = np.linspace(0, 1, n)[:, np.newaxis]
+                samples = start + t * (end - start)
+                lines[np.round((high[1] - samples[:, 1]) / pixel_pitch).astype(int),
+                      np.round((samples[:, 0] - low[0]) / pixel_pitch).astype(int)] = True
+    for center, radius in zip(centers, radii):
+        grid_x, grid_y = np.meshgrid(x - center[0], y - center[1])
+        filled ^= grid_x ** 2 + grid_y ** 2 <= radius ** 2
+    if line_width > 1:
+        lines = ndimage.binary_dilation(lines, np.ones((line_width, line_width), dtype=bool))
+    template = (filled | lines).astype(float)
+    if psf_sigma:
+        template = ndimage.gaussian_filter(template, psf_sigma / pixel_pitch)
+    return template, np.array([high[1] / pixel_pitch, -low[0] / pixel_pitch])
+
+
+def block_mean(image, factor):
+    """ Averages blocks of factor x factor pixels, the last rows and columns are padded with the edge values. """
+    if factor == 1:
+        return image
+    rows, cols = -(-image.shape[0] // factor) * factor, -(-image.shape[1] // factor) * factor
+    image = np.pad(image, ((0, rows - image.shape[0]), (0, cols - image.shape[1])), mode='edge')
+    return image.reshape(rows // factor, factor, cols // factor, factor).mean(axis=(1, 3))
+
+
+def window_sums(image, shape):
+    """ Sums of image and image squared over every window of shape fully inside image, from integral images. """
+    sums = []
+    for values in [image, image ** 2]:
+        integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+        integral[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+        h, w = shape
+        sums.append(integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w])
+    return sums
+
+
+class TemplateMatcher:
+    """ Finds stencils in a scan by normalized cross-correlation computed with FFTs.
+
+        Templates are first matched against a block averaged copy of the scan, coarse enough for the template to keep
+        about coarse_size pixels across. Candidates above a lowered threshold are then refined on the full resolution
+        scan in a window of one coarse pixel and located to sub-pixel precision with a parabola through the
+        correlation peak. Downsampled scans, their window sums and their spectra for each FFT size are cached, so
+        searching many stencils, rotations and scales costs one FFT product per template.
+
+        Attributes:
+            image (np.array): Scan counts, rows from y max to y min.
+            x_ax (np.array): x axis of the scan.
+            y_ax (np.array): y axis of the scan.
+            pixel_pitch (float): Pixel pitch along x, assumed equal along y.
+            coarse_size (int): Smallest template size in pixels on the coarse level.
+            levels (dict): factor -> downsampled image.
+            spectra (dict): (factor, fft shape) -> real FFT of the downsampled image.
+            sums (dict): (factor, template shape) -> window sums of the image and the image squared.
+    """
+    def __init__(self, image, x_ax, y_ax, coarse_size=16):
+        self.image = np.asarray(image, dtype=float)
+        self.x_ax, self.y_ax = np.asarray(x_ax), np.asarray(y_ax)
+        self.pixel_pitch = abs(self.x_ax[1] - self.x_ax[0])
+        self.coarse_size = coarse_size
+        self.levels = {1: self.image}
+        self.spectra = {}
+        self.sums = {}
+
+    @classmethod
+    def from_mat_file(cls, mat_file, **kwargs):
+        return cls(mat_file.graph['result'], mat_file.graph['x'][0], mat_file.graph['y'][0], **kwargs)
+
+    def level(self, factor):
+        if factor not in self.levels:
+            self.levels[factor] = block_mean(self.image, factor)
+        return self.levels[factor]
+
+    def correlate(self, template, factor=1):
+        """ Returns the normalized cross-correlation of template at every position fully inside the scan level.
+
+            Element (r, c) is the score of the template with its first pixel on pixel (r, c) of the level.
+        """
+        image = self.level(factor)
+        h, w = template.shape
+        if h > image.shape[0] or w > image.shape[1]:
+            return np.zeros((0, 0))
+        fft_shape = (next_fast_len(image.shape[0] + h - 1), next_fast_len(image.shape[1] + w - 1))
+        if (factor, fft_shape) not in self.spectra:
+            self.spectra[(factor, fft_shape)] = np.fft.rfft2(image, fft_shape)
+        if (factor, template.shape) not in self.sums:
+            self.sums[(factor, template.shape)] = window_sums(image, template.shape)
+        sums, squares = self.sums[(factor, template.shape)]
+        return normalized_correlation(self.spectra[(factor, fft_shape)], fft_shape, sums, squares, template)
+
+    def position(self, row, col, origin):
+        """ Scan coordinates of the stencil origin for the template placed with its first pixel on row, col. """
+        return (self.x_ax[0] + (col + origin[1]) * self.pixel_pitch,
+                self.y_ax[-1] - (row + origin[0]) * self.pixel_pitch)  # rows run from y max to y min
+
+    @timed('template_match')
+    def match(self, template, origin, threshold=0.6, min_distance=None):
+        """ Finds all positions where template scores above threshold.
+
+            Args:
+                template (np.array): Template, see rasterize.
+                origin (np.array): Row and column of the stencil origin in template pixels.
+                threshold (float): Smallest normalized cross-correlation of a match.
+                min_distance (int): Smallest distance of two matches in pixels, default half the template size.
+
+            Returns:
+                list of tuple: x, y and score of each match.
+        """
+        if min_distance is None:
+            min_distance = max(min(template.shape) // 2, 1)
+        factor = int(np.clip(max(template.shape) // self.coarse_size, 1, 8))
+        if factor > 1:
+            coarse_template = block_mean(template, factor)
+            coarse = self.correlate(coarse_template, factor)
+            candidates = peaks(coarse, threshold * 0.7, max(min_distance // factor, 1))
+        else:
+            candidates = None
+        matches = []
+        if candidates is None:
+            scores = self.correlate(template)
+            for row, col in peaks(scores, threshold, min_distance):
+                matches.append(self.refine(scores, row, col, origin))
+            return matches
+        h, w = template.shape
+        for row, col in candidates:  # refine each coarse candidate in a window of one coarse pixel
+            top, left = max(row * factor - factor, 0), max(col * factor - factor, 0)
+            bottom = min(row * factor + factor + h, self.image.shape[0])
+            right = min(col * factor + factor + w, self.image.shape[1])
+            if bottom - top < h or right - left < w:
+                continue
+            scores = normalized_correlation_direct(self.image[top:bottom, left:right], template)
+            r, c = np.unravel_index(np.argmax(scores), scores.shape)
+            if scores[r, c] >= threshold:
+                x, y, score = self.refine(scores, r, c, origin)
+                matches.append((x + left * self.pixel_pitch, y - top * self.pixel_pitch, score))
+        return matches
+
+    def refine(self, scores, row, col, origin):
+        """ Sub-pixel position of the peak at row, col by a parabola along each axis. """
+        offsets = []
+        for axis, index in enumerate([row, col]):
+            if 0 < index < scores.shape[axis] - 1:
+                before = scores[row - 1, col] if axis == 0 else scores[row, col - 1]
+                after = scores[row + 1, col] if axis == 0 else scores[row, col + 1]
+                curvature = before - 2 * scores[row, col] + after
+                offsets.append(0.5 * (before - after) / curvature if curvature < 0 else 0.)
+            else:
+                offsets.append(0.)
+        x, y = self.position(row + offsets[0], col + offsets[1], origin)
+        return x, y, float(scores[row, col])
+
+    def search(self, stencils, threshold=0.6, angles=(0.,), scales=(1.,), psf_sigma=None):
+        """ Searches a scan for several stencils, each at several rotations and scales.
+
+            Overlapping matches of a stencil at different rotations or scales are reduced to the best one. Matches of
+            different stencils are all kept, as a part of a stencil, e.g. a wing of a windmill, is a stencil itself.
+
+            Args:
+                stencils (dict): name -> DXFGeometry.
+                threshold (float): Smallest normalized cross-correlation of a match.
+                angles (list of float): Rotations in degrees.
+                scales (list of float): Scales.
+                psf_sigma (float): Width of the point spread function of the scan, see rasterize.
+
+            Returns:
+                list of Match: Sorted by decreasing score.
+        """
+        matches, radii = [], []
+        for name, geometry in stencils.items():
+            for angle in angles:
+                for scale in scales:
+                    template, origin = rasterize(geometry, self.pixel_pitch, angle, scale, psf_sigma=psf_sigma)
+                    for x, y, score in self.match(template, origin, threshold):
+                        matches.append(Match(name, x, y, angle, scale, score))
+                        radii.append(min(template.shape) * self.pixel_pitch / 2.)
+        order = np.argsort([-m.score for m in matches])
+        kept = []
+        for i in order:
+            if all(matches[i].name != matches[j].name or
+                   np.hypot(matches[i].x - matches[j].x, matches[i].y - matches[j].y) >= max(radii[i], radii[j])
+                   for j in kept):
+                kept.append(i)
+        return [matches[i] for i in kept]
+
+
+def normalized_correlation(spectrum, fft_shape, sums, squares, template):
+    """ Normalized cross-correlation of a template with an image given by its spectrum and window sums. """
+    h, w = template.shape
+    zero_mean = template - template.mean()
+    norm = np.sqrt(np.sum(zero_mean ** 2))
+    rows, cols = sums.shape
+    if norm == 0:
+        return np.zeros((rows, cols))
+    flipped = np.fft.rfft2(zero_mean[::-1, ::-1], fft_shape)  # convolution with the flipped template correlates
+    correlation = np.fft.irfft2(spectrum * flipped, fft_shape)[h - 1:h - 1 + rows, w - 1:w - 1 + cols]
+    variance = np.maximum(squares - sums ** 2 / (h * w), 0)
+    denominator = np.sqrt(variance) * norm
+    return np.where(denominator > 1e-12 * norm * (1 + np.sqrt(variance.max())), correlation / np.maximum(
+        denominator, 1e-300), 0.)
+
+
+def normalized_correlation_direct(image, template):
+    """ Normalized cross-correlation for small images, without cached spectra. """
+    fft_shape = (next_fast_len(image.shape[0] + template.shape[0] - 1),
+                 next_fast_len(image.shape[1] + template.shape[1] - 1))
+    sums, squares = window_sums(image, template.shape)
+    return normalized_correlation(np.fft.rfft2(image, fft_shape), fft_shape, sums, squares, template)
+
+
+def peaks(scores, threshold, min_distance):
+    """ Rows and columns of the local maxima of scores above threshold, at least min_distance apart. """
+    if not scores.size:
+        return []
+    maxima = (scores == ndimage.maximum_filter(scores, size=2 * min_distance + 1)) & (scores >= threshold)
+    rows, cols = np.nonzero(maxima)
+    order = np.argsort(-scores[rows, cols])
+    return list(zip(rows[order], cols[order]))
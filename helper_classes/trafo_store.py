@@ -0,0 +1,155 @@
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+from utility.warp import WARP_MODELS, CoordinateMap, compose, fit_warp
+
+
+class TrafoStore:
+    """ Named transformations from scan to layout coordinates, kept per sample and layout.
+
+        A sample is the directory holding its scans, a layout the dxf file. Matrices are stored directly, warps by
+        their point pairs and fitted again when first used after loading. The store is written to
+        ~/.pykaboo/registrations.json whenever a transformation is added, outside of the program directory.
+        Transformations of unsaved layouts are kept for the session only.
+
+        Resampling maps are cached for each transformation, drift and scan grid, so viewing a further scan of the
+        same field in layout coordinates costs a gather only.
+
+        Attributes:
+            file_name (string): Json file holding the transformations.
+            entries (dict): Name -> dict with sample, layout, scan, model and matrix or point pairs.
+            trafos (dict): Name -> matrix or warp, built from entries on demand.
+            maps (OrderedDict): Recently used CoordinateMaps, keyed by name, drift and scan grid.
+            max_maps (int): Number of cached maps, each holds about 13 bytes per pixel.
+    """
+    def __init__(self, file_name=None, max_maps=8):
+        self.file_name = file_name or os.path.join(os.path.expanduser('~'), '.pykaboo', 'registrations.json')
+        self.entries = {}
+        self.trafos = {}
+        self.maps = OrderedDict()
+        self.max_maps = max_maps
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return
+        try:
+            with open(self.file_name, 'r') as f:
+                self.entries = json.load(f)
+        except ValueError:  # damaged file, start a new store
+            self.entries = {}
+        self.trafos = {}
+        self.maps.clear()
+
+    def save(self):
+        entries = {name: entry for name, entry in self.entries.items() if entry['layout']}
+        directory = os.path.dirname(self.file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.file_name, 'w') as f:
+            json.dump(entries, f, indent=1)
+
+    @staticmethod
+    def name(sample, layout):
+        return '{0} | {1}'.format(os.path.basename(os.path.normpath(sample)) or sample,
+                                  os.path.basename(layout) or 'unsaved layout')
+
+    def find(self, sample, layout):
+        """ Returns the name of the transformation stored for sample and layout, None if there is none. """
+        if not layout:
+            return None
+        for name, entry in self.entries.items():
+            if entry['sample'] == os.path.normpath(sample) and entry['layout'] == os.path.normpath(layout):
+                return name
+        return None
+
+    def add(self, sample, layout, scan, model, trafo, **kwargs):
+        """ Stores a transformation, replacing the one of the same sample and layout.
+
+            Args:
+                sample (string): Directory of the scans.
+                layout (string): File name of the dxf layout, '' for an unsaved layout.
+                scan (string): File name of the scan the transformation was fitted on.
+                model (string): Model of fit_trafo or of WARP_MODELS.
+                trafo: 3x3 matrix or warp.
+
+            Keyword Args:
+                raw (np.array): Scan coordinates of the point pairs, required for warps.
+                real (np.array): Layout coordinates of the point pairs, required for warps.
+                weights (np.array): Weights of the point pairs.
+                order (int): Polynomial order of a polynomial warp.
+                smoothing (float): Smoothing of a thin-plate warp.
+
+            Returns:
+                string: Name of the stored transformation.
+        """
+        name = self.find(sample, layout) or self.unique_name(self.name(sample, layout))
+        entry = {'sample': os.path.normpath(sample), 'layout': os.path.normpath(layout) if layout else '',
+                 'scan': scan, 'model': model}
+        if model in WARP_MODELS:
+            weights = kwargs.get('weights')
+            entry.update({'raw': np.asarray(kwargs['raw']).tolist(), 'real': np.asarray(kwargs['real']).tolist(),
+                          'weights': None if weights is None else np.asarray(weights).tolist(),
+                          'order': kwargs.get('order', 3), 'smoothing': kwargs.get('smoothing', 0.)})
+        else:
+            entry['matrix'] = np.asarray(trafo).tolist()
+        self.remove(name)
+        self.entries[name] = entry
+        self.trafos[name] = trafo
+        if entry['layout']:
+            self.save()
+        return name
+
+    def unique_name(self, name):
+        unique, number = name, 1
+        while unique in self.entries:
+            number += 1
+            unique = '{0} ({1})'.format(name, number)
+        return unique
+
+    def remove(self, name):
+        """ Drops a transformation and its cached maps from the session, the json file is left unchanged. """
+        self.entries.pop(name, None)
+        self.trafos.pop(name, None)
+        for key in [key for key in self.maps if key[0] == name]:
+            del self.maps[key]
+
+    def trafo(self, name):
+        if name not in self.trafos:
+            entry = self.entries[name]
+            if entry['model'] in WARP_MODELS:
+                self.trafos[name] = fit_warp(entry['raw'], entry['real'], entry['model'], weights=entry['weights'],
+                                             order=entry['order'], smoothing=entry['smoothing'])
+            else:
+                self.trafos[name] = np.array(entry['matrix'])
+        return self.trafos[name]
+
+    def drift(self, name, scan, drift_trafos):
+        """ Matrix mapping scan onto the scan the transformation was fitted on, None without drift correction.
+
+            Args:
+                drift_trafos (dict): File name -> matrix mapping that scan onto a common reference scan.
+        """
+        fitted_scan = self.entries[name]['scan']
+        if not drift_trafos or scan == fitted_scan or scan not in drift_trafos or fitted_scan not in drift_trafos:
+            return None
+        return np.dot(drift_trafos[scan], np.linalg.inv(drift_trafos[fitted_scan]))
+
+    def coordinate_map(self, name, x_axis, y_axis, drift=None):
+        """ CoordinateMap of the named transformation for scans on the given axes, built once and cached.
+
+            Args:
+                drift (np.array): Matrix applied before the transformation, see drift().
+        """
+        key = (name, None if drift is None else np.round(drift, 9).tobytes(),
+               x_axis[0], x_axis[-1], len(x_axis), y_axis[0], y_axis[-1], len(y_axis))
+        if key in self.maps:
+            self.maps.move_to_end(key)
+        else:
+            trafo = self.trafo(name)
+            self.maps[key] = CoordinateMap(trafo if drift is None else compose(drift, trafo), x_axis, y_axis)
+            while len(self.maps) > self.max_maps:
+                self.maps.popitem(last=False)
+        return self.maps[key]
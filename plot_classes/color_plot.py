@@ -1,68 +1,189 @@
-from matplotlib import patches as patches
-from matplotlib.path import Path
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib.collections import LineCollection
 from PyQt5 import QtWidgets
 
+from plot_classes.event_coalescer import EventCoalescer
 from plot_classes.my_mpl_canvas import MyMplCanvas
-from utility import tum_jet
+from utility.color_lut import apply_colormap
 from utility.xterm_hex_conv import xterm_to_hex
 from utility.config import paths
+from utility.profiling import timed, timer
 
 
 # noinspection PyAttributeOutsideInit, PyArgumentList
 class ColorPlot(MyMplCanvas):
+    snap_markers = {'vertex': 's', 'midpoint': '^', 'centre': 'o', 'intersection': 'x', 'grid': '+'}
 
     def __init__(self, *args, **kwargs):
         MyMplCanvas.__init__(self, *args, **kwargs)
+        self.coalescer = EventCoalescer(parent=self)
+        self.mpl_connect('draw_event', self.store_background)
 
     def compute_initial_figure(self):
         self.plot_limits = [[0, 100], [0, 100]]
         self.plot_limits_fixed = False
         self.count_limits = [0, 1e5]
         self.count_limits_fixed = False
+        self.count_percentiles = None  # [lower, upper] in percent for automatic contrast, None for full range
+        self.colormap = 'tum_jet'
+        self.color_buffer = None  # RGBA image of the last draw, reused if the next image has the same shape
         self.mat = None
         self.dxf = None
+        self.dxf_color = None  # color index of all entities of dxf, None for their own colors
+        self.layer_artists = OrderedDict()  # layer name -> (line collection, entity of each segment) of dxf
+        self.selection_artists = OrderedDict()  # the same for the selected entities
+        self.geometry = None  # DXFGeometry drawn as line collection, e.g. a layout transformed onto the scan
         self.markers = None
+        self.selection = None  # handles of selected dxf entities
+        self.background = None  # pixels of the last full draw, restored before drawing the snap marker
+        self.snap_marker = None
         self.axes.cla()
 
+    @timed('draw_canvas.imshow')
     def draw_mat(self, mat_file):
         if not self.count_limits_fixed:
-            cts = mat_file.graph['result'].ravel()
-            self.count_limits = [min(cts), max(cts)]
+            self.count_limits = mat_file.count_limits(self.count_percentiles)
         if not self.plot_limits_fixed:
             self.plot_limits = [[mat_file.graph['x'][0, 0], mat_file.graph['x'][0, -1]],
                                 [mat_file.graph['y'][0, 0], mat_file.graph['y'][0, -1]]]
-        self.axes.imshow(mat_file.graph['result'], extent=(mat_file.graph['x'][0, 0], mat_file.graph['x'][0, -1],
-                                                           mat_file.graph['y'][0, 0], mat_file.graph['y'][0, -1]),
-                         cmap=tum_jet.tum_jet, vmin=self.count_limits[0], vmax=self.count_limits[1])
+        if hasattr(mat_file, 'set_view'):  # mosaics are read for the visible region at the resolution of the canvas
+            mat_file.set_view(self.plot_limits[0], self.plot_limits[1], max(self.width(), self.height()))
+        shape = mat_file.graph['result'].shape + (4,)
+        if self.color_buffer is None or self.color_buffer.shape != shape:
+            self.color_buffer = np.empty(shape, dtype=np.uint8)
+        apply_colormap(mat_file.graph['result'], self.count_limits[0], self.count_limits[1], self.colormap,
+                       out=self.color_buffer)
+        self.axes.imshow(self.color_buffer, extent=(mat_file.graph['x'][0, 0], mat_file.graph['x'][0, -1],
+                                                    mat_file.graph['y'][0, 0], mat_file.graph['y'][0, -1]))
 
+    @timed('draw_canvas.layers')
     def draw_dxf(self, dxf_file, **kwargs):
-        for patch in self.patches(dxf_file, **kwargs):
-            if patch:
-                self.axes.add_patch(patch)
+        """ Draws each layer as one line collection, remembered in layer_artists to be restyled by update_layers. """
+        self.dxf_color = kwargs.get('dxf_color', None)
+        self.layer_artists = self.draw_geometry(dxf_file.geometry(), color=self.dxf_color,
+                                                hidden=getattr(dxf_file, 'hidden_layers', ()))
+
+    @timed('draw_canvas.geometry')
+    def draw_geometry(self, geometry, handles=None, color=None, linewidth=1., hidden=()):
+        """ Draws the outlines of a DXFGeometry as one line collection per layer, circles and ellipses as polygons.
+
+            Args:
+                geometry (DXFGeometry): Entities to draw.
+                handles (set): Draw only the entities of these handles, default all.
+                color (int): Color index of all entities, default the colors of the geometry.
+                linewidth (float): Width of all lines.
+                hidden (set): Names of layers drawn invisible.
+
+            Returns:
+                OrderedDict: Layer name -> (line collection, entity number of each of its segments).
+        """
+        artists = OrderedDict()
+        if not len(geometry):
+            return artists
+        pitch = abs(self.plot_limits[0][1] - self.plot_limits[0][0]) / max(self.width(), 1)
+        segments, entities = geometry.segments(max_error=pitch / 2.)
+        if handles is not None:
+            keep = np.array([h in handles for h in geometry.handles], dtype=bool)[entities]
+            segments, entities = segments[keep], entities[keep]
+        order = np.argsort(geometry.layers[entities], kind='mergesort')
+        segments, entities = segments[order], entities[order]
+        bounds = np.searchsorted(geometry.layers[entities], np.arange(len(geometry.layer_names) + 1))
+        rgb = geometry.rgb() / 255. if color is None else None
+        for layer, name in enumerate(geometry.layer_names):
+            start, stop = bounds[layer], bounds[layer + 1]
+            if start == stop:
+                continue
+            colors = xterm_to_hex(color) if color is not None else rgb[entities[start:stop]]
+            artists[name] = (self.axes.add_collection(LineCollection(
+                segments[start:stop], colors=colors, linewidths=linewidth, visible=name not in hidden)),
+                entities[start:stop])
+        return artists
+
+    def update_layers(self):
+        """ Applies the visibility and colors of the layers of the drawn dxf file to their line collections, without
+            drawing the layout again. """
+        if not self.dxf:
+            return
+        rgb = self.dxf.geometry().rgb() / 255.
+        for name, (artist, entities) in self.layer_artists.items():
+            artist.set_visible(self.dxf.layer_visible(name))
+            if self.dxf_color is None:
+                artist.set_color(rgb[entities])
+        for name, (artist, _) in self.selection_artists.items():
+            artist.set_visible(self.dxf.layer_visible(name))
+        self.draw_idle()
+
+    @timed('draw_canvas.selection')
+    def draw_selection(self, dxf_file, selection):
+        self.selection_artists = self.draw_geometry(dxf_file.geometry(), handles=set(selection), color=0,
+                                                    linewidth=2.5, hidden=getattr(dxf_file, 'hidden_layers', ()))
 
+    @timed('draw_canvas.markers')
     def draw_markers(self, markers):
         self.axes.plot([pt[0] for pt in markers], [pt[1] for pt in markers], ls='None',
                        marker='+', markeredgecolor='k', markersize=15)
 
+    @timed('draw_canvas')
     def draw_canvas(self, **kwargs):
         self.plot_limits = kwargs.get('plot_limits', self.plot_limits)
         self.mat = kwargs.get('mat', self.mat)
         self.dxf = kwargs.get('dxf', self.dxf)
+        self.geometry = kwargs.get('geometry', self.geometry)
         self.markers = kwargs.get('markers', self.markers)
+        self.selection = kwargs.get('selection', self.selection)
         dxf_color = kwargs.get('dxf_color', None)
         show_axes = kwargs.get('show_axes', True)
         self.axes.cla()
+        self.selection_artists = OrderedDict()
         if self.mat:
             self.draw_mat(self.mat)
         if self.dxf:
             self.draw_dxf(self.dxf, dxf_color=dxf_color)
+            if self.selection:
+                self.draw_selection(self.dxf, self.selection)
+        if self.geometry:
+            self.draw_geometry(self.geometry)
         if self.markers:
             self.draw_markers(self.markers)
         self.axes.set_xlim(self.plot_limits[0][0], self.plot_limits[0][1])
         self.axes.set_ylim(self.plot_limits[1][0], self.plot_limits[1][1])
         self.axes.get_xaxis().set_visible(show_axes)
         self.axes.get_yaxis().set_visible(show_axes)
-        self.draw()
+        self.snap_marker, = self.axes.plot([], [], ls='None', marker='+', markersize=12, markerfacecolor='none',
+                                           markeredgecolor='m', markeredgewidth=1.5, animated=True)
+        with timer('draw_canvas.draw'):
+            self.draw()
+
+    def set_plot_limits(self, plot_limits):
+        """ Changes only the axis limits, the redraw is merged with other requests until the next refresh. """
+        self.plot_limits = plot_limits
+        self.axes.set_xlim(plot_limits[0][0], plot_limits[0][1])
+        self.axes.set_ylim(plot_limits[1][0], plot_limits[1][1])
+        self.background = None  # outdated until the redraw
+        if hasattr(self.mat, 'set_view'):
+            self.coalescer.post('draw', self.draw_canvas)  # the visible part of a mosaic is read again
+        else:
+            self.coalescer.post('draw', self.draw_idle)
+
+    def pixel_size(self):
+        """ Width of a pixel in data units. """
+        return abs(self.plot_limits[0][1] - self.plot_limits[0][0]) / max(self.axes.bbox.width, 1)
+
+    def store_background(self, event):
+        self.background = self.copy_from_bbox(self.axes.bbox)
+
+    def show_snap(self, position, kind=None):
+        """ Draws the snap marker at position, or removes it for None, by blitting over the last full draw. """
+        if self.background is None or self.snap_marker is None:
+            return
+        self.restore_region(self.background)
+        if position is not None:
+            self.snap_marker.set_data([position[0]], [position[1]])
+            self.snap_marker.set_marker(self.snap_markers.get(kind, '+'))
+            self.axes.draw_artist(self.snap_marker)
+        self.blit(self.axes.bbox)
 
     def update_canvas(self, **kwargs):  # TODO: Change canvas methods to partial updates
         pass
@@ -73,25 +194,3 @@ class ColorPlot(MyMplCanvas):
         if not fname:  # capture cancel in dialog
             return
         self.fig.savefig(fname, bbox_inches='tight')
-
-    @staticmethod
-    def patches(dxf_file, **kwargs):
-        dxf_color = kwargs.get('dxf_color', None)
-        for e in dxf_file.drawing.entities:
-            if dxf_color:
-                c = dxf_color
-            elif e.dxf.color < 256:
-                c = e.dxf.color
-            else:
-                c = dxf_file.drawing.layers.get(e.dxf.layer).get_color()
-            if e.dxftype() == 'CIRCLE':
-                yield patches.Circle(e.dxf.center[:-1], e.dxf.radius, fill=False, color=xterm_to_hex(c))
-            elif e.dxftype() == 'POLYLINE':
-                codes = [Path.MOVETO] + [Path.LINETO for _ in range(e.__len__() - 1)] + [Path.CLOSEPOLY]
-                pts = [p[:-1] for p in e.points()]
-                path = Path(pts + [pts[0]], codes)
-                yield patches.PathPatch(path, fill=False, color=xterm_to_hex(c))
-            elif e.dxftype() == 'LWPOLYLINE':  # TODO: Test 'LWPOLYLINE'
-                codes = [Path.MOVETO] + [Path.LINETO for _ in range(e.__len__() - 1)] + [Path.CLOSEPOLY]
-                path = Path(e.get_rstrip_points() + [e.get_rstrip_points()[0]], codes)
-                yield patches.PathPatch(path, fill=False, color=xterm_to_hex(c))
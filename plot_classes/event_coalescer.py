@@ -0,0 +1,38 @@
+from collections import OrderedDict
+from PyQt5 import QtWidgets, QtCore
+
+
+class EventCoalescer(QtCore.QObject):
+    """ Merges bursts of mouse events and redraw requests into one call per display refresh.
+
+        Every post replaces the pending call of the same key, so when the timer fires only the latest mouse
+        position is handled and only the latest view is drawn, however many events arrived in between.
+
+        Attributes:
+            pending (OrderedDict): key -> (callback, args) of the calls waiting for the next flush.
+            timer (QTimer): Single shot timer started by the first post after a flush.
+    """
+    def __init__(self, interval=None, parent=None):
+        super(EventCoalescer, self).__init__(parent)
+        if interval is None:  # one display refresh
+            screen = QtWidgets.QApplication.primaryScreen()
+            refresh_rate = screen.refreshRate() if screen else 60.
+            interval = int(round(1000. / max(refresh_rate, 1.)))
+        self.pending = OrderedDict()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+
+    def post(self, key, callback, *args):
+        """ Calls callback(*args) with the next flush, replacing any call pending under key. """
+        self.pending[key] = (callback, args)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        """ Runs all pending calls now, in the order their keys were first posted. """
+        self.timer.stop()
+        pending, self.pending = self.pending, OrderedDict()
+        for callback, args in pending.values():
+            callback(*args)
@@ -0,0 +1,187 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+from helper_classes.mat_file import MatFile
+from utility.color_lut import apply_colormap
+
+
+def render_overlay(mat_file=None, geometry=None, count_limits=None, **kwargs):
+    """ Renders a scan and the outlines of a layout into an RGBA image without matplotlib.
+
+        The scan is colored with a lookup table from utility.color_lut and sampled at the centre of each output pixel,
+        outlines are sampled at half pixel steps along each segment. Row 0 of the image is the top edge, the largest y.
+
+        Args:
+            mat_file (MatFile): Scan, None for the layout only.
+            geometry (DXFGeometry): Layout, None for the scan only.
+            count_limits (list): [min, max] counts mapped to the ends of the colormap. Default mat_file.count_limits().
+
+        Keyword Args:
+            extent (list): [[xmin, xmax], [ymin, ymax]] of the image. Default the scan, else the layout.
+            pixel_pitch (float): Size of an output pixel. Default the pixel pitch of the scan, else 1/1000 of the
+                layout width.
+            line_width (int): Width of outlines in pixels. Default 1.
+            colormap (string): Name of a colormap registered in utility.color_lut. Default 'tum_jet'.
+            background (tuple): RGBA of pixels without scan. Default opaque white.
+            max_pixels (int): Largest number of output pixels. Default 2e8.
+
+        Returns:
+            np.array: uint8 array of shape (rows, columns, 4).
+    """
+    extent = kwargs.get('extent')
+    pixel_pitch = kwargs.get('pixel_pitch')
+    if extent is None:
+        if mat_file is not None:
+            extent = [[mat_file.graph['x'][0, 0], mat_file.graph['x'][0, -1]],
+                      [mat_file.graph['y'][0, 0], mat_file.graph['y'][0, -1]]]
+        elif geometry is not None and len(geometry):
+            extent = geometry.extent()
+        else:
+            raise ValueError('Nothing to render.')
+    (x_min, x_max), (y_min, y_max) = sorted(extent[0]), sorted(extent[1])
+    if pixel_pitch is None:
+        if mat_file is not None:
+            pixel_pitch = abs(mat_file.graph['x'][0, 1] - mat_file.graph['x'][0, 0])
+        else:
+            pixel_pitch = (x_max - x_min) / 1000.
+    n_cols = max(1, int(np.ceil((x_max - x_min) / pixel_pitch)))
+    n_rows = max(1, int(np.ceil((y_max - y_min) / pixel_pitch)))
+    if n_cols * n_rows > kwargs.get('max_pixels', 2e8):
+        raise ValueError('Image of {0} x {1} pixels is too large, increase the pixel pitch.'.format(n_cols, n_rows))
+
+    image = np.empty((n_rows, n_cols, 4), dtype=np.uint8)
+    image[:] = kwargs.get('background', (255, 255, 255, 255))
+    if mat_file is not None:
+        if count_limits is None:
+            count_limits = mat_file.count_limits()
+        draw_scan(image, mat_file, count_limits, x_min, y_max, pixel_pitch, kwargs.get('colormap', 'tum_jet'))
+    if geometry is not None and len(geometry):
+        draw_outlines(image, geometry, x_min, y_max, pixel_pitch, kwargs.get('line_width', 1))
+    return image
+
+
+def draw_scan(image, mat_file, count_limits, x_min, y_max, pixel_pitch, colormap):
+    x_ax, y_ax = mat_file.graph['x'][0], mat_file.graph['y'][0]
+    result = mat_file.graph['result']
+    pitch_x = (x_ax[-1] - x_ax[0]) / (len(x_ax) - 1)
+    pitch_y = (y_ax[-1] - y_ax[0]) / (len(y_ax) - 1)
+    centres_x = x_min + (np.arange(image.shape[1]) + 0.5) * pixel_pitch
+    centres_y = y_max - (np.arange(image.shape[0]) + 0.5) * pixel_pitch
+    cols = np.round((centres_x - x_ax[0]) / pitch_x).astype(int)
+    rows = (len(y_ax) - 1) - np.round((centres_y - y_ax[0]) / pitch_y).astype(int)  # rows run from y max to y min
+    col_ok = (cols >= 0) & (cols < len(x_ax))
+    row_ok = (rows >= 0) & (rows < len(y_ax))
+    if not col_ok.any() or not row_ok.any():
+        return
+    sampled = result[rows[row_ok][:, np.newaxis], cols[col_ok][np.newaxis, :]]
+    image[np.ix_(row_ok, col_ok)] = apply_colormap(sampled, count_limits[0], count_limits[1], colormap)
+
+
+def draw_outlines(image, geometry, x_min, y_max, pixel_pitch, line_width=1):
+    segments, entities = geometry.segments(max_error=pixel_pitch / 4.)
+    columns = (segments[:, :, 0] - x_min) / pixel_pitch - 0.5
+    rows = (y_max - segments[:, :, 1]) / pixel_pitch - 0.5
+    n_samples = np.ceil(2 * np.hypot(columns[:, 1] - columns[:, 0], rows[:, 1] - rows[:, 0])).astype(int) + 1
+    segment = np.repeat(np.arange(segments.shape[0]), n_samples)
+    first = np.cumsum(n_samples) - n_samples
+    t = (np.arange(segment.size) - first[segment]) / np.maximum(n_samples[segment] - 1, 1).astype(float)
+    sample_cols = np.round(columns[segment, 0] + t * (columns[segment, 1] - columns[segment, 0])).astype(int)
+    sample_rows = np.round(rows[segment, 0] + t * (rows[segment, 1] - rows[segment, 0])).astype(int)
+    colors = np.concatenate([geometry.rgb(), np.full((len(geometry), 1), 255, dtype=np.uint8)], axis=1)
+    sample_colors = colors[entities[segment]]
+    low = -(line_width // 2)
+    for d_row in range(low, low + line_width):
+        for d_col in range(low, low + line_width):
+            r, c = sample_rows + d_row, sample_cols + d_col
+            inside = (r >= 0) & (r < image.shape[0]) & (c >= 0) & (c < image.shape[1])
+            image[r[inside], c[inside]] = sample_colors[inside]
+
+
+def write_png(file_name, image, compression=1):
+    """ Writes an RGBA uint8 image as PNG, compression level 0 to 9. """
+    height, width = image.shape[:2]
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)  # filter byte 0 in front of every row
+    raw[:, 1:] = image.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(file_name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), compression)))
+        f.write(chunk(b'IEND', b''))
+
+
+def write_tiff(file_name, image, pixel_pitch=None):
+    """ Writes an RGBA uint8 image as uncompressed TIFF, with the pixel pitch in um as resolution if given. """
+    height, width = image.shape[:2]
+    n_tags = 14 if pixel_pitch else 11
+    ifd_size = 2 + 12 * n_tags + 4
+    bits_offset = 8 + ifd_size
+    resolution_offset = bits_offset + 8
+    data_offset = resolution_offset + 16
+    tags = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 4, bits_offset), (259, 3, 1, 1), (262, 3, 1, 2),
+            (273, 4, 1, data_offset), (277, 3, 1, 4), (278, 4, 1, height), (279, 4, 1, image.nbytes),
+            (284, 3, 1, 1), (338, 3, 1, 2)]  # uncompressed RGB, one strip, unassociated alpha
+    if pixel_pitch:
+        tags += [(282, 5, 1, resolution_offset), (283, 5, 1, resolution_offset + 8), (296, 3, 1, 3)]  # per cm
+    pixels_per_cm = min(int(round(1e7 / pixel_pitch)), 2 ** 32 - 1) if pixel_pitch else 0  # in 1/1000
+    with open(file_name, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, 8))
+        f.write(struct.pack('<H', n_tags))
+        for tag, field_type, count, value in sorted(tags):
+            value = struct.pack('<HH', value, 0) if field_type == 3 and count == 1 else struct.pack('<I', value)
+            f.write(struct.pack('<HHI', tag, field_type, count) + value)
+        f.write(struct.pack('<I', 0))
+        f.write(struct.pack('<4H', 8, 8, 8, 8))
+        f.write(struct.pack('<4I', pixels_per_cm, 1000, pixels_per_cm, 1000))
+        f.write(np.ascontiguousarray(image).tobytes())
+
+
+def write_image(file_name, image, pixel_pitch=None):
+    """ Writes image as TIFF for .tif and .tiff file names, else as PNG. Returns the file name used. """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in ['.tif', '.tiff']:
+        write_tiff(file_name, image, pixel_pitch)
+    else:
+        if extension != '.png':
+            file_name += '.png'
+        write_png(file_name, image)
+    return file_name
+
+
+def export_overlays(scan_names, geometry, directory, view=None, count_limits=None, percentiles=None, **kwargs):
+    """ Renders a series of scans with the same layout and writes one image per scan into directory.
+
+        Args:
+            scan_names (list of string): File names of the mat files.
+            geometry (DXFGeometry): Layout drawn over every scan.
+            directory (string): Output directory, images are named after the scans.
+            view (function): Returns the MatFile to render for a loaded MatFile, e.g. its transformed view.
+            count_limits (list): Fixed [min, max] counts for all scans. Default per scan, see percentiles.
+            percentiles (list): [lower, upper] count percentiles of each scan if count_limits is None, None for the
+                full range.
+
+        Keyword Args:
+            file_type (string): 'png' or 'tif'. Default 'png'.
+            All other keyword arguments of render_overlay.
+
+        Returns:
+            list of string: Written file names.
+    """
+    file_type = kwargs.pop('file_type', 'png')
+    written = []
+    mat_file = MatFile()
+    for scan_name in scan_names:
+        mat_file.load(None, file_name=scan_name)
+        rendered = view(mat_file) if view else mat_file
+        image = render_overlay(rendered, geometry, count_limits or rendered.count_limits(percentiles), **kwargs)
+        base_name = os.path.splitext(os.path.basename(scan_name))[0]
+        written.append(write_image(os.path.join(directory, '{0}.{1}'.format(base_name, file_type)), image,
+                                   kwargs.get('pixel_pitch')))
+    if mat_file.stack is not None:
+        mat_file.stack.close()
+    return written
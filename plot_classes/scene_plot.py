@@ -0,0 +1,474 @@
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5 import QtWidgets, QtGui, QtCore
+
+from plot_classes.event_coalescer import EventCoalescer
+from utility.color_lut import apply_colormap
+from utility.xterm_hex_conv import xterm_to_hex
+from utility.config import paths
+from utility.profiling import timed
+
+TILE_SEGMENTS = 4096  # segments per item, the unit of culling and of the render cache
+# kB of item caches, set once by MainWindow, the default 10 MB are rendered again every frame for large layouts
+PIXMAP_CACHE = 256 * 1024
+MOUSE_BUTTONS = {QtCore.Qt.LeftButton: 1, QtCore.Qt.MiddleButton: 2, QtCore.Qt.RightButton: 3}
+
+
+def polygon(points):
+    """ Returns a QPolygonF of the points of an (n, 2) array, copied straight into its buffer. """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    poly = QtGui.QPolygonF(len(points))
+    if len(points):
+        buffer = poly.data()
+        buffer.setsize(points.nbytes)
+        np.frombuffer(buffer, np.float64)[:] = points.ravel()
+    return poly
+
+
+def marker_path(kind, size):
+    """ Returns the outline of a marker of size pixels centered at the origin, kinds as in ColorPlot.snap_markers. """
+    half = size / 2.
+    path = QtGui.QPainterPath()
+    if kind == 's':
+        path.addRect(-0.8 * half, -0.8 * half, 1.6 * half, 1.6 * half)
+    elif kind == 'o':
+        path.addEllipse(QtCore.QPointF(0, 0), 0.8 * half, 0.8 * half)
+    elif kind == '^':
+        path.addPolygon(polygon([[0, -half], [0.87 * half, 0.5 * half], [-0.87 * half, 0.5 * half]]))
+        path.closeSubpath()
+    elif kind == 'x':
+        for sign in (1, -1):
+            path.moveTo(-0.7 * half, -sign * 0.7 * half)
+            path.lineTo(0.7 * half, sign * 0.7 * half)
+    else:
+        path.moveTo(-half, 0)
+        path.lineTo(half, 0)
+        path.moveTo(0, -half)
+        path.lineTo(0, half)
+    return path
+
+
+def cosmetic_pen(color, linewidth=1.):
+    """ Returns a pen of linewidth pixels at every zoom. """
+    pen = QtGui.QPen(QtGui.QColor(color))
+    pen.setCosmetic(True)
+    pen.setWidthF(linewidth if linewidth != 1. else 0.)  # width 0 draws the fast one pixel lines
+    return pen
+
+
+class SegmentItem(QtWidgets.QGraphicsItem):
+    """ Straight segments of one layer and color in one tile of the scene, drawn with a single drawLines call.
+
+        Attributes:
+            lines (QPolygonF): Start and end point of each segment.
+            rect (QRectF): Bounding box of all segments, used by the scene index to cull the item.
+            pen (QPen): Cosmetic pen of all segments.
+    """
+    def __init__(self, segments, pen):
+        super(SegmentItem, self).__init__()
+        points = segments.reshape(-1, 2)
+        low, high = points.min(axis=0), points.max(axis=0)
+        pad = 1e-3 * max(high[0] - low[0], high[1] - low[1], 1e-6)  # horizontal or vertical lines have no area
+        self.rect = QtCore.QRectF(low[0] - pad, low[1] - pad, high[0] - low[0] + 2 * pad, high[1] - low[1] + 2 * pad)
+        self.lines = polygon(points)
+        self.pen = pen
+        self.setCacheMode(QtWidgets.QGraphicsItem.DeviceCoordinateCache)
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self.pen)
+        painter.drawLines(self.lines)
+
+
+class ImageItem(QtWidgets.QGraphicsItem):
+    """ RGBA scan placed in data coordinates by its item transform, row 0 at the top like imshow.
+
+        Attributes:
+            buffer (np.array): Pixels of the image, kept alive as long as the QImage uses them.
+            image (QImage): Image drawn, sharing the memory of buffer.
+    """
+    def __init__(self, buffer, extent):
+        super(ImageItem, self).__init__()
+        self.buffer = buffer
+        height, width = buffer.shape[:2]
+        self.image = QtGui.QImage(buffer.data, width, height, 4 * width, QtGui.QImage.Format_RGBA8888)
+        left, right, bottom, top = extent
+        self.setTransform(QtGui.QTransform((right - left) / width, 0, 0, -(top - bottom) / height, left, top))
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self.image.width(), self.image.height())
+
+    def paint(self, painter, option, widget=None):
+        painter.drawImage(0, 0, self.image)
+
+
+class CanvasEvent(object):
+    """ Mouse event of the ScenePlot with the attributes of the matplotlib events used by the widgets.
+
+        Attributes:
+            name (string): Matplotlib name of the event, e.g. 'button_press_event'.
+            x, y (int): Position in pixels of the canvas.
+            xdata, ydata (float): Position in data coordinates.
+            button: 1, 2 or 3 for mouse buttons, 'up' or 'down' for the wheel, None for moves.
+            step (float): Wheel steps, positive up.
+    """
+    def __init__(self, name, x, y, xdata, ydata, button=None, step=0.):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.xdata = xdata
+        self.ydata = ydata
+        self.button = button
+        self.step = step
+
+
+# noinspection PyAttributeOutsideInit, PyArgumentList
+class ScenePlot(QtWidgets.QGraphicsView):
+    """ Retained mode canvas on a QGraphicsScene with the drawing interface of ColorPlot.
+
+        The layout is split into items of at most TILE_SEGMENTS segments of one layer, color and spatial tile. The
+        scene culls them with its BSP index and every item caches its pixels in device coordinates, so panning blits
+        cached tiles and zooming paints only the visible ones, without any Python per segment. Items are built again
+        only when the geometry, the selection or the scan changed, layers are hidden and recolored on their items.
+        The scan is one QImage item placed by its transform, the colormap is applied again only when the scan, count
+        limits or colormap changed.
+
+        The view shows plot_limits stretched to the viewport like the auto aspect of matplotlib, without axes.
+        Mouse events are passed to callbacks registered with mpl_connect as CanvasEvent with matplotlib names.
+    """
+    snap_markers = {'vertex': 's', 'midpoint': '^', 'centre': 'o', 'intersection': 'x', 'grid': '+'}
+
+    def __init__(self, parent=None):
+        scene = QtWidgets.QGraphicsScene()
+        scene.setItemIndexMethod(QtWidgets.QGraphicsScene.BspTreeIndex)
+        super(ScenePlot, self).__init__(scene, parent)
+        scene.setParent(self)
+        self.setBackgroundBrush(QtGui.QBrush(QtCore.Qt.white))
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setFrameShape(QtWidgets.QFrame.NoFrame)
+        self.setOptimizationFlags(QtWidgets.QGraphicsView.DontSavePainterState |
+                                  QtWidgets.QGraphicsView.DontAdjustForAntialiasing)
+        self.setMouseTracking(True)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        self.callbacks = {}  # matplotlib event name -> list of callbacks
+        self.coalescer = EventCoalescer(parent=self)
+        self.compute_initial_figure()
+
+    def compute_initial_figure(self):
+        self.plot_limits = [[0, 100], [0, 100]]
+        self.plot_limits_fixed = False
+        self.count_limits = [0, 1e5]
+        self.count_limits_fixed = False
+        self.count_percentiles = None  # [lower, upper] in percent for automatic contrast, None for full range
+        self.colormap = 'tum_jet'
+        self.mat = None
+        self.dxf = None
+        self.dxf_color = None  # color index of all entities of dxf, None for their own colors
+        self.layer_artists = OrderedDict()  # layer name -> (items, entity of each segment) of dxf
+        self.geometry = None
+        self.markers = None
+        self.selection = None  # handles of selected dxf entities
+        self.scan_item = None
+        self.scan_key = None  # scan, result array, count limits and colormap of scan_item
+        self.drawn_dxf = None  # geometry and color drawn in layer_artists
+        self.dxf_segments = None  # (segments, entities) of drawn_dxf
+        self.layer_colors = {}  # layer name -> color of each segment in layer_artists, to find recolored layers
+        self.selection_items = OrderedDict()
+        self.drawn_selection = None
+        self.geometry_items = OrderedDict()
+        self.drawn_geometry = None
+        self.marker_items = []
+        self.snap_marker = QtWidgets.QGraphicsPathItem()
+        self.snap_marker.setPen(cosmetic_pen('#ff00ff', 1.5))
+        self.snap_marker.setFlag(QtWidgets.QGraphicsItem.ItemIgnoresTransformations)
+        self.snap_marker.setZValue(4)
+        self.snap_marker.hide()
+        self.scene().addItem(self.snap_marker)
+
+    def minimumSizeHint(self):
+        return QtCore.QSize(100, 100)
+
+    def mpl_connect(self, name, callback):
+        """ Calls callback with a CanvasEvent for every event of name, the matplotlib names of the mouse events. """
+        self.callbacks.setdefault(name, []).append(callback)
+        return len(self.callbacks[name]) - 1
+
+    def emit(self, name, position, **kwargs):
+        point = self.mapToScene(position)
+        event = CanvasEvent(name, position.x(), position.y(), point.x(), point.y(), **kwargs)
+        for callback in self.callbacks.get(name, []):
+            callback(event)
+
+    def mousePressEvent(self, event):
+        self.emit('button_press_event', event.pos(), button=MOUSE_BUTTONS.get(event.button()))
+
+    def mouseReleaseEvent(self, event):
+        self.emit('button_release_event', event.pos(), button=MOUSE_BUTTONS.get(event.button()))
+
+    def mouseMoveEvent(self, event):
+        self.emit('motion_notify_event', event.pos())
+
+    def wheelEvent(self, event):
+        step = event.angleDelta().y() / 120.
+        if step:
+            self.emit('scroll_event', event.pos(), button='up' if step > 0 else 'down', step=step)
+
+    def resizeEvent(self, event):
+        super(ScenePlot, self).resizeEvent(event)
+        self.show_limits()
+
+    def pixel_size(self):
+        """ Width of a pixel in data units. """
+        return abs(self.plot_limits[0][1] - self.plot_limits[0][0]) / max(self.viewport().width(), 1)
+
+    def show_limits(self):
+        """ Scales the view so that plot_limits fill the viewport, y pointing up. """
+        (x0, x1), (y0, y1) = self.plot_limits
+        if x0 == x1 or y0 == y1:
+            return
+        viewport = self.viewport()
+        self.setTransform(QtGui.QTransform(viewport.width() / float(x1 - x0), 0, 0,
+                                           -viewport.height() / float(y1 - y0), 0, 0))
+        # a scene rect of exactly the limits leaves nothing to scroll and is centered in the viewport
+        self.setSceneRect(QtCore.QRectF(min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0)))
+        self.centerOn((x0 + x1) / 2., (y0 + y1) / 2.)
+
+    def remove_items(self, items):
+        for item in items:
+            self.scene().removeItem(item)
+
+    @timed('draw_canvas.imshow')
+    def draw_mat(self, mat_file):
+        if not self.count_limits_fixed:
+            self.count_limits = mat_file.count_limits(self.count_percentiles)
+        if not self.plot_limits_fixed:
+            self.plot_limits = [[mat_file.graph['x'][0, 0], mat_file.graph['x'][0, -1]],
+                                [mat_file.graph['y'][0, 0], mat_file.graph['y'][0, -1]]]
+        if hasattr(mat_file, 'set_view'):  # mosaics are read for the visible region at the resolution of the canvas
+            mat_file.set_view(self.plot_limits[0], self.plot_limits[1], max(self.width(), self.height()))
+        key = (mat_file, mat_file.graph['result'], tuple(self.count_limits), self.colormap)
+        if self.scan_key is not None and key[0] is self.scan_key[0] and key[1] is self.scan_key[1] and \
+                key[2:] == self.scan_key[2:]:
+            return
+        self.clear_mat()
+        buffer = np.empty(mat_file.graph['result'].shape + (4,), dtype=np.uint8)  # owned by the image item
+        apply_colormap(mat_file.graph['result'], self.count_limits[0], self.count_limits[1], self.colormap, out=buffer)
+        self.scan_item = ImageItem(buffer, (mat_file.graph['x'][0, 0], mat_file.graph['x'][0, -1],
+                                            mat_file.graph['y'][0, 0], mat_file.graph['y'][0, -1]))
+        self.scene().addItem(self.scan_item)
+        self.scan_key = key
+
+    def clear_mat(self):
+        if self.scan_item is not None:
+            self.scene().removeItem(self.scan_item)
+        self.scan_item = None
+        self.scan_key = None
+
+    @timed('draw_canvas.layers')
+    def draw_dxf(self, dxf_file, **kwargs):
+        """ Builds the items of each layer, or only applies visibility and colors if the geometry was drawn before. """
+        self.dxf_color = kwargs.get('dxf_color', None)
+        geometry = dxf_file.geometry()
+        if self.drawn_dxf is not None and self.drawn_dxf[0] is geometry and self.drawn_dxf[1] == self.dxf_color:
+            self.update_layers()
+            return
+        self.clear_dxf()
+        self.dxf_segments = self.segments(geometry)
+        self.layer_artists = self.draw_geometry(geometry, color=self.dxf_color,
+                                                hidden=getattr(dxf_file, 'hidden_layers', ()),
+                                                segments=self.dxf_segments)
+        self.layer_colors = {name: geometry.colors[entities] for name, (_, entities) in self.layer_artists.items()}
+        self.drawn_dxf = (geometry, self.dxf_color)
+
+    def clear_dxf(self):
+        for items, _ in self.layer_artists.values():
+            self.remove_items(items)
+        self.layer_artists = OrderedDict()
+        self.drawn_dxf = None
+        self.dxf_segments = None
+
+    def segments(self, geometry):
+        """ Segments of a geometry for every zoom, circles within a 65536th of the extent, a pixel of a 1000 pixel view
+            magnified 64 times. """
+        if not len(geometry):
+            return np.zeros((0, 2, 2)), np.zeros(0, dtype=int)
+        bounds = geometry.bounds()
+        extent = max(bounds[:, 2].max() - bounds[:, 0].min(), bounds[:, 3].max() - bounds[:, 1].min(), 1e-9)
+        return geometry.segments(max_error=extent / 2 ** 16)
+
+    @timed('draw_canvas.geometry')
+    def draw_geometry(self, geometry, handles=None, color=None, linewidth=1., hidden=(), segments=None, z=1.):
+        """ Adds the outlines of a DXFGeometry as items of one layer, color and tile each.
+
+            Args:
+                geometry (DXFGeometry): Entities to draw.
+                handles (set): Draw only the entities of these handles, default all.
+                color (int): Color index of all entities, default the colors of the geometry.
+                linewidth (float): Width of all lines in pixels.
+                hidden (set): Names of layers drawn invisible.
+                segments (tuple): (segments, entities) of geometry, default computed.
+                z (float): Stacking order of the items, the scan is at 0.
+
+            Returns:
+                OrderedDict: Layer name -> (items, entity number of each of their segments).
+        """
+        artists = OrderedDict()
+        if not len(geometry):
+            return artists
+        segments, entities = self.segments(geometry) if segments is None else segments
+        if handles is not None:
+            keep = np.array([h in handles for h in geometry.handles], dtype=bool)[entities]
+            segments, entities = segments[keep], entities[keep]
+        if not len(entities):
+            return artists
+        if color is None:
+            rgb = geometry.rgb().astype(int)
+            packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        else:
+            packed = np.full(len(geometry), int(xterm_to_hex(color)[1:], 16), dtype=int)
+        middles = segments.mean(axis=1)
+        low, high = middles.min(axis=0), middles.max(axis=0)
+        n_tiles = int(np.ceil(np.sqrt(len(entities) / float(TILE_SEGMENTS))))
+        cells = np.clip(((middles - low) / np.maximum(high - low, 1e-12) * n_tiles).astype(int), 0, n_tiles - 1)
+        layers, colors, tiles = geometry.layers[entities], packed[entities], cells[:, 0] * n_tiles + cells[:, 1]
+        order = np.lexsort((tiles, colors, layers))
+        segments, entities = segments[order], entities[order]
+        layers, colors, tiles = layers[order], colors[order], tiles[order]
+        changes = (np.diff(layers) != 0) | (np.diff(colors) != 0) | (np.diff(tiles) != 0)
+        starts = np.concatenate([[0], np.flatnonzero(changes) + 1, [len(entities)]])
+        pens = {}
+        for start, stop in zip(starts[:-1].tolist(), starts[1:].tolist()):
+            while stop - start > 0:  # tiles of dense regions are split further
+                end = min(stop, start + TILE_SEGMENTS)
+                name = geometry.layer_names[layers[start]]
+                if colors[start] not in pens:
+                    pens[colors[start]] = cosmetic_pen('#{0:06x}'.format(colors[start]), linewidth)
+                item = SegmentItem(segments[start:end], pens[colors[start]])
+                item.setZValue(z)
+                item.setVisible(name not in hidden)
+                self.scene().addItem(item)
+                artists.setdefault(name, ([], []))[0].append(item)
+                artists[name][1].append(entities[start:end])
+                start = end
+        return OrderedDict((name, (items, np.concatenate(parts))) for name, (items, parts) in artists.items())
+
+    def update_layers(self):
+        """ Applies the visibility and colors of the layers of the drawn dxf file to their items. Only the items of
+            recolored layers are built again. """
+        if not self.dxf or self.drawn_dxf is None:
+            return
+        geometry = self.drawn_dxf[0]
+        colors = geometry.colors
+        for name, (items, entities) in list(self.layer_artists.items()):
+            visible = self.dxf.layer_visible(name)
+            if self.dxf_color is None and not np.array_equal(colors[entities], self.layer_colors[name]):
+                self.remove_items(items)
+                segments, all_entities = self.dxf_segments
+                keep = geometry.layers[all_entities] == geometry.layer_names.index(name)
+                self.layer_artists.update(self.draw_geometry(geometry, segments=(segments[keep], all_entities[keep]),
+                                                             hidden=() if visible else (name,)))
+            else:
+                for item in items:
+                    item.setVisible(visible)
+            for item in self.selection_items.get(name, ([], None))[0]:
+                item.setVisible(visible)
+        self.layer_colors = {name: colors[entities] for name, (_, entities) in self.layer_artists.items()}
+
+    @timed('draw_canvas.selection')
+    def draw_selection(self, dxf_file, selection):
+        key = (self.drawn_dxf[0], tuple(selection))
+        if self.drawn_selection == key:
+            return
+        self.clear_selection()
+        self.selection_items = self.draw_geometry(dxf_file.geometry(), handles=set(selection), color=0,
+                                                  linewidth=2.5, hidden=getattr(dxf_file, 'hidden_layers', ()),
+                                                  segments=self.dxf_segments, z=2.)
+        self.drawn_selection = key
+
+    def clear_selection(self):
+        for items, _ in self.selection_items.values():
+            self.remove_items(items)
+        self.selection_items = OrderedDict()
+        self.drawn_selection = None
+
+    def clear_geometry(self):
+        for items, _ in self.geometry_items.values():
+            self.remove_items(items)
+        self.geometry_items = OrderedDict()
+        self.drawn_geometry = None
+
+    @timed('draw_canvas.markers')
+    def draw_markers(self, markers):
+        path, pen = marker_path('+', 15), cosmetic_pen('#000000')
+        for pt in markers:
+            item = QtWidgets.QGraphicsPathItem(path)
+            item.setPen(pen)
+            item.setFlag(QtWidgets.QGraphicsItem.ItemIgnoresTransformations)
+            item.setPos(pt[0], pt[1])
+            item.setZValue(3)
+            self.scene().addItem(item)
+            self.marker_items.append(item)
+
+    @timed('draw_canvas')
+    def draw_canvas(self, **kwargs):
+        """ Same arguments as ColorPlot.draw_canvas, show_axes is ignored as the scene has no axes. """
+        self.plot_limits = kwargs.get('plot_limits', self.plot_limits)
+        self.mat = kwargs.get('mat', self.mat)
+        self.dxf = kwargs.get('dxf', self.dxf)
+        self.geometry = kwargs.get('geometry', self.geometry)
+        self.markers = kwargs.get('markers', self.markers)
+        self.selection = kwargs.get('selection', self.selection)
+        dxf_color = kwargs.get('dxf_color', None)
+        if self.mat:
+            self.draw_mat(self.mat)
+        else:
+            self.clear_mat()
+        if self.dxf:
+            self.draw_dxf(self.dxf, dxf_color=dxf_color)
+        else:
+            self.clear_dxf()
+        if self.dxf and self.selection:
+            self.draw_selection(self.dxf, self.selection)
+        else:
+            self.clear_selection()
+        if self.geometry is not self.drawn_geometry:
+            self.clear_geometry()
+            if self.geometry:
+                self.geometry_items = self.draw_geometry(self.geometry, z=1.5)
+                self.drawn_geometry = self.geometry
+        self.remove_items(self.marker_items)
+        self.marker_items = []
+        if self.markers:
+            self.draw_markers(self.markers)
+        self.show_limits()
+
+    def set_plot_limits(self, plot_limits):
+        """ Changes only the view transform, the cached items are reused for the next paint. """
+        self.plot_limits = plot_limits
+        if hasattr(self.mat, 'set_view'):
+            self.coalescer.post('draw', self.draw_canvas)  # the visible part of a mosaic is read again
+        else:
+            self.show_limits()
+
+    def show_snap(self, position, kind=None):
+        """ Moves the snap marker to position, or hides it for None. Only the region of the marker is painted. """
+        if position is None:
+            self.snap_marker.hide()
+            return
+        self.snap_marker.setPath(marker_path(self.snap_markers.get(kind, '+'), 12))
+        self.snap_marker.setPos(position[0], position[1])
+        self.snap_marker.show()
+
+    def update_canvas(self, **kwargs):
+        pass
+
+    def save(self, parent):
+        fname = QtWidgets.QFileDialog.getSaveFileName(parent, 'Save File', paths['registration'],
+                                                      "Portable network graphics (*.png)")[0]
+        if not fname:  # capture cancel in dialog
+            return
+        self.viewport().grab().save(fname)
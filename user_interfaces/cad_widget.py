@@ -1,35 +1,54 @@
-import copy
+import logging
 import numpy as np
 import os
+import time
 from PyQt5 import QtWidgets, QtGui, QtCore
 from scipy import optimize as opt
 
 from plot_classes.color_plot import ColorPlot
+from plot_classes.scene_plot import ScenePlot
+from plot_classes.raster_export import export_overlays, render_overlay, write_image
 from helper_classes.dwg_xch_file import DwgXchFile
+from helper_classes.mosaic import Mosaic, MosaicView
+from helper_classes.snap_engine import SNAP_KINDS
 from helper_classes.stack import Stack
+from helper_classes.template_matcher import TemplateMatcher
 from utility.config import paths
-from utility.utility_functions import affine_trafo, distance, kd_nearest, two_d_gaussian_sym
+from utility.profiling import timer
+from utility.trafo_fit import fit_trafo
+from utility.warp import WARP_MODELS, compose, fit_warp
+from utility.utility_functions import distance, two_d_gaussian_sym
 from user_interfaces.grid_dialog import GridDialog
-from user_interfaces.layer_dialog import LayerDialog
+from user_interfaces.layer_dialog import LayerDialog, LayerSelectDialog
 from user_interfaces.stencil_dialog import StencilDialog
+from user_interfaces.trafo_dialog import TrafoDialog
 
 
 # noinspection PyAttributeOutsideInit
 # noinspection PyArgumentList
 class CADWidget(QtWidgets.QWidget):
-    def __init__(self, action, window_number, logger, parent=None):
+    def __init__(self, action, window_number, logger, trafo_store, parent=None):
         super(CADWidget, self).__init__(parent)
         self.window_number = window_number
         self.logger = logger
+        self.trafo_store = trafo_store
+        self.trafo_name = None
         self.grid = [False, 1, 0.1]
+        self.snap_kinds = list(SNAP_KINDS)  # object snaps used for picking, empty to snap to the grid only
+        self.trafo_settings = ['affine', 'none', 1., 3, 0.]  # model, outlier rejection, threshold, order, smoothing
+        self.trafo = None
         self.pick_stack = Stack()
         self.object_stack = Stack()
         self.stencil = None
         self.layer = None
         self.mode = 'pick_free'
         self.tool = 'free_select'
+        self.press_position = None  # data coordinates of the last button press, start of box and lasso selection
+        self.lasso = []
         self.mat = None
         self.mat_file = None
+        self.match_settings = [0.7, 0.2]  # smallest normalized cross-correlation, psf sigma of the scan in um
+        self.clearance = 0.  # minimum spacing in um checked for stencil placements, 0 for overlaps only
 
         free_select_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'free_select.png')),
                                             'Free select tool', self)
@@ -63,6 +82,11 @@ class CADWidget(QtWidgets.QWidget):
         measure_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'measure.png')),
                                         'Measure', self)
         measure_btn.triggered.connect(self.measure)
+        self.snap_btn = QtWidgets.QAction('Snap', self)
+        self.snap_btn.setToolTip('Snap to vertices, midpoints, circle centres and intersections')
+        self.snap_btn.setCheckable(True)
+        self.snap_btn.setChecked(True)
+        self.snap_btn.triggered.connect(self.set_snap)
         color_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'palette.png')),
                                       'Select color', self)
         color_btn.triggered.connect(self.select_color)
@@ -75,6 +99,19 @@ class CADWidget(QtWidgets.QWidget):
         transform_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'transform.png')),
                                           'Transform', self)
         transform_btn.triggered.connect(self.transform)
+        self.overlay_btn = QtWidgets.QAction('Overlay on scan', self)
+        self.overlay_btn.setToolTip('Show the layout on the untransformed scan, with the inverse affine transformation')
+        self.overlay_btn.setCheckable(True)
+        self.overlay_btn.triggered.connect(self.overlay_on_scan)
+        build_mosaic_btn = QtWidgets.QAction('Build mosaic', self)
+        build_mosaic_btn.setToolTip('Composite registered scans into one image in layout coordinates')
+        build_mosaic_btn.triggered.connect(self.build_mosaic)
+        open_mosaic_btn = QtWidgets.QAction('Open mosaic', self)
+        open_mosaic_btn.setToolTip('Show a mosaic built before under the layout')
+        open_mosaic_btn.triggered.connect(self.open_mosaic)
+        trafo_settings_btn = QtWidgets.QAction('Trafo settings', self)
+        trafo_settings_btn.setToolTip('Set transformation model and outlier rejection')
+        trafo_settings_btn.triggered.connect(self.set_trafo_settings)
         pick_free_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'pick_free.png')),
                                           'Pick free point', self)
         pick_free_btn.triggered.connect(self.pick_free)
@@ -87,6 +124,16 @@ class CADWidget(QtWidgets.QWidget):
         pick_peak_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'pick_peak.png')),
                                           'Pick peak in image', self)
         pick_peak_btn.triggered.connect(self.pick_peak)
+        find_stencils_btn = QtWidgets.QAction('Find stencils', self)
+        find_stencils_btn.setToolTip('Search the scan for stencils and mark their positions')
+        find_stencils_btn.triggered.connect(self.find_stencils)
+        clearance_btn = QtWidgets.QAction('Check clearance', self)
+        clearance_btn.setToolTip('Select all objects overlapping or closer than a minimum spacing')
+        clearance_btn.triggered.connect(self.check_clearance)
+        scene_btn = QtWidgets.QAction('Qt canvas', self)
+        scene_btn.setToolTip('Draw on a retained Qt scene, panning and zooming large layouts without redrawing them')
+        scene_btn.setCheckable(True)
+        scene_btn.triggered.connect(self.set_scene_canvas)
 
         self.toolbar = QtWidgets.QToolBar("Draw")
         self.toolbar.addAction(free_select_btn)
@@ -98,23 +145,28 @@ class CADWidget(QtWidgets.QWidget):
         self.toolbar.addAction(stencil_btn)
         self.toolbar.addSeparator()
         self.toolbar.addAction(grid_btn)
+        self.toolbar.addAction(self.snap_btn)
         self.toolbar.addAction(measure_btn)
         self.toolbar.addSeparator()
         self.toolbar.addAction(color_btn)
         self.toolbar.addAction(sel_stencil_btn)
         self.toolbar.addAction(layer_btn)
+        self.toolbar.addAction(clearance_btn)
+        self.toolbar.addAction(scene_btn)
         self.toolbar.addSeparator()
         self.toolbar.addAction(transform_btn)
+        self.toolbar.addAction(trafo_settings_btn)
+        self.toolbar.addAction(self.overlay_btn)
+        self.toolbar.addAction(build_mosaic_btn)
+        self.toolbar.addAction(open_mosaic_btn)
         self.toolbar.addSeparator()
         self.toolbar.addAction(pick_free_btn)
         self.toolbar.addAction(pick_node_btn)
         self.toolbar.addAction(pick_object_btn)
         self.toolbar.addAction(pick_peak_btn)
+        self.toolbar.addAction(find_stencils_btn)
 
-        self.canvas = ColorPlot(self)
-        self.canvas.mpl_connect('scroll_event', self.mouse_wheel)
-        self.canvas.mpl_connect('button_release_event', self.mouse_released)
-        self.canvas.mpl_connect('motion_notify_event', self.mouse_moved)
+        self.canvas = self.make_canvas(ColorPlot)
 
         self.status_bar = QtWidgets.QStatusBar()
 
@@ -130,7 +182,8 @@ class CADWidget(QtWidgets.QWidget):
             self.logger.add_to_log("New dxf.")
         elif action == "Open":
             self.dxf_file = DwgXchFile()
-            self.dxf_file.load(self, file_type='standard')
+            self.dxf_file.load(self, file_type='standard',
+                               select_layers=lambda names: LayerSelectDialog(names, self).exec_())
             self.canvas.draw_canvas(dxf=self.dxf_file)
             self.logger.add_to_log("Open dxf.")
         elif action == "Open Template":
@@ -174,11 +227,37 @@ class CADWidget(QtWidgets.QWidget):
         else:
             self.logger.add_to_log("Grid not active.")
 
+    def set_snap(self, active):
+        self.snap_kinds = list(SNAP_KINDS) if active else []
+        self.logger.add_to_log("Object snap {0}.".format('active' if active else 'not active'))
+
+    def make_canvas(self, canvas_class):
+        canvas = canvas_class(self)
+        canvas.mpl_connect('scroll_event', self.mouse_wheel)
+        canvas.mpl_connect('button_press_event', self.mouse_pressed)
+        canvas.mpl_connect('button_release_event', self.mouse_released)
+        canvas.mpl_connect('motion_notify_event', lambda event: canvas.coalescer.post('move', self.mouse_moved, event))
+        return canvas
+
+    def set_scene_canvas(self, active):
+        """ Replaces the matplotlib canvas by the Qt scene canvas or back, keeping view, contrast and contents. """
+        old = self.canvas
+        self.canvas = self.make_canvas(ScenePlot if active else ColorPlot)
+        for name in ['plot_limits', 'plot_limits_fixed', 'count_limits', 'count_limits_fixed', 'count_percentiles',
+                     'colormap']:
+            setattr(self.canvas, name, getattr(old, name))
+        old.coalescer.timer.stop()
+        self.layout().replaceWidget(old, self.canvas)
+        old.deleteLater()
+        self.canvas.draw_canvas(mat=old.mat, dxf=old.dxf, geometry=old.geometry, markers=old.markers,
+                                selection=old.selection)
+        self.logger.add_to_log("Drawing on the {0} canvas.".format('Qt' if active else 'matplotlib'))
+
     def measure(self):
         self.tool = 'measure'
         self.pick_stack.empty()
         self.object_stack.empty()
-        self.canvas.draw_canvas(markers=self.pick_stack.items)
+        self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
 
     def select_color(self):
         self.color = QtWidgets.QColorDialog.getColor().name()
@@ -193,9 +272,66 @@ class CADWidget(QtWidgets.QWidget):
             self.logger.add_to_log("Active stencil: {0}".format(stencil_name))
 
     def set_layer(self):
-        self.layer = LayerDialog(self.layer, self.dxf_file, self).exec_()
+        layer_dialog = LayerDialog(self.layer, self.dxf_file, self)
+        layer_dialog.layers_changed.connect(self.canvas.update_layers)
+        self.layer = layer_dialog.exec_()
         self.logger.add_to_log("Active layer: {0}".format(self.layer))
-        # TODO: set layer properties in addition to displaying them
+
+    def check_clearance(self):
+        clearance, ok = QtWidgets.QInputDialog.getDouble(self, 'Check clearance', 'Minimum spacing in um:',
+                                                         self.clearance, 0., 1e4, 3)
+        if not ok:
+            return
+        self.clearance = clearance
+        start = time.time()
+        checker = self.dxf_file.clearance_checker()
+        visible = [name for name in checker.geometry.layer_names if self.dxf_file.layer_visible(name)]
+        conflicts = checker.check(clearance, layers=visible)
+        self.object_stack.empty()
+        for i, (first, second, dist) in enumerate(zip(conflicts.first.tolist(), conflicts.second.tolist(),
+                                                      conflicts.distances.tolist())):
+            for handle in (checker.handles[first], checker.handles[second]):
+                if handle not in self.object_stack.items:
+                    self.object_stack.push(handle)
+            if i < 20:  # the rest is only selected
+                self.logger.add_to_log("Clearance {0} - {1}: {2:.3f} um.".format(
+                    checker.handles[first], checker.handles[second], dist), logging.WARNING)
+        self.logger.add_to_log("{0} conflicts closer than {1:g} um among {2} objects in {3:.2f} s.".format(
+            len(conflicts.first), clearance, len(checker), time.time() - start))
+        self.canvas.draw_canvas(selection=self.object_stack.items)
+
+    def set_trafo_settings(self):
+        self.trafo_settings = TrafoDialog(self.trafo_settings, self).exec_()
+        self.logger.add_to_log("Transformation model: {0}, outlier rejection: {1}, threshold {2}, "
+                               "polynomial order {3}, thin-plate smoothing {4}".format(*self.trafo_settings))
+
+    def find_stencils(self):
+        if not self.mat_file:
+            self.logger.add_to_log("No .mat file found.")
+            return
+        fnames = QtWidgets.QFileDialog.getOpenFileNames(self, 'Find stencils', paths['stencils'], "dxf (*.dxf)")[0]
+        if not fnames:  # capture cancel in dialog
+            return
+        threshold, ok = QtWidgets.QInputDialog.getDouble(self, 'Find stencils', 'Smallest correlation:',
+                                                         self.match_settings[0], 0.1, 1., 2)
+        if not ok:
+            return
+        self.match_settings[0] = threshold
+        stencils = {}
+        for fname in fnames:
+            stencil = DwgXchFile()
+            stencil.load(self, file_type='stencil', file_name=fname)
+            stencils[os.path.splitext(os.path.basename(fname))[0]] = stencil.geometry()
+        start = time.time()
+        matcher = TemplateMatcher.from_mat_file(self.mat_file)
+        matches = matcher.search(stencils, threshold, angles=[0., 90., 180., 270.], psf_sigma=self.match_settings[1])
+        for match in matches:
+            self.pick_stack.push([match.x, match.y])
+            self.logger.add_to_log("Found {0} at ({1:.3f}, {2:.3f}), rotated by {3:g} deg, correlation {4:.2f}.".
+                                   format(match.name, match.x, match.y, match.angle, match.score))
+        self.logger.add_to_log("{0} matches of {1} stencils in {2:.2f} s.".
+                               format(len(matches), len(stencils), time.time() - start))
+        self.canvas.draw_canvas(markers=self.pick_stack.items)
 
     def transform(self):
         try:
@@ -204,78 +340,322 @@ class CADWidget(QtWidgets.QWidget):
             self.logger.add_to_log("No .mat file found.")
             pass
         else:
-            if self.pick_stack.size() == mat_pick_stack.size() and self.pick_stack.size() >= 3:
-                self.trafo_matrix = affine_trafo(mat_pick_stack.items, self.pick_stack.items)
-                self.logger.add_to_log('Affine transformation successful. Trace: {0:.2f}'.
-                                       format(np.trace(self.trafo_matrix)))
-                self.mat_file = copy.deepcopy(self.mat.mat_file)
-                self.mat_file.transform(self.trafo_matrix)
-                self.canvas.count_limits_fixed = True
-                self.canvas.count_limits = self.mat.canvas.count_limits
+            if self.pick_stack.size() == mat_pick_stack.size():
+                model, robust, threshold, order, smoothing = self.trafo_settings
+                mat_picks = np.array([pt[:3] for pt in mat_pick_stack.items], dtype=float)
+                if mat_picks.ndim != 2 or mat_picks.shape[1] != 3:
+                    self.logger.add_to_log("Transformation failed: mat points need x, y and uncertainty of the "
+                                           "peak position.", logging.WARNING)
+                    return
+                cad_picks = np.array([pt[:2] for pt in self.pick_stack.items])
+                weights = 1 / mat_picks[:, 2] ** 2
+                try:
+                    fit = fit_trafo(mat_picks[:, :2], cad_picks, model='affine' if model in WARP_MODELS else model,
+                                    weights=weights, robust=None if robust == 'none' else robust,
+                                    threshold=threshold)
+                    if model in WARP_MODELS:  # warp fitted to the pairs the affine fit kept
+                        warp = fit_warp(mat_picks[fit.inliers, :2], cad_picks[fit.inliers], model,
+                                        weights=weights[fit.inliers], order=order, smoothing=smoothing)
+                except (ValueError, np.linalg.LinAlgError) as e:
+                    self.logger.add_to_log("Transformation failed: {0}".format(e), logging.WARNING)
+                    return
+                if model in WARP_MODELS:
+                    self.trafo = warp
+                    self.logger.add_to_log('{0} warp successful. Rms residual {1:.3f} um, affine part {2:.3f} um.'.
+                                           format(model.capitalize(), warp.rms, fit.rms))
+                else:
+                    self.trafo = fit.matrix
+                    self.logger.add_to_log('{0} transformation successful. Trace: {1:.2f}, rms residual {2:.3f} um.'.
+                                           format(model.capitalize(), np.trace(self.trafo), fit.rms))
+                for ipt in np.flatnonzero(~fit.inliers):
+                    self.logger.add_to_log('Point {0} rejected as outlier, residual {1:.3f} um.'.
+                                           format(ipt + 1, fit.residuals[ipt]))
+                if self.trafo_name in self.trafo_store.entries and \
+                        not self.trafo_store.entries[self.trafo_name]['layout']:
+                    self.trafo_store.remove(self.trafo_name)  # replaced fit of an unsaved layout
+                self.trafo_name = self.trafo_store.add(
+                    os.path.dirname(self.mat.mat_file.file_name), self.dxf_file.file_name, self.mat.mat_file.file_name,
+                    model, self.trafo, raw=mat_picks[fit.inliers, :2], real=cad_picks[fit.inliers],
+                    weights=weights[fit.inliers], order=order, smoothing=smoothing)
                 self.pick_stack.empty()
-                self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+                self.show_transformed_scan()
+                self.update_overlay()
             else:
-                self.logger.add_to_log("For trafo select at least three data points in mat and dxf each.\n"
-                                       "Ensure that the same number of points is selected in each.")
+                self.logger.add_to_log("For trafo select the same number of data points in mat and dxf.")
+
+    def show_transformed_scan(self):
+        mat_file = self.mat.mat_file
+        drift = self.trafo_store.drift(self.trafo_name, mat_file.file_name, self.mat.drift_trafos)
+        coordinate_map = self.trafo_store.coordinate_map(self.trafo_name, mat_file.graph['x'][0],
+                                                         mat_file.graph['y'][0], drift)
+        if self.mat_file is not None:
+            self.mat_file.release()
+        self.mat_file = mat_file.transformed_view(None, coordinate_map)
+        self.canvas.count_limits_fixed = True
+        self.canvas.count_limits = self.mat.canvas.count_limits
+        self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+
+    def overlay_on_scan(self, active):
+        if active and (self.mat is None or self.scan_to_layout() is None):
+            self.logger.add_to_log("Overlay needs an affine transformation of the scan.", logging.WARNING)
+            self.overlay_btn.setChecked(False)
+            return
+        self.update_overlay()
+
+    def scan_to_layout(self):
+        """ Affine matrix from the shown scan to the layout with the drift of the scan applied, None for warps. """
+        if not isinstance(self.trafo, np.ndarray):
+            return None
+        if self.mat is None or self.trafo_name not in self.trafo_store.entries:
+            return self.trafo
+        drift = self.trafo_store.drift(self.trafo_name, self.mat.mat_file.file_name, self.mat.drift_trafos)
+        return self.trafo if drift is None else compose(drift, self.trafo)
+
+    def update_overlay(self):
+        """ Draws the layout on the scan with the current transformation, or removes it if the overlay is off or
+            there is no affine transformation any more. Called whenever scan, transformation or layout change. """
+        if self.mat is None:
+            return
+        matrix = self.scan_to_layout() if self.overlay_btn.isChecked() else None
+        if matrix is None:
+            if self.overlay_btn.isChecked():
+                self.logger.add_to_log("Overlay removed, no affine transformation of the scan.", logging.WARNING)
+                self.overlay_btn.setChecked(False)
+            if self.mat.canvas.geometry is not None:
+                self.mat.canvas.draw_canvas(geometry=None)
+            return
+        start = time.time()
+        geometry = self.dxf_file.geometry().transformed(np.linalg.inv(matrix))
+        self.mat.canvas.draw_canvas(geometry=geometry)
+        self.logger.add_to_log("Layout of {0} entities overlaid on the scan in {1:.3f} s.".
+                               format(len(geometry), time.time() - start))
+
+    def build_mosaic(self):
+        scan_dir = os.path.dirname(self.mat.mat_file.file_name) if self.mat else paths['registration']
+        scan_names = QtWidgets.QFileDialog.getOpenFileNames(self, 'Scans of the mosaic', scan_dir,
+                                                            "Matlab data file (*.mat)")[0]
+        if not scan_names:  # capture cancel in dialog
+            return
+        scans = []
+        for scan_name in scan_names:
+            name = self.trafo_store.find(os.path.dirname(scan_name), self.dxf_file.file_name)
+            if name is None:
+                self.logger.add_to_log("No transformation stored for {0}, left out.".format(scan_name),
+                                       logging.WARNING)
+                continue
+            drift = self.trafo_store.drift(name, scan_name, self.mat.drift_trafos if self.mat else None)
+            trafo = self.trafo_store.trafo(name)
+            scans.append((scan_name, trafo if drift is None else compose(drift, trafo)))
+        if not scans:
+            return
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, 'Mosaic directory', paths['registration'])
+        if not directory:
+            return
+        start = time.time()
+        try:
+            mosaic = Mosaic.build(directory, scans)
+        except (ValueError, OSError) as e:
+            self.logger.add_to_log("Mosaic failed: {0}".format(e), logging.WARNING)
+            return
+        self.logger.add_to_log("Mosaic of {0} scans, {1} x {2} pixels, built in {3:.1f} s.".
+                               format(len(scans), mosaic.shapes[0][1], mosaic.shapes[0][0], time.time() - start))
+        self.show_mosaic(mosaic)
+
+    def open_mosaic(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, 'Mosaic directory', paths['registration'])
+        if not directory:  # capture cancel in dialog
+            return
+        try:
+            mosaic = Mosaic(directory)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            self.logger.add_to_log("No mosaic in {0}: {1}".format(directory, e), logging.WARNING)
+            return
+        self.show_mosaic(mosaic)
+
+    def show_mosaic(self, mosaic):
+        if self.mat_file is not None:
+            self.mat_file.release()
+        self.mat_file = MosaicView(mosaic)
+        self.canvas.count_limits_fixed = False
+        self.canvas.plot_limits_fixed = False
+        self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+        self.canvas.plot_limits_fixed = True  # zooming reads the mosaic again, keep the limits
+
+    def update_scan(self):
+        """ Shows a newly displayed scan in layout coordinates, with the transformation stored for its sample. """
+        if not self.mat or not self.mat.mat_file.file_name:
+            return
+        sample = os.path.dirname(self.mat.mat_file.file_name)
+        name = self.trafo_store.find(sample, self.dxf_file.file_name)
+        if name is None:  # the transformation of another sample must not be applied to this scan
+            self.trafo_name = None
+            self.trafo = None
+            if self.mat_file is not None:
+                self.mat_file.release()
+                self.mat_file = None
+                self.canvas.draw_canvas(mat=None, markers=self.pick_stack.items)
+            self.logger.add_to_log("No transformation stored for {0}.".format(sample), logging.WARNING)
+            self.update_overlay()
+            return
+        if name != self.trafo_name:
+            self.trafo_name = name
+            self.trafo = self.trafo_store.trafo(name)
+            self.logger.add_to_log("Using stored transformation {0}.".format(name))
+        if self.trafo_name in self.trafo_store.entries:
+            self.show_transformed_scan()
+        self.update_overlay()
+
+    def export_pixel_pitch(self):
+        if self.mat_file:
+            pitch = abs(self.mat_file.graph['x'][0, 1] - self.mat_file.graph['x'][0, 0])
+        else:
+            pitch = abs(self.canvas.plot_limits[0][1] - self.canvas.plot_limits[0][0]) / 1000.
+        pitch, ok = QtWidgets.QInputDialog.getDouble(self, 'Export', 'Pixel pitch (um):', pitch, 1e-4, 1e3, 4)
+        return pitch if ok else None
+
+    def export_raster(self):
+        fname = QtWidgets.QFileDialog.getSaveFileName(self, 'Export overlay', paths['registration'],
+                                                      "Portable network graphics (*.png);;Tagged image file (*.tif)")[0]
+        if not fname:  # capture cancel in dialog
+            return
+        pixel_pitch = self.export_pixel_pitch()
+        if not pixel_pitch:
+            return
+        start = time.time()
+        try:
+            image = render_overlay(self.mat_file, self.dxf_file.geometry(), self.canvas.count_limits,
+                                   extent=self.canvas.plot_limits, pixel_pitch=pixel_pitch)
+        except ValueError as e:
+            self.logger.add_to_log("Export failed: {0}".format(e), logging.WARNING)
+            return
+        fname = write_image(fname, image, pixel_pitch)
+        self.logger.add_to_log("Exported {0} in {1:.2f} s.".format(fname, time.time() - start))
+
+    def export_batch(self):
+        if not self.mat or self.trafo_name not in self.trafo_store.entries:
+            self.logger.add_to_log("Batch export needs an image window and a transformation.")
+            return
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, 'Export directory', paths['registration'])
+        if not directory:  # capture cancel in dialog
+            return
+        pixel_pitch = self.export_pixel_pitch()
+        if not pixel_pitch:
+            return
+
+        def view(mat_file):
+            drift = self.trafo_store.drift(self.trafo_name, mat_file.file_name, self.mat.drift_trafos)
+            coordinate_map = self.trafo_store.coordinate_map(self.trafo_name, mat_file.graph['x'][0],
+                                                             mat_file.graph['y'][0], drift)
+            return mat_file.transformed_view(None, coordinate_map)
+
+        start = time.time()
+        scan_dir = os.path.dirname(self.mat.mat_file.file_name)
+        scan_names = [os.path.join(scan_dir, f) for f in os.listdir(scan_dir) if f.endswith('.mat')]
+        mat_canvas = self.mat.canvas
+        try:
+            written = export_overlays(scan_names, self.dxf_file.geometry(), directory, view=view,
+                                      count_limits=mat_canvas.count_limits if mat_canvas.count_limits_fixed else None,
+                                      percentiles=mat_canvas.count_percentiles, extent=self.canvas.plot_limits,
+                                      pixel_pitch=pixel_pitch)
+        except ValueError as e:
+            self.logger.add_to_log("Export failed: {0}".format(e), logging.WARNING)
+            return
+        self.logger.add_to_log("Exported {0} overlays to {1} in {2:.1f} s.".format(len(written), directory,
+                                                                                     time.time() - start))
 
     def pick_free(self):
         self.pick_stack.empty()
         self.object_stack.empty()
-        self.canvas.draw_canvas(markers=self.pick_stack.items)
+        self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
         self.mode = 'pick_free'
 
     def pick_node(self):
         self.pick_stack.empty()
         self.object_stack.empty()
-        self.canvas.draw_canvas(markers=self.pick_stack.items)
+        self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
         self.mode = 'pick_node'
 
     def pick_object(self):
         self.pick_stack.empty()
         self.object_stack.empty()
-        self.canvas.draw_canvas(markers=self.pick_stack.items)
-        self.mode = 'pick_obj'
+        self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
+        self.mode = 'pick_object'
 
     def pick_peak(self):
         self.pick_stack.empty()
         self.object_stack.empty()
-        self.canvas.draw_canvas(markers=self.pick_stack.items)
+        self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
         self.mode = 'pick_peak'
 
     def mouse_wheel(self, event):
         position = self.get_coordinates(event, use_grid=False)
-        if event.button == 'up' and any(position):
-            plot_lims = [[(self.canvas.plot_limits[0][0] - position[0]) / 1.2 + position[0],
-                          (self.canvas.plot_limits[0][1] - position[0]) / 1.2 + position[0]],
-                         [(self.canvas.plot_limits[1][0] - position[1]) / 1.2 + position[1],
-                          (self.canvas.plot_limits[1][1] - position[1]) / 1.2 + position[1]]]
+        if event.button in ['up', 'down'] and any(position):
+            factor = 1 / 1.2 if event.button == 'up' else 1.2
+            plot_lims = [[(self.canvas.plot_limits[0][0] - position[0]) * factor + position[0],
+                          (self.canvas.plot_limits[0][1] - position[0]) * factor + position[0]],
+                         [(self.canvas.plot_limits[1][0] - position[1]) * factor + position[1],
+                          (self.canvas.plot_limits[1][1] - position[1]) * factor + position[1]]]
             self.canvas.plot_limits_fixed = True
-            self.canvas.draw_canvas(plot_limits=plot_lims)
-        elif event.button == 'down' and any(position):
-            plot_lims = [[(self.canvas.plot_limits[0][0] - position[0]) * 1.2 + position[0],
-                          (self.canvas.plot_limits[0][1] - position[0]) * 1.2 + position[0]],
-                         [(self.canvas.plot_limits[1][0] - position[1]) * 1.2 + position[1],
-                          (self.canvas.plot_limits[1][1] - position[1]) * 1.2 + position[1]]]
-            self.canvas.plot_limits_fixed = True
-            self.canvas.draw_canvas(plot_limits=plot_lims)
+            self.canvas.set_plot_limits(plot_lims)
+
+    def mouse_pressed(self, event):
+        self.canvas.coalescer.flush()  # handle the last move before the click
+        position = self.get_coordinates(event, use_grid=False)
+        self.press_position = position if event.button == 1 and any(position) else None
+        self.lasso = [position] if self.press_position else []
 
     def mouse_moved(self, event):
-        position = self.get_coordinates(event, use_grid=True)
+        position = self.get_coordinates(event, use_grid=False)
         if any(position):
-            self.status_bar.showMessage("X={0:.3f}, Y={1:.3f}".format(*position))
+            position, kind = self.snap(position)
+            self.status_bar.showMessage("X={0:.3f}, Y={1:.3f}".format(*position) +
+                                        (" ({0})".format(kind) if kind else ""))
+            self.canvas.show_snap(position if kind else None, kind)
+            if self.press_position and self.mode == 'pick_object' and \
+                    QtWidgets.QApplication.keyboardModifiers() == QtCore.Qt.ShiftModifier:
+                self.lasso.append([event.xdata, event.ydata])
+
+    def pick_tolerance(self):
+        """ Five screen pixels in data units. """
+        return 5 * self.canvas.pixel_size()
+
+    def select_objects(self, position):
+        """ Pushes the handles of the entity at position, or of all entities in the box or lasso drawn since the
+            button was pressed, onto the object stack. """
+        geometry = self.dxf_file.geometry()
+        selectable = self.dxf_file.selectable()  # entities on hidden layers are never selected
+        tolerance = self.pick_tolerance()
+        if self.press_position and distance(self.press_position, position)[0] > tolerance:
+            if len(self.lasso) > 2:
+                entities = geometry.select_lasso(self.lasso + [position])
+            else:
+                (x0, x1), (y0, y1) = sorted([self.press_position[0], position[0]]), \
+                                     sorted([self.press_position[1], position[1]])
+                entities = geometry.select_box([x0, y0, x1, y1])
+            if selectable is not None:
+                entities = [entity for entity in entities if selectable[entity]]
+        else:
+            entity = geometry.hit(position, tolerance, selectable)
+            entities = [] if entity is None else [entity]
+        for entity in entities:
+            if geometry.handles[entity] not in self.object_stack.items:
+                self.object_stack.push(geometry.handles[entity])
+        if len(entities) > 1:
+            self.status_bar.showMessage("Selected {0} objects.".format(len(entities)))
 
     def mouse_released(self, event):
+        self.canvas.coalescer.flush()
         position = self.get_coordinates(event, use_grid=True)
         if any(position):
             if event.button == 1:
                 if self.mode == 'pick_free':
                     self.pick_stack.push(position)
                 elif self.mode == 'pick_node':
-                    obj_index, position = kd_nearest(self.dxf_file.points().coordinates(), position)
-                    self.pick_stack.push(position)
+                    position = self.dxf_file.geometry().snap_engine().nearest_node(position)
+                    if position:
+                        self.pick_stack.push(position)
                 elif self.mode == 'pick_object':
-                    obj_index, position = kd_nearest(self.dxf_file.points().coordinates(), position)
-                    self.object_stack.push(obj_index)
+                    self.select_objects([event.xdata, event.ydata])
                 elif self.mode == 'pick_peak' and self.mat_file:
                     x_ax = self.mat_file.graph['x'][0]
                     y_ax = self.mat_file.graph['y'][0][::-1]
@@ -285,11 +665,13 @@ class CADWidget(QtWidgets.QWidget):
                                 self.canvas.count_limits[0])  # amplitude, x0, y0, sigma, offset
                     param_bounds = ([0, position[0] - 1, position[1] - 1, 0, -np.inf],
                                     [np.inf, position[0] + 1, position[1] + 1, np.inf, np.inf])
-                    popt, _ = opt.curve_fit(two_d_gaussian_sym, [x_ax, y_ax], self.mat_file.graph['result'].ravel(),
-                                            p0=gauss_p0, bounds=param_bounds)
+                    with timer('gaussian_fit'):
+                        popt, _ = opt.curve_fit(two_d_gaussian_sym, [x_ax, y_ax],
+                                                self.mat_file.graph['result'].ravel(), p0=gauss_p0,
+                                                bounds=param_bounds)
                     self.pick_stack.push([popt[1], popt[2]])
                 if self.tool == 'free_select':
-                    self.canvas.draw_canvas(markers=self.pick_stack.items)
+                    self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
                 elif self.tool == 'measure':
                     self.canvas.draw_canvas(dxf=self.dxf_file)
                     if self.pick_stack.size() == 2:
@@ -298,8 +680,14 @@ class CADWidget(QtWidgets.QWidget):
                                .format(dist[0], abs(dist[1][0]), abs(dist[1][1])))
                         self.logger.add_to_log(msg)
                 elif self.tool == 'stencil' and self.stencil and not self.pick_stack.is_empty():
-                    self.dxf_file.add_stencil(self.stencil, self.pick_stack.pop())
+                    position = self.pick_stack.pop()
+                    conflicts, _ = self.dxf_file.check_placement(self.stencil, [position], self.clearance)
+                    for _, handle, dist in conflicts:
+                        self.logger.add_to_log("Stencil at ({0:.3f}, {1:.3f}) conflicts with {2}: {3:.3f} um.".format(
+                            position[0], position[1], handle, dist), logging.WARNING)
+                    self.dxf_file.add_stencil(self.stencil, position)
                     self.canvas.draw_canvas(dxf=self.dxf_file)
+                    self.update_overlay()
 
             elif event.button == 3:
                 if self.mode == 'pick_free' and not self.pick_stack.is_empty():
@@ -311,24 +699,50 @@ class CADWidget(QtWidgets.QWidget):
                 elif self.mode == 'pick_peak' and not self.pick_stack.is_empty():
                     self.pick_stack.pop()
                 if self.tool == 'free_select' or self.tool == 'measure':
-                    self.canvas.draw_canvas(markers=self.pick_stack.items)
+                    self.canvas.draw_canvas(markers=self.pick_stack.items, selection=self.object_stack.items)
                 elif self.tool == 'stencil' and self.stencil:
                     self.dxf_file.undo_add_stencil()
                     self.canvas.draw_canvas(dxf=self.dxf_file)
+                    self.update_overlay()
 
     def get_coordinates(self, event, use_grid):
         if any([event.xdata, event.ydata]):
-            if use_grid and self.grid[0]:
-                if QtWidgets.QApplication.keyboardModifiers() == QtCore.Qt.ControlModifier:
-                    return [round(event.xdata / self.grid[2]) * self.grid[2],
-                            round(event.ydata / self.grid[2]) * self.grid[2]]
-                else:
-                    return [round(event.xdata/self.grid[1])*self.grid[1],
-                            round(event.ydata / self.grid[1]) * self.grid[1]]
+            if use_grid:
+                return self.snap([event.xdata, event.ydata])[0]
             else:
                 return [event.xdata, event.ydata]
         else:
             return [None, None]
 
+    def snap(self, position):
+        """ Returns position snapped to the layout or the grid and the kind of snap point, None if not snapped. """
+        spacing = None
+        if self.grid[0]:
+            if QtWidgets.QApplication.keyboardModifiers() == QtCore.Qt.ControlModifier:
+                spacing = self.grid[2]
+            else:
+                spacing = self.grid[1]
+        return self.dxf_file.geometry().snap_engine().snap(position, self.pick_tolerance(), spacing, self.snap_kinds)
+
     def set_mat(self, mat):
         self.mat = mat
+        if self.mat:
+            self.mat.count_limits_changed.connect(self.set_count_limits)
+            self.mat.scan_changed.connect(self.update_scan)
+            self.update_scan()
+
+    def set_count_limits(self, count_limits):
+        if self.mat_file:  # transformed image shares the count limits of the image window
+            self.canvas.count_limits = list(count_limits)
+            self.canvas.draw_canvas()
+
+    def closeEvent(self, event):
+        self.canvas.coalescer.timer.stop()
+        if self.mat:
+            self.mat.count_limits_changed.disconnect(self.set_count_limits)
+            self.mat.scan_changed.disconnect(self.update_scan)
+        if self.mat_file is not None:
+            self.mat_file.release()
+            self.mat_file = None
+            self.canvas.mat = None
+        event.accept()
@@ -1,25 +1,37 @@
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets
 
-from utility.xterm_hex_conv import xterm_to_hex
+from utility.xterm_hex_conv import hex_to_xterm, xterm_to_hex
 
 
 # noinspection PyAttributeOutsideInit, PyArgumentList
 class LayerDialog(QtWidgets.QDialog):
+    layers_changed = QtCore.pyqtSignal()  # visibility or color of a layer changed, applied to dxf_file at once
+
     def __init__(self, layer, dxf_file, parent=None):
         super(LayerDialog, self).__init__(parent)
         self.active_layer = layer
+        self.dxf_file = dxf_file
+        self.layer_names = dxf_file.layer_names()
+        # restored on cancel, changes are applied while the dialog is open
+        self.initial_state = (layer, set(dxf_file.hidden_layers), dict(dxf_file.layer_colors),
+                              {name: dxf_file.layer_color(name) for name in self.layer_names})
 
-        self.layer_color_btns = [QtWidgets.QPushButton(self) for _ in dxf_file.drawing.layers]
-        self.layer_select_cbs = [QtWidgets.QCheckBox(self) for _ in dxf_file.drawing.layers]
+        self.layer_color_btns = [QtWidgets.QPushButton(self) for _ in self.layer_names]
+        self.layer_select_cbs = [QtWidgets.QCheckBox(self) for _ in self.layer_names]
+        self.layer_visible_cbs = [QtWidgets.QCheckBox('visible', self) for _ in self.layer_names]
         self.layer_cbgp = QtWidgets.QButtonGroup()
-        for il, l in enumerate(dxf_file.drawing.layers):
-            self.layer_color_btns[il].setStyleSheet("background-color: %s" % xterm_to_hex(l.get_color()))
+        for il, name in enumerate(self.layer_names):
+            self.layer_color_btns[il].setStyleSheet("background-color: %s" % xterm_to_hex(dxf_file.layer_color(name)))
             self.layer_color_btns[il].resize(self.layer_color_btns[il].sizeHint())
+            self.layer_color_btns[il].setObjectName(name)
             self.layer_color_btns[il].clicked.connect(self.set_color)
             self.layer_select_cbs[il].setObjectName(str(il))
             self.layer_cbgp.addButton(self.layer_select_cbs[il], il)
+            self.layer_visible_cbs[il].setObjectName(name)
+            self.layer_visible_cbs[il].setChecked(dxf_file.layer_visible(name))
+            self.layer_visible_cbs[il].toggled.connect(self.set_visible)
         self.layer_cbgp.buttonClicked.connect(self.set_layer)
-        self.layer_name_edts = [QtWidgets.QLineEdit(l.dxf.name, self) for l in dxf_file.drawing.layers]
+        self.layer_name_edts = [QtWidgets.QLineEdit(name, self) for name in self.layer_names]
 
         self.btns = QtWidgets.QDialogButtonBox(
             QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel, self)
@@ -32,6 +44,7 @@ class LayerDialog(QtWidgets.QDialog):
         for il, hbox in enumerate(hboxes):
             hbox.setSpacing(10)
             hbox.addWidget(self.layer_select_cbs[il])
+            hbox.addWidget(self.layer_visible_cbs[il])
             hbox.addWidget(self.layer_color_btns[il])
             hbox.addWidget(self.layer_name_edts[il])
             vbox.addLayout(hbox)
@@ -41,11 +54,64 @@ class LayerDialog(QtWidgets.QDialog):
     def set_layer(self, cb_selected):
         self.active_layer = int(cb_selected.objectName())
 
+    def set_visible(self, visible):
+        self.dxf_file.set_layer_visible(self.sender().objectName(), visible)
+        self.layers_changed.emit()
+
     def set_color(self):
         sel_color_btn = self.sender()
-        color = QtWidgets.QColorDialog.getColor()
-        sel_color_btn.setStyleSheet("background-color: %s" % color.name())
+        name = sel_color_btn.objectName()
+        color = QtWidgets.QColorDialog.getColor(QtGui.QColor(xterm_to_hex(self.dxf_file.layer_color(name))), self)
+        if not color.isValid():  # capture cancel in dialog
+            return
+        index = hex_to_xterm(color.name())
+        self.dxf_file.set_layer_color(name, index)
+        sel_color_btn.setStyleSheet("background-color: %s" % xterm_to_hex(index))
+        self.layers_changed.emit()
+
+    def reject(self):
+        """ Restores active layer, visibility and colors of the layers as they were when the dialog was opened. """
+        self.active_layer, hidden_layers, layer_colors, colors = self.initial_state
+        for name, color in colors.items():
+            if self.dxf_file.layer_color(name) != color:
+                self.dxf_file.set_layer_color(name, color)
+        self.dxf_file.hidden_layers = set(hidden_layers)
+        self.dxf_file.layer_colors = dict(layer_colors)
+        self.layers_changed.emit()
+        super(LayerDialog, self).reject()
 
     def exec_(self):
         super(LayerDialog, self).exec_()
         return self.active_layer
+
+
+# noinspection PyAttributeOutsideInit, PyArgumentList
+class LayerSelectDialog(QtWidgets.QDialog):
+    """ Asks for the layers of a file to read, all checked at first. """
+    def __init__(self, layer_names, parent=None):
+        super(LayerSelectDialog, self).__init__(parent)
+        self.setWindowTitle('Layers to read')
+        self.layer_list = QtWidgets.QListWidget(self)
+        for name in layer_names:
+            item = QtWidgets.QListWidgetItem(name, self.layer_list)
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Checked)
+
+        self.btns = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel, self)
+        self.btns.accepted.connect(self.accept)
+        self.btns.rejected.connect(self.reject)
+
+        vbox = QtWidgets.QVBoxLayout(self)
+        vbox.setSpacing(10)
+        vbox.addWidget(self.layer_list)
+        vbox.addSpacing(5)
+        vbox.addWidget(self.btns)
+
+    def exec_(self):
+        """ Returns the names of the checked layers, None on cancel or if no layer is checked. """
+        if not super(LayerSelectDialog, self).exec_():
+            return None
+        items = [self.layer_list.item(i) for i in range(self.layer_list.count())]
+        names = [item.text() for item in items if item.checkState() == QtCore.Qt.Checked]
+        return names or None
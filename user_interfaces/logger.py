@@ -1,15 +1,77 @@
-from PyQt5 import QtGui, QtWidgets
+import logging
+import logging.handlers
+import threading
+from collections import deque
+from PyQt5 import QtCore, QtGui, QtWidgets
 
+from utility import profiling
 from utility.config import paths
 
 
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+class BufferHandler(logging.Handler):
+    """ Logging handler collecting formatted records in a ring buffer until the widget takes them.
+
+        Records may come from any thread, only the newest max_lines are kept if the widget falls behind.
+    """
+    def __init__(self, max_lines):
+        super(BufferHandler, self).__init__()
+        self.lines = deque(maxlen=max_lines)
+        self.lines_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lines_lock:
+            self.lines.append(line)
+
+    def take(self):
+        """ Returns and removes all buffered lines. """
+        with self.lines_lock:
+            lines = list(self.lines)
+            self.lines.clear()
+        return lines
+
+
 # noinspection PyAttributeOutsideInit, PyArgumentList
 class Logger(QtWidgets.QWidget):
+    """ Log window fed by the python logger 'pykaboo'.
 
-    def __init__(self, parent=None):
+        Messages are buffered by a BufferHandler and appended to the window in one batch per flush interval, the
+        window keeps only the last max_lines lines. Optionally all messages are also written to a rotating log file.
+
+        Attributes:
+            log (logging.Logger): Logger of the application, also usable from worker threads.
+            handler (BufferHandler): Handler feeding the window.
+            file_handler (RotatingFileHandler): Handler of the log file, None if not logging to a file.
+    """
+    def __init__(self, parent=None, max_lines=10000, flush_interval=200):
         super(Logger, self).__init__(parent)
+        self.log = logging.getLogger('pykaboo')
+        self.log.setLevel(logging.DEBUG)
+        self.handler = BufferHandler(max_lines)
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(message)s', '%H:%M:%S'))
+        self.handler.setLevel(logging.INFO)
+        self.log.addHandler(self.handler)
+        self.file_handler = None
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.timeout.connect(self.flush)
+        self.flush_timer.start(flush_interval)
 
-        self.edt_log = QtWidgets.QTextEdit('Log: \n', self)
+        self.edt_log = QtWidgets.QPlainTextEdit(self)
+        self.edt_log.setReadOnly(True)
+        self.edt_log.setMaximumBlockCount(max_lines)
+        self.edt_log.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.level_cmb = QtWidgets.QComboBox(self)
+        self.level_cmb.addItems(LEVELS)
+        self.level_cmb.setCurrentIndex(LEVELS.index('INFO'))
+        self.level_cmb.setToolTip('Lowest level of messages shown')
+        self.level_cmb.currentIndexChanged.connect(self.set_level)
         self.save_btn = QtWidgets.QPushButton('Save', self)
         self.save_btn.setToolTip('Save log file')
         self.save_btn.setObjectName('log_save')
@@ -20,10 +82,33 @@ class Logger(QtWidgets.QWidget):
         self.clear_btn.setObjectName('log_clear')
         self.clear_btn.clicked.connect(self.clear)
         self.clear_btn.resize(self.clear_btn.sizeHint())
+        self.timings_btn = QtWidgets.QPushButton('Timings', self)
+        self.timings_btn.setToolTip('Show count, median, 95th percentile and maximum duration of the timed operations')
+        self.timings_btn.setObjectName('log_timings')
+        self.timings_btn.clicked.connect(self.show_timings)
+        self.export_btn = QtWidgets.QPushButton('Export', self)
+        self.export_btn.setToolTip('Save timing statistics as json')
+        self.export_btn.setObjectName('log_export')
+        self.export_btn.clicked.connect(self.export_timings)
+        self.profile_btn = QtWidgets.QPushButton('Profile', self)
+        self.profile_btn.setToolTip('Record a cProfile until pressed again')
+        self.profile_btn.setObjectName('log_profile')
+        self.profile_btn.setCheckable(True)
+        self.profile_btn.toggled.connect(self.set_profiling)
+        self.file_btn = QtWidgets.QPushButton('Log file', self)
+        self.file_btn.setToolTip('Also write all messages to a rotating log file')
+        self.file_btn.setObjectName('log_file')
+        self.file_btn.setCheckable(True)
+        self.file_btn.toggled.connect(self.set_log_file)
 
         vbox1 = QtWidgets.QVBoxLayout()
         vbox1.addWidget(self.save_btn)
         vbox1.addWidget(self.clear_btn)
+        vbox1.addWidget(self.timings_btn)
+        vbox1.addWidget(self.export_btn)
+        vbox1.addWidget(self.profile_btn)
+        vbox1.addWidget(self.file_btn)
+        vbox1.addWidget(self.level_cmb)
         main_hbox = QtWidgets.QHBoxLayout(self)
         main_hbox.setSpacing(10)
         main_hbox.addWidget(self.edt_log)
@@ -35,15 +120,62 @@ class Logger(QtWidgets.QWidget):
             return
         elif not fname.endswith('.txt'):
             fname += ".txt"
+        self.flush()
         with open(fname, 'w') as file:
             file.write(self.edt_log.toPlainText())
 
-    def add_to_log(self, entry):
-        self.edt_log.append(entry)
-        self.edt_log.moveCursor(QtGui.QTextCursor.End)
+    def add_to_log(self, entry, level=logging.INFO):
+        self.log.log(level, entry)
+
+    def flush(self):
+        lines = self.handler.take()
+        if lines:
+            self.edt_log.appendPlainText('\n'.join(lines))
+            self.edt_log.moveCursor(QtGui.QTextCursor.End)
+
+    def set_level(self, index):
+        self.handler.setLevel(LEVELS[index])
+
+    def set_log_file(self, active, max_bytes=5000000, backup_count=3):
+        if self.file_handler is not None:
+            self.log.removeHandler(self.file_handler)
+            self.file_handler.close()
+            self.file_handler = None
+        if not active:
+            return
+        fname = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', paths['registration'], "Log files (*.log)")[0]
+        if not fname:  # capture cancel in dialog
+            self.file_btn.setChecked(False)
+            return
+        elif not fname.endswith('.log'):
+            fname += ".log"
+        self.file_handler = logging.handlers.RotatingFileHandler(fname, maxBytes=max_bytes, backupCount=backup_count)
+        self.file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.log.addHandler(self.file_handler)
+        self.add_to_log("Logging to " + fname)
+
+    def show_timings(self):
+        self.add_to_log(profiling.report())
+
+    def export_timings(self):
+        fname = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', paths['registration'],
+                                                      "Json files (*.json)")[0]
+        if not fname:  # capture cancel in dialog
+            return
+        elif not fname.endswith('.json'):
+            fname += ".json"
+        profiling.export_json(fname)
+
+    def set_profiling(self, active):
+        if active:
+            profiling.start_profile()
+            self.add_to_log("Profiling started.")
+        else:
+            self.add_to_log(profiling.stop_profile())
 
     def clear(self):
-        self.edt_log.setText('Log: ')
+        self.handler.take()
+        self.edt_log.clear()
 
     def closeEvent(self, event):  # deactivate closing button
         event.ignore()
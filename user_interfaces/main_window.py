@@ -1,6 +1,8 @@
 import os
 from PyQt5 import QtWidgets, QtGui
 
+from helper_classes.trafo_store import TrafoStore
+from plot_classes.scene_plot import PIXMAP_CACHE
 from user_interfaces.logger import Logger
 from user_interfaces.cad_widget import CADWidget
 from user_interfaces.mat_widget import MatWidget
@@ -14,6 +16,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
+        QtGui.QPixmapCache.setCacheLimit(max(QtGui.QPixmapCache.cacheLimit(), PIXMAP_CACHE))  # for ScenePlot
         self.init_ui()
 
     def init_ui(self):
@@ -27,6 +30,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setCentralWidget(self.mdi)
 
         self.logger = Logger(self)
+        self.trafo_store = TrafoStore()
         self.log_widget = QtWidgets.QMdiSubWindow()
         self.log_widget.setWidget(self.logger)
         self.log_widget.setWindowTitle("Logger")
@@ -52,6 +56,12 @@ class MainWindow(QtWidgets.QMainWindow):
         import_mat_btn.triggered.connect(self.import_mat)
         export_png_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'export.png')), 'Save png', self)
         export_png_btn.triggered.connect(self.export_png)
+        export_raster_btn = QtWidgets.QAction('Export overlay', self)
+        export_raster_btn.setToolTip('Export scan and layout as png or tiff at a chosen pixel pitch')
+        export_raster_btn.triggered.connect(self.export_raster)
+        export_batch_btn = QtWidgets.QAction('Batch export', self)
+        export_batch_btn.setToolTip('Export all scans in the directory of the image with the layout')
+        export_batch_btn.triggered.connect(self.export_batch)
         self.toolbar = self.addToolBar("File")
         self.toolbar.addAction(new_dxf_btn)
         self.toolbar.addAction(open_dxf_btn)
@@ -60,11 +70,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.toolbar.addAction(save_dxf_as_btn)
         self.toolbar.addAction(import_mat_btn)
         self.toolbar.addAction(export_png_btn)
+        self.toolbar.addAction(export_raster_btn)
+        self.toolbar.addAction(export_batch_btn)
 
         self.show()
 
     def new_dxf(self):
-        self.cad = CADWidget("New", 0, self.logger, self)
+        self.cad = CADWidget("New", 0, self.logger, self.trafo_store, self)
         self.cad_widget = QtWidgets.QMdiSubWindow()
         self.cad_widget.setWidget(self.cad)
         self.cad_widget.setWindowTitle("CAD")
@@ -76,7 +88,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.cad.set_mat(self.mat)
 
     def open_dxf(self):
-        self.cad = CADWidget("Open", 0, self.logger, self)
+        self.cad = CADWidget("Open", 0, self.logger, self.trafo_store, self)
         self.cad_widget = QtWidgets.QMdiSubWindow()
         self.cad_widget.setWidget(self.cad)
         self.cad_widget.setWindowTitle("CAD")
@@ -88,7 +100,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.cad.set_mat(self.mat)
 
     def open_template(self):
-        self.cad = CADWidget("Open Template", 0, self.logger, self)
+        self.cad = CADWidget("Open Template", 0, self.logger, self.trafo_store, self)
         self.cad_widget = QtWidgets.QMdiSubWindow()
         self.cad_widget.setWidget(self.cad)
         self.cad_widget.setWindowTitle("CAD")
@@ -135,3 +147,13 @@ class MainWindow(QtWidgets.QMainWindow):
         active_widget = self.mdi.activeSubWindow().widget()
         if isinstance(active_widget, CADWidget):
             active_widget.canvas.save(active_widget)
+
+    def export_raster(self):
+        active_widget = self.mdi.activeSubWindow().widget()
+        if isinstance(active_widget, CADWidget):
+            active_widget.export_raster()
+
+    def export_batch(self):
+        active_widget = self.mdi.activeSubWindow().widget()
+        if isinstance(active_widget, CADWidget):
+            active_widget.export_batch()
@@ -1,22 +1,36 @@
+import copy
+import logging
 import os
+import time
 import numpy as np
 from scipy import optimize as opt
-from PyQt5 import QtWidgets, QtGui
+from PyQt5 import QtWidgets, QtGui, QtCore
 
 from plot_classes.color_plot import ColorPlot
 from helper_classes.mat_file import MatFile
 from helper_classes.stack import Stack
 from user_interfaces.minmax_dialog import MinMaxDialog
 from utility.config import paths
+from utility.peak_fit import fit_cluster, region
+from utility.phase_correlation import PhaseCorrelator, drift_trafo
+from utility.profiling import timer
 from utility.utility_functions import two_d_gaussian_sym
 
 
 # noinspection PyAttributeOutsideInit, PyArgumentList
 class MatWidget(QtWidgets.QWidget):
+    count_limits_changed = QtCore.pyqtSignal(list)
+    scan_changed = QtCore.pyqtSignal()  # another file, frame, channel or projection is displayed
+
     def __init__(self, logger, parent=None):
         super(MatWidget, self).__init__(parent)
         self.logger = logger
         self.pick_stack = Stack()
+        self.auto_percentiles = [0.5, 99.5]
+        self.reference = None
+        self.correlator = None
+        self.drift_trafos = {}  # file name -> matrix mapping the scan onto the reference scan
+        self.peak_fit = [0.2, 1., 3, False]  # expected sigma, region radius in um, max emitters, elliptical
 
         back_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'back.png')),
                                      'Back', self)
@@ -30,6 +44,11 @@ class MatWidget(QtWidgets.QWidget):
         minmax_btn = QtWidgets.QAction(QtGui.QIcon(os.path.join(paths['icons'], 'minmax.png')),
                                        'Set minimum and maximum counts', self)
         minmax_btn.triggered.connect(self.set_minmax)
+        self.auto_contrast_btn = QtWidgets.QAction('Auto', self)
+        self.auto_contrast_btn.setToolTip('Automatic contrast from {0}-{1} % count percentiles'
+                                          .format(*self.auto_percentiles))
+        self.auto_contrast_btn.setCheckable(True)
+        self.auto_contrast_btn.triggered.connect(self.set_auto_contrast)
 
         self.toolbar = QtWidgets.QToolBar("Image")
         self.toolbar.addAction(back_btn)
@@ -37,10 +56,42 @@ class MatWidget(QtWidgets.QWidget):
         self.toolbar.addAction(open_btn)
         self.toolbar.addSeparator()
         self.toolbar.addAction(minmax_btn)
+        self.toolbar.addAction(self.auto_contrast_btn)
+        self.toolbar.addSeparator()
+        reference_btn = QtWidgets.QAction('Reference', self)
+        reference_btn.setToolTip('Use current scan as reference for drift correction')
+        reference_btn.triggered.connect(self.set_reference)
+        self.toolbar.addAction(reference_btn)
+        drift_btn = QtWidgets.QAction('Drift', self)
+        drift_btn.setToolTip('Register all scans in directory to the reference scan')
+        drift_btn.triggered.connect(self.register_directory)
+        self.toolbar.addAction(drift_btn)
+        self.toolbar.addSeparator()
+        self.multi_btn = QtWidgets.QAction('Multi', self)
+        self.multi_btn.setToolTip('Fit up to {0} overlapping peaks jointly around the click'.format(self.peak_fit[2]))
+        self.multi_btn.setCheckable(True)
+        self.toolbar.addAction(self.multi_btn)
+        self.toolbar.addSeparator()
+
+        self.frame_spb = QtWidgets.QSpinBox(self)
+        self.frame_spb.setPrefix('Frame ')
+        self.frame_spb.setToolTip('Displayed frame (z plane or time step)')
+        self.frame_spb.valueChanged.connect(self.set_frame)
+        self.channel_spb = QtWidgets.QSpinBox(self)
+        self.channel_spb.setPrefix('Channel ')
+        self.channel_spb.valueChanged.connect(self.set_frame)
+        self.projection_cmb = QtWidgets.QComboBox(self)
+        self.projection_cmb.addItems(['Frame', 'Max', 'Mean'])
+        self.projection_cmb.setToolTip('Display single frame or projection of all frames')
+        self.projection_cmb.currentIndexChanged.connect(self.set_frame)
+        self.frame_actions = [self.toolbar.addWidget(self.frame_spb),
+                              self.toolbar.addWidget(self.channel_spb),
+                              self.toolbar.addWidget(self.projection_cmb)]
 
         self.canvas = ColorPlot(self)
         self.canvas.mpl_connect('button_release_event', self.mouse_released)
-        self.canvas.mpl_connect('motion_notify_event', self.mouse_moved)
+        self.canvas.mpl_connect('motion_notify_event',
+                                lambda event: self.canvas.coalescer.post('move', self.mouse_moved, event))
 
         self.status_bar = QtWidgets.QStatusBar()
 
@@ -52,6 +103,7 @@ class MatWidget(QtWidgets.QWidget):
 
         self.mat_file = MatFile()
         self.mat_file.load(self, dialog=True)
+        self.update_frame_controls()
         self.canvas.draw_canvas(mat=self.mat_file)
         self.logger.add_to_log("Loaded file " + self.mat_file.file_name)
 
@@ -62,8 +114,12 @@ class MatWidget(QtWidgets.QWidget):
             dir_content = [f for f in os.listdir(dirname) if f.endswith('.mat')]
             fname = dir_content[(dir_content.index(fname) - 1 + len(dir_content)) % len(dir_content)]
             self.mat_file.load(self, file_name=os.path.join(dirname, fname))
+            self.update_frame_controls()
             self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+            self.count_limits_changed.emit(self.canvas.count_limits)
             self.logger.add_to_log("Loaded file " + self.mat_file.file_name)
+            self.register_drift()
+            self.scan_changed.emit()
 
     def file_forward(self):
         if self.mat_file.file_name:
@@ -72,22 +128,99 @@ class MatWidget(QtWidgets.QWidget):
             dir_content = [f for f in os.listdir(dirname) if f.endswith('.mat')]
             fname = dir_content[(dir_content.index(fname) + 1 + len(dir_content)) % len(dir_content)]
             self.mat_file.load(self, file_name=os.path.join(dirname, fname))
+            self.update_frame_controls()
             self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+            self.count_limits_changed.emit(self.canvas.count_limits)
             self.logger.add_to_log("Loaded file " + self.mat_file.file_name)
+            self.register_drift()
+            self.scan_changed.emit()
 
     def file_open(self):
         self.mat_file.load(self, dialog=True)
+        self.update_frame_controls()
         self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+        self.count_limits_changed.emit(self.canvas.count_limits)
         self.logger.add_to_log("Loaded file " + self.mat_file.file_name)
+        self.register_drift()
+        self.scan_changed.emit()
+
+    def set_reference(self):
+        self.reference = copy.deepcopy(self.mat_file)
+        self.correlator = PhaseCorrelator(self.reference.graph['result'], upsample=20, coarse=4)
+        self.drift_trafos = {self.reference.file_name: np.eye(3)}
+        self.logger.add_to_log("Reference scan: " + self.reference.file_name)
+
+    def register_drift(self, mat_file=None):
+        if not self.correlator:
+            return
+        if mat_file is None:
+            mat_file = self.mat_file
+        try:
+            trafo, peak = drift_trafo(mat_file, self.reference, self.correlator)
+        except ValueError as e:
+            self.logger.add_to_log("Drift correction failed: {0}".format(e), logging.WARNING)
+            return
+        self.drift_trafos[mat_file.file_name] = trafo
+        self.logger.add_to_log("Drift {0}: dx = {1:.3f} um, dy = {2:.3f} um, peak {3:.2f}"
+                               .format(os.path.basename(mat_file.file_name), trafo[2, 0], trafo[2, 1], peak))
+
+    def register_directory(self):
+        if not self.correlator:
+            self.logger.add_to_log("Select a reference scan first.")
+            return
+        start = time.time()
+        dirname = os.path.dirname(self.reference.file_name)
+        dir_content = [f for f in os.listdir(dirname) if f.endswith('.mat')]
+        for fname in dir_content:
+            mat_file = MatFile()
+            mat_file.load(None, file_name=os.path.join(dirname, fname))
+            self.register_drift(mat_file)
+        self.logger.add_to_log("Registered {0} scans in {1:.1f} s.".format(len(dir_content), time.time() - start))
 
     def set_minmax(self):
+        self.auto_contrast_btn.setChecked(False)
         self.canvas.count_limits_fixed = True
+        self.canvas.count_percentiles = None
         self.canvas.count_limits = MinMaxDialog(self.canvas.count_limits, self).exec_()
         self.canvas.draw_canvas()
+        self.count_limits_changed.emit(self.canvas.count_limits)
+
+    def set_auto_contrast(self, active):
+        self.canvas.count_limits_fixed = False
+        self.canvas.count_percentiles = self.auto_percentiles if active else None
+        self.canvas.draw_canvas()
+        self.count_limits_changed.emit(self.canvas.count_limits)
+        self.logger.add_to_log("Count limits: {0:.1f} - {1:.1f}".format(*self.canvas.count_limits))
+
+    def update_frame_controls(self):
+        for widget in [self.frame_spb, self.channel_spb, self.projection_cmb]:
+            widget.blockSignals(True)
+        self.frame_spb.setMaximum(self.mat_file.n_frames() - 1)
+        self.frame_spb.setValue(self.mat_file.frame)
+        self.channel_spb.setMaximum(self.mat_file.n_channels() - 1)
+        self.channel_spb.setValue(self.mat_file.channel)
+        self.projection_cmb.setCurrentIndex(0)
+        self.frame_spb.setEnabled(True)
+        for widget in [self.frame_spb, self.channel_spb, self.projection_cmb]:
+            widget.blockSignals(False)
+        self.frame_actions[0].setVisible(self.mat_file.n_frames() > 1)
+        self.frame_actions[1].setVisible(self.mat_file.n_channels() > 1)
+        self.frame_actions[2].setVisible(self.mat_file.n_frames() > 1)
+
+    def set_frame(self):
+        projection = [None, 'max', 'mean'][self.projection_cmb.currentIndex()]
+        self.frame_spb.setEnabled(projection is None)
+        self.mat_file.set_frame(frame=self.frame_spb.value(), channel=self.channel_spb.value(),
+                                projection=projection)
+        self.canvas.draw_canvas(mat=self.mat_file, markers=self.pick_stack.items)
+        self.count_limits_changed.emit(self.canvas.count_limits)
+        self.scan_changed.emit()
 
     def mouse_released(self, event):
         if any([event.xdata, event.ydata]):
-            if event.button == 1:
+            if event.button == 1 and self.multi_btn.isChecked():
+                self.fit_peaks([event.xdata, event.ydata])
+            elif event.button == 1:
                 x_ax = self.mat_file.graph['x'][0]
                 y_ax = self.mat_file.graph['y'][0][::-1]
                 x_ax, y_ax = np.meshgrid(x_ax, y_ax)
@@ -96,21 +229,50 @@ class MatWidget(QtWidgets.QWidget):
                             self.canvas.count_limits[0])  # amplitude, x0, y0, sigma, offset
                 param_bounds = ([0, event.xdata - 1, event.ydata - 1, 0, -np.inf],
                                 [np.inf, event.xdata + 1, event.ydata + 1, np.inf, np.inf])
-                popt, _ = opt.curve_fit(two_d_gaussian_sym, [x_ax, y_ax], self.mat_file.graph['result'].ravel(),
-                                        p0=gauss_p0, bounds=param_bounds)
-                self.pick_stack.push([popt[1], popt[2]])
+                with timer('gaussian_fit'):
+                    popt, pcov = opt.curve_fit(two_d_gaussian_sym, [x_ax, y_ax],
+                                               self.mat_file.graph['result'].ravel(), p0=gauss_p0,
+                                               bounds=param_bounds)
+                sigma = np.sqrt((pcov[1, 1] + pcov[2, 2]) / 2)  # uncertainty of the peak position
+                if not np.isfinite(sigma) or sigma <= 0:
+                    sigma = self.pixel_pitch()
+                self.pick_stack.push([popt[1], popt[2], sigma])
                 self.canvas.draw_canvas(markers=self.pick_stack.items)
             elif event.button == 2:  # manually select point by pressing wheel
-                self.pick_stack.push([event.xdata, event.ydata])
+                self.pick_stack.push([event.xdata, event.ydata, self.pixel_pitch()])
                 self.canvas.draw_canvas(markers=self.pick_stack.items)
             elif event.button == 3 and not self.pick_stack.is_empty():
                 self.pick_stack.pop()
                 self.canvas.draw_canvas(markers=self.pick_stack.items)
 
+    def fit_peaks(self, position):
+        """ Fits all overlapping peaks around position jointly and picks the one closest to position. """
+        sigma, radius, max_emitters, elliptical = self.peak_fit
+        x, y, counts = region(self.mat_file.graph['x'][0], self.mat_file.graph['y'][0], self.mat_file.graph['result'],
+                              position, radius)
+        with timer('gaussian_fit.multi'):
+            fit = fit_cluster(x, y, counts, sigma, max_emitters, elliptical)
+        if fit is None:
+            self.logger.add_to_log("Peak fit failed: too few pixels around the click.", logging.WARNING)
+            return
+        closest = np.argmin(np.hypot(*(fit.positions - position).T))
+        uncertainty = fit.uncertainties[closest]
+        if not np.isfinite(uncertainty) or uncertainty <= 0:
+            uncertainty = self.pixel_pitch()
+        self.pick_stack.push([fit.positions[closest, 0], fit.positions[closest, 1], uncertainty])
+        self.canvas.draw_canvas(markers=self.pick_stack.items)
+        if len(fit.positions) > 1:
+            self.logger.add_to_log("Fitted {0} overlapping peaks, picked x = {1:.3f} um, y = {2:.3f} um."
+                                   .format(len(fit.positions), *fit.positions[closest]))
+
+    def pixel_pitch(self):
+        return abs(self.mat_file.graph['x'][0, 1] - self.mat_file.graph['x'][0, 0])
+
     def mouse_moved(self, event):
         if any([event.xdata, event.ydata]):
             self.status_bar.showMessage("X={0:.3f}, Y={1:.3f}".format(event.xdata, event.ydata))
 
     def closeEvent(self, event):
+        self.canvas.coalescer.timer.stop()
         self.parent().parent().parent().parent().del_mat()
         event.accept()
@@ -0,0 +1,75 @@
+from PyQt5 import QtWidgets
+
+from utility.trafo_fit import MIN_POINTS
+from utility.warp import WARP_MODELS
+
+
+# noinspection PyAttributeOutsideInit, PyArgumentList
+class TrafoDialog(QtWidgets.QDialog):
+    models = list(MIN_POINTS) + WARP_MODELS
+    estimators = ['none', 'ransac', 'huber']
+
+    def __init__(self, trafo_settings, parent=None):
+        super(TrafoDialog, self).__init__(parent)
+        self.trafo_settings = trafo_settings
+
+        self.lbl_model = QtWidgets.QLabel("Model:", self)
+        self.cmb_model = QtWidgets.QComboBox(self)
+        self.cmb_model.addItems(self.models)
+        self.cmb_model.setCurrentIndex(self.models.index(self.trafo_settings[0]))
+        self.lbl_robust = QtWidgets.QLabel("Outlier rejection:", self)
+        self.cmb_robust = QtWidgets.QComboBox(self)
+        self.cmb_robust.addItems(self.estimators)
+        self.cmb_robust.setCurrentIndex(self.estimators.index(self.trafo_settings[1]))
+        self.lbl_threshold = QtWidgets.QLabel("Outlier threshold:", self)
+        self.edt_threshold = QtWidgets.QLineEdit(str(self.trafo_settings[2]), self)
+        self.lbl_order = QtWidgets.QLabel("Polynomial order:", self)
+        self.edt_order = QtWidgets.QLineEdit(str(self.trafo_settings[3]), self)
+        self.lbl_smoothing = QtWidgets.QLabel("Thin-plate smoothing:", self)
+        self.edt_smoothing = QtWidgets.QLineEdit(str(self.trafo_settings[4]), self)
+        self.btns = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel, self)
+        self.btns.accepted.connect(self.accept)
+        self.btns.rejected.connect(self.reject)
+
+        hbox1 = QtWidgets.QHBoxLayout()
+        hbox1.setSpacing(10)
+        hbox1.addWidget(self.lbl_model)
+        hbox1.addWidget(self.cmb_model)
+
+        hbox2 = QtWidgets.QHBoxLayout()
+        hbox2.setSpacing(10)
+        hbox2.addWidget(self.lbl_robust)
+        hbox2.addWidget(self.cmb_robust)
+
+        hbox3 = QtWidgets.QHBoxLayout()
+        hbox3.setSpacing(10)
+        hbox3.addWidget(self.lbl_threshold)
+        hbox3.addWidget(self.edt_threshold)
+
+        hbox4 = QtWidgets.QHBoxLayout()
+        hbox4.setSpacing(10)
+        hbox4.addWidget(self.lbl_order)
+        hbox4.addWidget(self.edt_order)
+
+        hbox5 = QtWidgets.QHBoxLayout()
+        hbox5.setSpacing(10)
+        hbox5.addWidget(self.lbl_smoothing)
+        hbox5.addWidget(self.edt_smoothing)
+
+        vbox = QtWidgets.QVBoxLayout(self)
+        vbox.setSpacing(10)
+        vbox.addLayout(hbox1)
+        vbox.addLayout(hbox2)
+        vbox.addLayout(hbox3)
+        vbox.addSpacing(5)
+        vbox.addLayout(hbox4)
+        vbox.addLayout(hbox5)
+        vbox.addSpacing(5)
+        vbox.addWidget(self.btns)
+
+    def exec_(self):
+        if not super(TrafoDialog, self).exec_():
+            return self.trafo_settings
+        return [self.cmb_model.currentText(), self.cmb_robust.currentText(), float(self.edt_threshold.text()),
+                int(self.edt_order.text()), float(self.edt_smoothing.text())]
@@ -0,0 +1,52 @@
+import numpy as np
+
+from utility import tum_jet
+
+COLORMAPS = {}  # name -> matplotlib colormap
+LUTS = {}  # name -> uint8 RGBA table, built on first use
+
+
+def register_colormap(name, cmap, n_colors=256):
+    """ Makes a matplotlib colormap available to apply_colormap, sampled to n_colors table entries. """
+    COLORMAPS[name] = (cmap, n_colors)
+    LUTS.pop(name, None)
+
+
+def lookup_table(name='tum_jet'):
+    """ Returns the uint8 RGBA table of a registered colormap, shape (n_colors, 4). """
+    if name not in LUTS:
+        try:
+            cmap, n_colors = COLORMAPS[name]
+        except KeyError:
+            raise ValueError('Colormap {0} is not registered.'.format(name))
+        LUTS[name] = np.round(cmap(np.linspace(0, 1, n_colors)) * 255).astype(np.uint8)
+    return LUTS[name]
+
+
+def apply_colormap(array, vmin, vmax, colormap='tum_jet', out=None):
+    """ Colors an array like imshow with vmin and vmax, through a lookup table instead of matplotlib.
+
+        Values are quantized to the table entries and gathered in one take, values outside [vmin, vmax] and nan get the
+        end colors.
+
+        Args:
+            array (np.array): Values of any shape.
+            vmin (float): Value of the first color.
+            vmax (float): Value of the last color.
+            colormap (string or np.array): Name of a registered colormap or a uint8 RGBA table.
+            out (np.array): uint8 buffer of shape array.shape + (4,) to write to, reused between calls.
+
+        Returns:
+            np.array: uint8 RGBA array of shape array.shape + (4,).
+    """
+    lut = lookup_table(colormap) if isinstance(colormap, str) else colormap
+    scale = np.float32((lut.shape[0] - 1) / float(max(vmax - vmin, 1e-12)))
+    index = np.asarray(array, dtype=np.float32) - np.float32(vmin)
+    index *= scale
+    index += np.float32(0.5)
+    np.fmax(index, 0, out=index)  # fmax and fmin also map nan to the ends
+    np.fmin(index, lut.shape[0] - 1, out=index)
+    return np.take(lut, index.astype(np.int32), axis=0, out=out)
+
+
+register_colormap('tum_jet', tum_jet.tum_jet)
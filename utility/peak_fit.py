@@ -0,0 +1,201 @@
+from collections import namedtuple
+
+import numpy as np
+from scipy import ndimage
+from scipy.optimize import least_squares
+
+EmitterFit = namedtuple('EmitterFit', ['positions', 'amplitudes', 'sigmas', 'offset', 'uncertainties', 'chi2', 'bic',
+                                       'success'])
+EmitterFit.__doc__ = """ Result of fit_emitters and fit_cluster.
+
+    Attributes:
+        positions (np.array): Centre x, y of each emitter, shape (k, 2).
+        amplitudes (np.array): Peak counts of each emitter above the offset.
+        sigmas (np.array): Width of each emitter, shape (k, 1) for symmetric and (k, 2) for elliptical Gaussians.
+        offset (float): Background counts shared by all emitters.
+        uncertainties (np.array): Standard deviation of each centre, mean of the x and y variances.
+        chi2 (float): Sum of squared residuals, each divided by the Poisson standard deviation of the model.
+        bic (float): Bayesian information criterion of the fit, lower is better.
+        success (bool): False if the optimizer did not converge.
+"""
+
+
+def n_params(elliptical):
+    """ Number of parameters per emitter: amplitude, x0, y0 and sigma, or sigma_x and sigma_y if elliptical. """
+    return 5 if elliptical else 4
+
+
+def gaussians(params, x, y, elliptical=False):
+    """ Evaluates k Gaussians for all pixels at once.
+
+        Args:
+            params (np.array): Emitter parameters concatenated, see n_params, followed by the shared offset.
+            x (np.array): x of each pixel, flat.
+            y (np.array): y of each pixel, flat.
+            elliptical (bool): Separate widths along x and y instead of one sigma.
+
+        Returns:
+            np.array: Model counts of each pixel.
+            np.array: Jacobian, shape (n_pixels, n_params).
+    """
+    p = params[:-1].reshape(-1, n_params(elliptical))
+    amplitude, dx, dy = p[:, 0:1], x[np.newaxis, :] - p[:, 1:2], y[np.newaxis, :] - p[:, 2:3]
+    sigma_x = p[:, 3:4]
+    sigma_y = p[:, 4:5] if elliptical else sigma_x
+    g = np.exp(-0.5 * ((dx / sigma_x) ** 2 + (dy / sigma_y) ** 2))
+    ag = amplitude * g
+    model = params[-1] + ag.sum(axis=0)
+    if elliptical:
+        derivatives = [g, ag * dx / sigma_x ** 2, ag * dy / sigma_y ** 2, ag * dx ** 2 / sigma_x ** 3,
+                       ag * dy ** 2 / sigma_y ** 3]
+    else:
+        derivatives = [g, ag * dx / sigma_x ** 2, ag * dy / sigma_y ** 2, ag * (dx ** 2 + dy ** 2) / sigma_x ** 3]
+    jacobian = np.empty((x.size, params.size))
+    jacobian[:, :-1] = np.stack(derivatives, axis=1).reshape(-1, x.size).T  # emitter by emitter, as in params
+    jacobian[:, -1] = 1
+    return model, jacobian
+
+
+def fit_emitters(x, y, counts, p0, elliptical=False, sigma_limits=(0, np.inf)):
+    """ Fits k Gaussians with a shared offset jointly to the counts of a region.
+
+        Residuals are weighted with the Poisson standard deviation of the model counts, so the BIC of fits with
+        different numbers of emitters is comparable. Centres are bounded to the region, amplitudes to positive values
+        and widths to sigma_limits.
+
+        Args:
+            x (np.array): x of each pixel, flat.
+            y (np.array): y of each pixel, flat.
+            counts (np.array): Counts of each pixel, flat.
+            p0 (np.array): Start parameters, see gaussians.
+            elliptical (bool): Separate widths along x and y.
+            sigma_limits (tuple): Smallest and largest width.
+
+        Returns:
+            EmitterFit
+    """
+    m = n_params(elliptical)
+    k = (len(p0) - 1) // m
+    lower = np.tile([0, x.min(), y.min()] + [sigma_limits[0]] * (m - 3), k).tolist() + [-np.inf]
+    upper = np.tile([np.inf, x.max(), y.max()] + [sigma_limits[1]] * (m - 3), k).tolist() + [np.inf]
+    p0 = np.clip(np.asarray(p0, dtype=float), np.array(lower) + 1e-12, np.array(upper) - 1e-12)
+    cache = {}
+
+    def evaluate(params):
+        key = params.tobytes()
+        if key not in cache:
+            model, jacobian = gaussians(params, x, y, elliptical)
+            w = 1 / np.sqrt(np.maximum(model, 1))
+            cache.clear()
+            cache[key] = ((model - counts) * w, jacobian * w[:, np.newaxis])
+        return cache[key]
+
+    result = least_squares(lambda params: evaluate(params)[0], p0, jac=lambda params: evaluate(params)[1],
+                           bounds=(lower, upper), method='trf', x_scale='jac', ftol=1e-6, xtol=1e-6)
+    p = result.x[:-1].reshape(k, m)
+    chi2 = float(np.sum(result.fun ** 2))
+    n = counts.size
+    try:  # scaled by the reduced chi square in case the noise is not Poisson
+        covariance = np.linalg.pinv(np.dot(result.jac.T, result.jac)) * chi2 / max(n - result.x.size, 1)
+        variances = np.diag(covariance)[:-1].reshape(k, m)
+        uncertainties = np.sqrt(np.abs(variances[:, 1] + variances[:, 2]) / 2)
+    except np.linalg.LinAlgError:
+        uncertainties = np.full(k, np.nan)
+    bic = chi2 + result.x.size * np.log(n)
+    return EmitterFit(p[:, 1:3], p[:, 0], p[:, 3:], float(result.x[-1]), uncertainties, chi2, float(bic),
+                      result.success)
+
+
+def region(x_ax, y_ax, result, centre, radius):
+    """ Returns x, y and counts of the pixels within radius of centre along x and y, flat.
+
+        Rows of result run from y max to y min, as in MatFile.graph.
+    """
+    y_rows = y_ax[::-1]
+    cols = np.flatnonzero(np.abs(x_ax - centre[0]) <= radius)
+    rows = np.flatnonzero(np.abs(y_rows - centre[1]) <= radius)
+    x, y = np.meshgrid(x_ax[cols], y_rows[rows])
+    if rows.size and cols.size:
+        counts = np.asarray(result[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], dtype=float).ravel()
+    else:
+        counts = np.zeros(0)
+    return x.ravel(), y.ravel(), counts
+
+
+def fit_cluster(x, y, counts, sigma, max_emitters=3, elliptical=False):
+    """ Fits 1 to max_emitters Gaussians to a region and keeps the number with the lowest BIC.
+
+        Each further emitter starts at the largest residual of the previous fit, the previous emitters start at their
+        fitted values. Adding emitters stops as soon as the BIC no longer drops.
+
+        Args:
+            x (np.array): x of each pixel, flat.
+            y (np.array): y of each pixel, flat.
+            counts (np.array): Counts of each pixel, flat.
+            sigma (float): Expected width of an emitter, start value of all widths.
+            max_emitters (int): Largest number of emitters tried.
+            elliptical (bool): Separate widths along x and y.
+
+        Returns:
+            EmitterFit: Best fit, None if the region has fewer pixels than parameters of a single emitter.
+    """
+    m = n_params(elliptical)
+    if counts.size <= m + 1:
+        return None
+    pitch = max(np.min(np.diff(np.unique(x))) if np.unique(x).size > 1 else sigma, 1e-12)
+    sigma_limits = (pitch / 2., (x.max() - x.min() + y.max() - y.min()) / 2. + pitch)
+    offset = np.percentile(counts, 10)
+    params = np.array([offset])
+    residual = counts - offset
+    best = None
+    for k in range(1, max_emitters + 1):
+        i = np.argmax(residual)
+        emitter = [max(residual[i], 1e-12), x[i], y[i]] + [sigma] * (m - 3)
+        params = np.concatenate([params[:-1], emitter, params[-1:]])
+        if counts.size <= params.size:
+            break
+        fit = fit_emitters(x, y, counts, params, elliptical, sigma_limits)
+        if best is not None and fit.bic >= best.bic:
+            break
+        best = fit
+        params = np.concatenate([np.column_stack([fit.amplitudes, fit.positions, fit.sigmas]).ravel(), [fit.offset]])
+        residual = counts - gaussians(params, x, y, elliptical)[0]
+    return best
+
+
+def fit_scan(x_ax, y_ax, result, sigma, threshold, max_emitters=3, elliptical=False, margin=None):
+    """ Fits all clusters of a scan, each connected region of counts above threshold separately.
+
+        Args:
+            x_ax (np.array): x axis of the scan.
+            y_ax (np.array): y axis of the scan, rows of result run from y max to y min.
+            result (np.array): Counts.
+            sigma (float): Expected width of an emitter.
+            threshold (float): Counts above which pixels belong to a cluster.
+            max_emitters (int): Largest number of emitters per cluster.
+            elliptical (bool): Separate widths along x and y.
+            margin (float): Border added around each cluster, default 2 sigma.
+
+        Returns:
+            list of EmitterFit: One fit per cluster.
+    """
+    pitch_x, pitch_y = abs(x_ax[1] - x_ax[0]), abs(y_ax[1] - y_ax[0])
+    margin = 2 * sigma if margin is None else margin
+    labels, _ = ndimage.label(np.asarray(result) > threshold)
+    y_rows = y_ax[::-1]
+    x_grid, y_grid = np.meshgrid(x_ax, y_rows, sparse=True)
+    fits = []
+    margin_rows, margin_cols = int(np.ceil(margin / pitch_y)), int(np.ceil(margin / pitch_x))
+    for label, (rows, cols) in enumerate(ndimage.find_objects(labels), 1):
+        rows = slice(max(rows.start - margin_rows, 0), rows.stop + margin_rows)
+        cols = slice(max(cols.start - margin_cols, 0), cols.stop + margin_cols)
+        others = (labels[rows, cols] != 0) & (labels[rows, cols] != label)
+        if others.any():  # neighbouring clusters and their tails are left to their own fits
+            others = ndimage.binary_dilation(others, np.ones((2 * margin_rows + 1, 2 * margin_cols + 1), dtype=bool))
+        keep = ~others.ravel()
+        counts = np.asarray(result[rows, cols], dtype=float).ravel()[keep]
+        x, y = np.broadcast_arrays(x_grid[:, cols], y_grid[rows, :])
+        fit = fit_cluster(x.ravel()[keep], y.ravel()[keep], counts, sigma, max_emitters, elliptical)
+        if fit is not None:
+            fits.append(fit)
+    return fits
@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class PhaseCorrelator:
+    """ Sub-pixel image registration by phase correlation against a fixed reference image.
+
+        The windowed real FFT of the reference is computed once, so registering a series of images against the
+        same reference costs one real FFT per image. The integer peak is found either by a full inverse FFT or,
+        with coarse > 1, on block averaged images and a few matrix DFT evaluations around the coarse estimate.
+        The peak is then refined on a grid upsampled by the factor upsample using matrix multiplication DFTs,
+        following Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008). The cross power spectrum is divided by its
+        magnitude to the power whitening; 1 is classic phase correlation, smaller values keep sparse, noisy scans
+        from being dominated by noise at high spatial frequencies.
+
+        Attributes:
+            shape (tuple): Shape of reference and of all registered images.
+            upsample (int): Sub-pixel refinement factor, shifts are resolved to 1 / upsample pixels.
+            coarse (int): Block size of the downsampled coarse pass, 1 to disable it.
+            whitening (float): Exponent of the cross power spectrum normalisation, between 0 and 1.
+            window (np.array): Hann window applied to every image before its FFT.
+            spectrum (np.array): Real FFT of the windowed reference.
+            coarse_spectrum (np.array): Real FFT of the block averaged, windowed reference, None if coarse == 1.
+    """
+    def __init__(self, reference, upsample=20, coarse=1, whitening=0.5):
+        reference = np.asarray(reference, dtype=float)
+        self.shape = reference.shape
+        self.upsample = upsample
+        self.coarse = coarse
+        self.whitening = whitening
+        self.window = np.outer(np.hanning(self.shape[0]), np.hanning(self.shape[1]))
+        self.spectrum = self.fft(reference)
+        self.coarse_spectrum = None
+        if self.coarse > 1:
+            coarse_reference = self.block_mean(reference)
+            self.coarse_window = np.outer(np.hanning(coarse_reference.shape[0]),
+                                          np.hanning(coarse_reference.shape[1]))
+            self.coarse_spectrum = np.fft.rfft2((coarse_reference - coarse_reference.mean()) * self.coarse_window)
+
+    def fft(self, image):
+        return np.fft.rfft2((image - image.mean()) * self.window)
+
+    def block_mean(self, image):
+        rows, cols = self.shape[0] // self.coarse * self.coarse, self.shape[1] // self.coarse * self.coarse
+        return image[:rows, :cols].reshape(rows // self.coarse, self.coarse,
+                                           cols // self.coarse, self.coarse).mean(axis=(1, 3))
+
+    def register(self, image):
+        """ Finds the shift of image relative to the reference.
+
+            Returns:
+                np.array: Shift [rows, columns] in pixels, image(r, c) = reference(r - rows, c - columns).
+                float: Correlation peak height, for whitening == 1 close to 1 for a clean match.
+        """
+        image = np.asarray(image, dtype=float)
+        if image.shape != self.shape:
+            raise ValueError('Image shape {0} differs from reference shape {1}.'.format(image.shape, self.shape))
+        cross_power = self.normalise(self.fft(image) * self.spectrum.conj())
+
+        if self.coarse > 1:
+            coarse_image = self.block_mean(image)
+            coarse_power = np.fft.rfft2((coarse_image - coarse_image.mean()) * self.coarse_window)
+            coarse_power = self.normalise(coarse_power * self.coarse_spectrum.conj())
+            coarse_corr = np.fft.irfft2(coarse_power, s=coarse_image.shape)
+            peak = self.wrap(np.array(np.unravel_index(np.argmax(coarse_corr), coarse_corr.shape)),
+                             coarse_corr.shape) * self.coarse
+            offsets = np.arange(-self.coarse, self.coarse + 1)
+            corr = self.dft_correlation(cross_power, peak[0] + offsets, peak[1] + offsets)
+            peak = peak + offsets[np.array(np.unravel_index(np.argmax(corr), corr.shape))]
+        else:
+            corr = np.fft.irfft2(cross_power, s=self.shape)
+            peak = self.wrap(np.array(np.unravel_index(np.argmax(corr), corr.shape)), self.shape)
+
+        offsets = np.arange(-self.upsample, self.upsample + 1) / float(self.upsample)
+        corr = self.dft_correlation(cross_power, peak[0] + offsets, peak[1] + offsets)
+        index = np.unravel_index(np.argmax(corr), corr.shape)
+        return peak + offsets[np.array(index)], float(corr[index])
+
+    def normalise(self, cross_power):
+        magnitude = np.abs(cross_power) ** self.whitening
+        return cross_power / (magnitude + 1e-12 * magnitude.max())
+
+    def dft_correlation(self, cross_power, rows, cols):
+        """ Evaluates the inverse DFT of a half spectrum at arbitrary, also fractional, rows and columns. """
+        row_freqs = np.fft.fftfreq(self.shape[0])
+        col_freqs = np.fft.rfftfreq(self.shape[1])
+        weights = np.full(col_freqs.size, 2.)  # negative column frequencies are the conjugate half
+        weights[0] = 1
+        if self.shape[1] % 2 == 0:
+            weights[-1] = 1
+        row_kernel = np.exp(2j * np.pi * np.outer(rows, row_freqs))
+        col_kernel = np.exp(2j * np.pi * np.outer(col_freqs, cols))
+        corr = row_kernel.dot(cross_power * weights[np.newaxis, :]).dot(col_kernel)
+        return np.real(corr) / (self.shape[0] * self.shape[1])
+
+    @staticmethod
+    def wrap(peak, shape):
+        shape = np.array(shape)
+        return np.where(peak > shape // 2, peak - shape, peak)
+
+
+def drift_trafo(mat_file, reference_file, correlator=None, **kwargs):
+    """ Affine matrix mapping coordinates of mat_file onto the same sample position in reference_file.
+
+        The matrix uses the convention of affine_trafo, [x', y', 1] = [x, y, 1] . matrix, and can be chained with
+        a transformation found for the reference, np.dot(drift, trafo_matrix). Both scans need the same pixel
+        pitch and number of pixels.
+
+        Args:
+            mat_file (MatFile): Scan to register.
+            reference_file (MatFile): Reference scan.
+            correlator (PhaseCorrelator): Correlator of the reference image, reused for a series of scans.
+                Built from reference_file with kwargs if None.
+
+        Returns:
+            np.array: 3x3 transformation matrix.
+            float: Correlation peak height.
+    """
+    if correlator is None:
+        correlator = PhaseCorrelator(reference_file.graph['result'], **kwargs)
+    (d_row, d_col), peak = correlator.register(mat_file.graph['result'])
+    pitch_x = mat_file.graph['x'][0, 1] - mat_file.graph['x'][0, 0]
+    pitch_y = mat_file.graph['y'][0, 1] - mat_file.graph['y'][0, 0]
+    trafo = np.eye(3)
+    trafo[2, 0] = reference_file.graph['x'][0, 0] - mat_file.graph['x'][0, 0] - d_col * pitch_x
+    trafo[2, 1] = reference_file.graph['y'][0, 0] - mat_file.graph['y'][0, 0] + d_row * pitch_y  # rows run along -y
+    return trafo, peak
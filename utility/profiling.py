@@ -0,0 +1,103 @@
+import cProfile
+import io
+import json
+import pstats
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import numpy as np
+
+MAX_SAMPLES = 10000  # durations kept per timer for the percentiles, counts and totals include all calls
+
+TIMINGS = {}  # name -> [count, total seconds, deque of the latest durations]
+PROFILER = [None]  # running cProfile.Profile, None if not profiling
+
+
+@contextmanager
+def timer(name):
+    """ Adds the duration of the with block to the statistics of the named timer. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """ Decorator timing every call of a function with the named timer. """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(name, duration):
+    if name not in TIMINGS:
+        TIMINGS[name] = [0, 0., deque(maxlen=MAX_SAMPLES)]
+    entry = TIMINGS[name]
+    entry[0] += 1
+    entry[1] += duration
+    entry[2].append(duration)
+
+
+def statistics():
+    """ Returns name -> dict of count, total, p50, p95 and max in seconds for every timer used so far. """
+    stats = {}
+    for name, (count, total, durations) in TIMINGS.items():
+        p50, p95 = np.percentile(durations, [50, 95])
+        stats[name] = {'count': count, 'total': total, 'p50': float(p50), 'p95': float(p95),
+                       'max': float(max(durations))}
+    return stats
+
+
+def report():
+    """ Returns the statistics as text table in milliseconds, slowest total first. """
+    stats = statistics()
+    lines = ['{0:<28}{1:>8}{2:>12}{3:>10}{4:>10}{5:>10}'.format('timer', 'count', 'total ms', 'p50', 'p95', 'max')]
+    for name in sorted(stats, key=lambda n: -stats[n]['total']):
+        s = stats[name]
+        lines.append('{0:<28}{1:>8}{2:>12.1f}{3:>10.2f}{4:>10.2f}{5:>10.2f}'.format(
+            name, s['count'], s['total'] * 1e3, s['p50'] * 1e3, s['p95'] * 1e3, s['max'] * 1e3))
+    return '\n'.join(lines)
+
+
+def export_json(file_name):
+    with open(file_name, 'w') as f:
+        json.dump(statistics(), f, indent=2, sort_keys=True)
+
+
+def reset():
+    TIMINGS.clear()
+
+
+def start_profile():
+    """ Starts collecting a cProfile of everything run from now on, until stop_profile. """
+    if PROFILER[0] is None:
+        PROFILER[0] = cProfile.Profile()
+        PROFILER[0].enable()
+
+
+def stop_profile(n_lines=25, file_name=None):
+    """ Stops the profile and returns the n_lines functions with the largest cumulative time as text.
+
+        Args:
+            n_lines (int): Number of functions listed.
+            file_name (string): Also dumps the full profile to this file, readable with pstats or snakeviz.
+    """
+    profiler, PROFILER[0] = PROFILER[0], None
+    if profiler is None:
+        return ''
+    profiler.disable()
+    if file_name:
+        profiler.dump_stats(file_name)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(n_lines)
+    return text.getvalue()
+
+
+def is_profiling():
+    return PROFILER[0] is not None
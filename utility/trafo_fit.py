@@ -0,0 +1,241 @@
+from collections import namedtuple
+
+import numpy as np
+
+MIN_POINTS = {'rigid': 2, 'similarity': 2, 'affine': 3, 'projective': 4}
+
+TrafoFit = namedtuple('TrafoFit', ['matrix', 'residuals', 'covariance', 'inliers', 'rms'])
+TrafoFit.__doc__ = """ Result of fit_trafo.
+
+    Attributes:
+        matrix (np.array): 3x3 matrix, [x', y', w] = [x, y, 1] . matrix, projective results are divided by w.
+        residuals (np.array): Distance between mapped and target point for every point pair.
+        covariance (np.array): Covariance of the model parameters, see params_to_matrix for their order.
+        inliers (np.array): Boolean mask of the point pairs within the threshold. Ransac excludes all other pairs from
+            the final fit, huber down weights them.
+        rms (float): Weighted root mean square residual of the inliers.
+"""
+
+
+def params_to_matrix(model, params):
+    """ Builds the 3x3 matrix of a model from its parameters.
+
+        Parameters are rigid (angle, tx, ty), similarity (a, b, tx, ty) with scale sqrt(a^2 + b^2), affine the first
+        two columns of the matrix row by row, projective the first eight matrix elements row by row.
+    """
+    p = params
+    if model == 'rigid':
+        c, s = np.cos(p[0]), np.sin(p[0])
+        return np.array([[c, s, 0], [-s, c, 0], [p[1], p[2], 1]])
+    elif model == 'similarity':
+        return np.array([[p[0], p[1], 0], [-p[1], p[0], 0], [p[2], p[3], 1]])
+    elif model == 'affine':
+        return np.array([[p[0], p[1], 0], [p[2], p[3], 0], [p[4], p[5], 1]])
+    elif model == 'projective':
+        return np.append(p, 1.).reshape(3, 3)
+    raise ValueError('Unknown transformation model {0}.'.format(model))
+
+
+def matrix_to_params(model, matrix):
+    if model == 'rigid':
+        return np.array([np.arctan2(matrix[0, 1], matrix[0, 0]), matrix[2, 0], matrix[2, 1]])
+    elif model == 'similarity':
+        return np.array([matrix[0, 0], matrix[0, 1], matrix[2, 0], matrix[2, 1]])
+    elif model == 'affine':
+        return matrix[:, :2].ravel()
+    elif model == 'projective':
+        return (matrix / matrix[2, 2]).ravel()[:-1]
+    raise ValueError('Unknown transformation model {0}.'.format(model))
+
+
+def apply_trafo(matrices, points):
+    """ Maps points (n, 2) with one matrix (3, 3) or a stack of matrices (m, 3, 3), returning (n, 2) or (m, n, 2). """
+    points = np.asarray(points, dtype=float)
+    mapped = np.dot(np.hstack([points, np.ones((points.shape[0], 1))]), matrices)
+    if mapped.ndim == 3:
+        mapped = np.swapaxes(mapped, 0, 1)
+    return mapped[..., :2] / mapped[..., 2:]
+
+
+def solve_models(model, raw, real):
+    """ Fits one model per sample exactly to minimal point sets raw, real with shape (m, k, 2).
+
+        Returns:
+            np.array: Stack of matrices (m, 3, 3).
+            np.array: Boolean mask of non-degenerate samples.
+    """
+    m = raw.shape[0]
+    if model in ['rigid', 'similarity']:
+        z = raw[..., 0] + 1j * raw[..., 1]
+        w = real[..., 0] + 1j * real[..., 1]
+        dz = z[:, 0] - z[:, 1]
+        valid = np.abs(dz) > 1e-12
+        a = (w[:, 0] - w[:, 1]) / np.where(valid, dz, 1)
+        if model == 'rigid':
+            a = a / np.where(np.abs(a) > 0, np.abs(a), 1)
+        b = np.mean(w - a[:, np.newaxis] * z, axis=1)
+        matrices = np.zeros((m, 3, 3))
+        matrices[:, 0, 0], matrices[:, 0, 1] = a.real, a.imag
+        matrices[:, 1, 0], matrices[:, 1, 1] = -a.imag, a.real
+        matrices[:, 2, 0], matrices[:, 2, 1], matrices[:, 2, 2] = b.real, b.imag, 1
+        return matrices, valid
+    elif model == 'affine':
+        x = np.concatenate([raw, np.ones((m, 3, 1))], axis=2)
+        valid = np.abs(np.linalg.det(x)) > 1e-12
+        x[~valid] = np.eye(3)
+        matrices = np.zeros((m, 3, 3))
+        matrices[:, :, :2] = np.linalg.solve(x, real)
+        matrices[:, 2, 2] = 1
+        return matrices, valid
+    elif model == 'projective':
+        a = np.zeros((m, 8, 8))
+        a[:, 0::2, 0:2], a[:, 0::2, 2] = raw, 1
+        a[:, 1::2, 3:5], a[:, 1::2, 5] = raw, 1
+        a[:, 0::2, 6:8] = -raw * real[..., 0:1]
+        a[:, 1::2, 6:8] = -raw * real[..., 1:2]
+        valid = np.abs(np.linalg.det(a)) > 1e-12
+        a[~valid] = np.eye(8)
+        h = np.linalg.solve(a, real.reshape(m, 8, 1))[..., 0]  # (h11, h12, h13, h21, ... h32), column convention
+        h = np.concatenate([h, np.ones((m, 1))], axis=1).reshape(m, 3, 3)
+        return np.swapaxes(h, 1, 2), valid
+    raise ValueError('Unknown transformation model {0}.'.format(model))
+
+
+def weighted_fit(model, raw, real, weights):
+    """ Weighted least squares fit of a model to all given point pairs. """
+    sw = np.sqrt(weights)[:, np.newaxis]
+    if model == 'affine':
+        x = np.hstack([raw, np.ones((raw.shape[0], 1))])
+        matrix = np.eye(3)
+        matrix[:, :2] = np.linalg.lstsq(sw * x, sw * real, rcond=None)[0]
+        return matrix
+    elif model == 'similarity':
+        ones, zeros = np.ones(raw.shape[0]), np.zeros(raw.shape[0])
+        design = np.vstack([np.stack([raw[:, 0], -raw[:, 1], ones, zeros], axis=1),
+                            np.stack([raw[:, 1], raw[:, 0], zeros, ones], axis=1)])
+        target = np.concatenate([real[:, 0], real[:, 1]])
+        sw2 = np.concatenate([sw[:, 0], sw[:, 0]])[:, np.newaxis]
+        params = np.linalg.lstsq(sw2 * design, sw2[:, 0] * target, rcond=None)[0]
+        return params_to_matrix(model, params)
+    elif model == 'rigid':  # weighted Procrustes
+        raw_c = np.average(raw, axis=0, weights=weights)
+        real_c = np.average(real, axis=0, weights=weights)
+        p, q = raw - raw_c, real - real_c
+        angle = np.arctan2(np.sum(weights * (p[:, 0] * q[:, 1] - p[:, 1] * q[:, 0])),
+                           np.sum(weights * (p[:, 0] * q[:, 0] + p[:, 1] * q[:, 1])))
+        matrix = params_to_matrix(model, [angle, 0, 0])
+        matrix[2, :2] = real_c - np.dot(raw_c, matrix[:2, :2])
+        return matrix
+    elif model == 'projective':  # weighted DLT on Hartley normalised points
+        def normalisation(pts):
+            centre = pts.mean(axis=0)
+            scale = np.sqrt(2) / max(np.mean(np.linalg.norm(pts - centre, axis=1)), 1e-12)
+            return np.array([[scale, 0, 0], [0, scale, 0], [-scale * centre[0], -scale * centre[1], 1]])
+        t_raw, t_real = normalisation(raw), normalisation(real)
+        p = apply_trafo(t_raw, raw)
+        q = apply_trafo(t_real, real)
+        n = raw.shape[0]
+        a = np.zeros((2 * n, 9))
+        a[:n, 0:2], a[:n, 2], a[:n, 6:8], a[:n, 8] = -p, -1, p * q[:, 0:1], q[:, 0]
+        a[n:, 3:5], a[n:, 5], a[n:, 6:8], a[n:, 8] = -p, -1, p * q[:, 1:2], q[:, 1]
+        a *= np.concatenate([sw[:, 0], sw[:, 0]])[:, np.newaxis]
+        h = np.linalg.svd(a)[2][-1].reshape(3, 3).T
+        matrix = np.dot(np.dot(t_raw, h), np.linalg.inv(t_real))
+        return matrix / matrix[2, 2]
+    raise ValueError('Unknown transformation model {0}.'.format(model))
+
+
+def covariance(model, matrix, raw, real, weights):
+    """ Parameter covariance from the numerical Jacobian, scaled by the reduced chi square like curve_fit. """
+    params = matrix_to_params(model, matrix)
+    sw = np.sqrt(np.concatenate([weights, weights]))
+
+    def weighted_residuals(p):
+        return sw * (apply_trafo(params_to_matrix(model, p), raw) - real).T.ravel()
+
+    r0 = weighted_residuals(params)
+    steps = 1e-7 * np.maximum(np.abs(params), 1)
+    jac = np.array([(weighted_residuals(params + step) - r0) / step[i]
+                    for i, step in enumerate(np.diag(steps))]).T
+    dof = r0.size - params.size
+    if dof <= 0:
+        return np.full((params.size, params.size), np.inf)
+    try:
+        return np.linalg.inv(np.dot(jac.T, jac)) * np.dot(r0, r0) / dof
+    except np.linalg.LinAlgError:
+        return np.full((params.size, params.size), np.inf)
+
+
+def fit_trafo(raw_coords, real_coords, model='affine', weights=None, robust=None, threshold=1., n_models=2000,
+              n_iter=20, seed=None):
+    """ Estimates the transformation mapping raw_coords onto real_coords.
+
+        Args:
+            raw_coords (list): Points [x, y] in the source frame, e.g. picks in a scan.
+            real_coords (list): Corresponding points in the target frame, e.g. picks in the layout.
+            model (string): 'rigid', 'similarity', 'affine' or 'projective'.
+            weights (list): Weight of each point pair, e.g. inverse variance of a Gaussian fit. Default all 1.
+            robust (string): None for plain weighted least squares, 'ransac' to reject outliers by scoring n_models
+                models fitted to random minimal subsets at once, 'huber' for iteratively reweighted least squares.
+            threshold (float): Residual in target units above which a pair is an outlier (ransac) or is down
+                weighted (huber).
+            n_models (int): Number of random minimal subsets scored by ransac.
+            n_iter (int): Maximum number of huber iterations.
+            seed (int): Seed of the ransac subset sampling.
+
+        Returns:
+            TrafoFit
+
+        Raises:
+            ValueError: If there are fewer point pairs than the model needs or the inputs do not match.
+    """
+    raw = np.asarray(raw_coords, dtype=float).reshape(-1, 2)
+    real = np.asarray(real_coords, dtype=float).reshape(-1, 2)
+    n = raw.shape[0]
+    if model not in MIN_POINTS:
+        raise ValueError('Unknown transformation model {0}.'.format(model))
+    if real.shape[0] != n:
+        raise ValueError('Got {0} source and {1} target points.'.format(n, real.shape[0]))
+    if n < MIN_POINTS[model]:
+        raise ValueError('A {0} transformation needs at least {1} point pairs, got {2}.'
+                         .format(model, MIN_POINTS[model], n))
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=float)
+    inliers = np.ones(n, dtype=bool)
+
+    if robust == 'ransac' and n > MIN_POINTS[model]:
+        rand = np.random.RandomState(seed)
+        samples = np.argsort(rand.rand(n_models, n), axis=1)[:, :MIN_POINTS[model]]
+        matrices, valid = solve_models(model, raw[samples], real[samples])
+        errors = np.linalg.norm(apply_trafo(matrices, raw) - real, axis=2)
+        scores = np.sum(weights * np.minimum(errors, threshold) ** 2, axis=1)  # MSAC score
+        scores[~valid] = np.inf
+        inliers = errors[np.argmin(scores)] < threshold
+        if inliers.sum() < MIN_POINTS[model]:
+            raise ValueError('Found no {0} transformation consistent within {1}.'.format(model, threshold))
+        for _ in range(2):  # refit on the consensus set until it is stable
+            matrix = weighted_fit(model, raw[inliers], real[inliers], weights[inliers])
+            refined = np.linalg.norm(apply_trafo(matrix, raw) - real, axis=1) < threshold
+            if refined.sum() < MIN_POINTS[model] or np.array_equal(refined, inliers):
+                break
+            inliers = refined
+    elif robust == 'huber':
+        robust_weights = weights
+        for _ in range(n_iter):
+            matrix = weighted_fit(model, raw, real, robust_weights)
+            errors = np.linalg.norm(apply_trafo(matrix, raw) - real, axis=1)
+            updated = weights * np.where(errors <= threshold, 1, threshold / np.maximum(errors, 1e-300))
+            if np.allclose(updated, robust_weights):
+                break
+            robust_weights = updated
+        weights = robust_weights
+    elif robust:
+        raise ValueError('Unknown robust estimator {0}.'.format(robust))
+
+    used = inliers if robust == 'ransac' else np.ones(n, dtype=bool)
+    matrix = weighted_fit(model, raw[used], real[used], weights[used])
+    residuals = np.linalg.norm(apply_trafo(matrix, raw) - real, axis=1)
+    if robust == 'huber':
+        inliers = residuals <= threshold
+    rms = np.sqrt(np.average(residuals[used] ** 2, weights=weights[used]))
+    cov = covariance(model, matrix, raw[used], real[used], weights[used])
+    return TrafoFit(matrix, residuals, cov, inliers, rms)
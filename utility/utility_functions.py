@@ -1,6 +1,11 @@
 import numpy as np
 from scipy.spatial import KDTree
 
+from utility.profiling import timed
+from utility.trafo_fit import fit_trafo
+
+PERCENTILE_GRID = np.linspace(0, 100, 1001)  # percentiles tabulated in image statistics, 0.1 % steps
+
 
 def test():
     pass
@@ -13,19 +18,42 @@ def two_d_gaussian_sym(xy, amplitude, xo, yo, sigma, offset):
     return g.ravel()
 
 
-def affine_trafo(raw_coords, real_coords):
-    primary = np.array(raw_coords)
-    secondary = np.array(real_coords)
+def image_statistics(data, bins=256):
+    """ Computes histogram and percentile statistics of an image in a single pass over sorted data.
 
-    # Pad the data with ones, so that our transformation can do translations too
-    if primary.shape[0] >= 3:
-        pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
-        x = pad(primary)
-        y = pad(secondary)
-        a, res, rank, s = np.linalg.lstsq(x, y, rcond=1e-4)
-        return a
+        Non-finite values are ignored. Percentiles on PERCENTILE_GRID are tabulated, so arbitrary
+        percentiles can later be interpolated from the table without touching the image again.
+
+        Returns:
+            dict: Keys are min, max, mean, std, quantiles (values at PERCENTILE_GRID) and
+                histogram (tuple of counts and bin edges between min and max).
+    """
+    cts = np.asarray(data, dtype=float).ravel()
+    cts = np.sort(cts[np.isfinite(cts)])
+    if not cts.size:
+        cts = np.zeros(1)
+    pos = PERCENTILE_GRID / 100 * (cts.size - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, cts.size - 1)
+    quantiles = cts[lo] + (pos - lo) * (cts[hi] - cts[lo])
+    if cts[-1] > cts[0]:
+        edges = np.linspace(cts[0], cts[-1], bins + 1)
     else:
-        raise ValueError('Could not find affine transformation.')
+        edges = np.linspace(cts[0] - 0.5, cts[0] + 0.5, bins + 1)
+    counts = np.diff(np.searchsorted(cts, edges, side='right'))
+    counts[0] += np.searchsorted(cts, edges[0], side='right')  # first bin is closed on the left
+    return {'min': cts[0], 'max': cts[-1], 'mean': cts.mean(), 'std': cts.std(),
+            'quantiles': quantiles, 'histogram': (counts, edges)}
+
+
+def percentile_limits(statistics, lower, upper):
+    return [float(np.interp(lower, PERCENTILE_GRID, statistics['quantiles'])),
+            float(np.interp(upper, PERCENTILE_GRID, statistics['quantiles']))]
+
+
+def affine_trafo(raw_coords, real_coords, **kwargs):
+    """ Returns the 3x3 matrix mapping raw_coords onto real_coords, see trafo_fit.fit_trafo for kwargs. """
+    return fit_trafo(raw_coords, real_coords, **kwargs).matrix
 
 
 def distance(point1, point2):
@@ -37,6 +65,7 @@ def flatten_list(lst):
     return [item for sublist in lst for item in sublist]
 
 
+@timed('kd_nearest')
 def kd_nearest(point_list, pt):
     tree = KDTree(point_list)
     _, ind = tree.query(pt)
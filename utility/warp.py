@@ -0,0 +1,271 @@
+import numpy as np
+
+from utility.trafo_fit import apply_trafo
+
+WARP_MODELS = ['polynomial', 'thin-plate']
+
+
+def normalisation(points):
+    """ Centre and scale bringing points to roughly unit size, keeps the fitted systems well conditioned. """
+    centre = points.mean(axis=0)
+    scale = max(np.abs(points - centre).max(), 1e-12)
+    return centre, scale
+
+
+class AffineWarp:
+    """ Linear or projective 3x3 matrix in the convention of fit_trafo, with the interface of the warps. """
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.inverse_matrix = np.linalg.inv(self.matrix)
+
+    def forward(self, points):
+        return apply_trafo(self.matrix, points)
+
+    def inverse(self, points):
+        return apply_trafo(self.inverse_matrix, points)
+
+
+class PolynomialWarp:
+    """ 2d polynomial of the given total order, fitted by weighted least squares in both directions.
+
+        Attributes:
+            order (int): Highest total power of x and y.
+            forward_fit (tuple): Normalisation and coefficients of the map from source to target.
+            inverse_fit (tuple): Normalisation and coefficients of the map from target to source.
+            rms (float): Root mean square residual of the forward map at the fitted points.
+    """
+    def __init__(self, order=3):
+        self.order = order
+        self.powers = [(i, n - i) for n in range(order + 1) for i in range(n + 1)]
+        self.forward_fit = None
+        self.inverse_fit = None
+        self.rms = None
+
+    def fit(self, src, dst, weights=None):
+        src, dst = np.asarray(src, dtype=float), np.asarray(dst, dtype=float)
+        if src.shape[0] < len(self.powers):
+            raise ValueError('A polynomial warp of order {0} needs at least {1} point pairs, got {2}.'
+                             .format(self.order, len(self.powers), src.shape[0]))
+        weights = np.ones(src.shape[0]) if weights is None else np.asarray(weights, dtype=float)
+        self.forward_fit = self.solve(src, dst, weights)
+        self.inverse_fit = self.solve(dst, src, weights)
+        self.rms = np.sqrt(np.average(np.sum((self.forward(src) - dst) ** 2, axis=1), weights=weights))
+        return self
+
+    def monomials(self, points, centre, scale):
+        xy = (points - centre) / scale
+        return np.stack([xy[:, 0] ** i * xy[:, 1] ** j for i, j in self.powers], axis=1)
+
+    def solve(self, src, dst, weights):
+        centre, scale = normalisation(src)
+        sw = np.sqrt(weights)[:, np.newaxis]
+        coeffs = np.linalg.lstsq(sw * self.monomials(src, centre, scale), sw * dst, rcond=None)[0]
+        return centre, scale, coeffs
+
+    def evaluate(self, fit, points):
+        centre, scale, coeffs = fit
+        return np.dot(self.monomials(np.asarray(points, dtype=float), centre, scale), coeffs)
+
+    def forward(self, points):
+        return self.evaluate(self.forward_fit, points)
+
+    def inverse(self, points):
+        return self.evaluate(self.inverse_fit, points)
+
+
+class ThinPlateWarp:
+    """ Thin-plate spline fitted in both directions.
+
+        With smoothing 0 the spline passes exactly through all point pairs, larger values trade fidelity for
+        bending energy. Point weights scale the smoothing of each pair inversely.
+
+        Attributes:
+            smoothing (float): Regularisation of the spline in normalised units.
+            forward_fit (tuple): Normalisation, control points and coefficients of the map from source to target.
+            inverse_fit (tuple): Same for the map from target to source.
+            rms (float): Root mean square residual of the forward map at the fitted points.
+    """
+    def __init__(self, smoothing=0.):
+        self.smoothing = smoothing
+        self.forward_fit = None
+        self.inverse_fit = None
+        self.rms = None
+
+    def fit(self, src, dst, weights=None):
+        src, dst = np.asarray(src, dtype=float), np.asarray(dst, dtype=float)
+        if src.shape[0] < 3:
+            raise ValueError('A thin-plate warp needs at least 3 point pairs, got {0}.'.format(src.shape[0]))
+        weights = np.ones(src.shape[0]) if weights is None else np.asarray(weights, dtype=float)
+        self.forward_fit = self.solve(src, dst, weights)
+        self.inverse_fit = self.solve(dst, src, weights)
+        self.rms = np.sqrt(np.average(np.sum((self.forward(src) - dst) ** 2, axis=1), weights=weights))
+        return self
+
+    @staticmethod
+    def kernel(points, controls):
+        r2 = np.sum((points[:, np.newaxis, :] - controls[np.newaxis, :, :]) ** 2, axis=2)
+        return 0.5 * r2 * np.log(np.where(r2 > 0, r2, 1))  # r^2 log(r)
+
+    def solve(self, src, dst, weights):
+        centre, scale = normalisation(src)
+        controls = (src - centre) / scale
+        n = controls.shape[0]
+        system = np.zeros((n + 3, n + 3))
+        system[:n, :n] = self.kernel(controls, controls) + np.diag(self.smoothing * weights.mean() / weights)
+        system[:n, n] = 1
+        system[:n, n + 1:] = controls
+        system[n:, :n] = system[:n, n:].T
+        rhs = np.zeros((n + 3, 2))
+        rhs[:n] = dst
+        return centre, scale, controls, np.linalg.solve(system, rhs)
+
+    def evaluate(self, fit, points, chunk_size=65536):
+        centre, scale, controls, coeffs = fit
+        points = (np.asarray(points, dtype=float) - centre) / scale
+        mapped = np.empty_like(points)
+        for start in range(0, points.shape[0], chunk_size):  # bounds the size of the kernel matrix
+            chunk = points[start:start + chunk_size]
+            mapped[start:start + chunk_size] = (np.dot(self.kernel(chunk, controls), coeffs[:-3]) + coeffs[-3] +
+                                                np.dot(chunk, coeffs[-2:]))
+        return mapped
+
+    def forward(self, points):
+        return self.evaluate(self.forward_fit, points)
+
+    def inverse(self, points):
+        return self.evaluate(self.inverse_fit, points)
+
+
+def fit_warp(raw_coords, real_coords, model, weights=None, order=3, smoothing=0.):
+    if model == 'polynomial':
+        return PolynomialWarp(order).fit(raw_coords, real_coords, weights)
+    elif model == 'thin-plate':
+        return ThinPlateWarp(smoothing).fit(raw_coords, real_coords, weights)
+    raise ValueError('Unknown warp model {0}.'.format(model))
+
+
+def as_warp(trafo):
+    return trafo if hasattr(trafo, 'inverse') else AffineWarp(trafo)
+
+
+class ComposedWarp:
+    """ A 3x3 matrix applied before a warp, e.g. the drift of a scan relative to the scan the warp was fitted on. """
+    def __init__(self, matrix, warp):
+        self.first = AffineWarp(matrix)
+        self.warp = warp
+
+    def forward(self, points):
+        return self.warp.forward(self.first.forward(points))
+
+    def inverse(self, points):
+        return self.first.inverse(self.warp.inverse(points))
+
+
+def compose(matrix, trafo):
+    """ Trafo applied after matrix, a matrix again if trafo is one. """
+    if hasattr(trafo, 'inverse'):
+        return ComposedWarp(matrix, trafo)
+    return np.dot(matrix, trafo)
+
+
+class CoordinateMap:
+    """ Source pixel coordinates of every pixel of a resampled image.
+
+        Built once per warp and scan grid. The flat index of the upper left source pixel and the bilinear
+        fractions are kept, so applying the map to any scan on that grid is a gather of four neighbours.
+
+        Attributes:
+            x (np.array): x axis of the resampled image.
+            y (np.array): y axis of the resampled image.
+            shape (tuple): Shape of the resampled image (len(y), len(x)).
+            source_shape (tuple): Shape of the scans the map applies to.
+            index (np.array): Flat index of the upper left source pixel of each resampled pixel.
+            row_frac (np.array): Fractional row offset from the upper left source pixel.
+            col_frac (np.array): Fractional column offset from the upper left source pixel.
+            valid (np.array): Boolean mask of resampled pixels within half a pixel of the scan.
+    """
+    def __init__(self, warp, x_axis, y_axis, shape=None, max_nodes=256):
+        """ Args:
+                warp: 3x3 matrix or warp mapping scan coordinates to target coordinates.
+                x_axis (np.array): Equidistant x axis of the scan.
+                y_axis (np.array): Equidistant y axis of the scan, rows of the scan run from y_axis[-1] to y_axis[0].
+                shape (tuple): Number of resampled pixels (ny, nx). Default the scan shape.
+                max_nodes (int): Non-linear warps are evaluated on at most max_nodes x max_nodes points and
+                    interpolated bilinearly, affine matrices on the four corners only.
+        """
+        warp = as_warp(warp)
+        shape = shape or (len(y_axis), len(x_axis))
+        edge = np.linspace(0, 1, 64)
+        outline = np.concatenate([np.stack([x_axis[0] + edge * (x_axis[-1] - x_axis[0]),
+                                            np.full(edge.size, y)], axis=1) for y in [y_axis[0], y_axis[-1]]] +
+                                 [np.stack([np.full(edge.size, x),
+                                            y_axis[0] + edge * (y_axis[-1] - y_axis[0])], axis=1)
+                                  for x in [x_axis[0], x_axis[-1]]])
+        outline = warp.forward(outline)
+        self.x = np.linspace(outline[:, 0].min(), outline[:, 0].max(), shape[1])
+        self.y = np.linspace(outline[:, 1].min(), outline[:, 1].max(), shape[0])
+
+        if isinstance(warp, AffineWarp) and np.allclose(warp.matrix[:, 2], [0, 0, 1]):
+            step = max(shape)  # linear, the corners define every pixel exactly
+        else:
+            step = max(1, int(np.ceil(max(shape) / float(max_nodes))))
+        node_rows = np.unique(np.append(np.arange(0, shape[0], step), shape[0] - 1))
+        node_cols = np.unique(np.append(np.arange(0, shape[1], step), shape[1] - 1))
+        node_x, node_y = np.meshgrid(self.x[node_cols], self.y[::-1][node_rows])
+        src = warp.inverse(np.stack([node_x.ravel(), node_y.ravel()], axis=1))
+        pitch_x = (x_axis[-1] - x_axis[0]) / (len(x_axis) - 1)
+        pitch_y = (y_axis[-1] - y_axis[0]) / (len(y_axis) - 1)
+        cols = ((src[:, 0] - x_axis[0]) / pitch_x).reshape(node_y.shape)
+        rows = ((len(y_axis) - 1) - (src[:, 1] - y_axis[0]) / pitch_y).reshape(node_y.shape)
+        rows = self.interpolate_nodes(rows, node_rows, node_cols, shape)
+        cols = self.interpolate_nodes(cols, node_rows, node_cols, shape)
+        self.shape = tuple(shape)
+        self.source_shape = (len(y_axis), len(x_axis))
+        self.valid = (rows > -0.5) & (rows < len(y_axis) - 0.5) & (cols > -0.5) & (cols < len(x_axis) - 0.5)
+        rows = np.clip(rows, 0, len(y_axis) - 1)
+        cols = np.clip(cols, 0, len(x_axis) - 1)
+        row0 = np.minimum(np.floor(rows), len(y_axis) - 2)
+        col0 = np.minimum(np.floor(cols), len(x_axis) - 2)
+        self.row_frac = (rows - row0).astype(np.float32)
+        self.col_frac = (cols - col0).astype(np.float32)
+        index_type = np.int32 if len(x_axis) * len(y_axis) < 2 ** 31 else np.int64
+        self.index = (row0 * len(x_axis) + col0).astype(index_type)
+
+    @staticmethod
+    def interpolate_nodes(values, node_rows, node_cols, shape):
+        """ Separable bilinear interpolation of values on the node grid to every pixel. """
+        if values.shape == tuple(shape):
+            return values
+
+        def weights(nodes, n):
+            pos = np.interp(np.arange(n), nodes, np.arange(nodes.size))
+            lower = np.minimum(np.floor(pos).astype(int), nodes.size - 2)
+            return lower, pos - lower
+
+        col0, col_frac = weights(node_cols, shape[1])
+        row0, row_frac = weights(node_rows, shape[0])
+        by_col = values[:, col0] * (1 - col_frac) + values[:, col0 + 1] * col_frac
+        return by_col[row0] * (1 - row_frac)[:, np.newaxis] + by_col[row0 + 1] * row_frac[:, np.newaxis]
+
+    def apply(self, image):
+        """ Resamples image to float32, pixels mapping outside of the scan are 0. """
+        image = np.asarray(image, dtype=np.float32)
+        if image.shape != self.source_shape:
+            raise ValueError('Image shape {0} differs from map shape {1}.'.format(image.shape, self.source_shape))
+        flat = image.ravel()
+        n_cols = self.source_shape[1]
+        resampled = np.take(flat, self.index)  # shifted views of flat give the other three neighbours
+        neighbour = np.take(flat[1:], self.index)
+        neighbour -= resampled
+        neighbour *= self.col_frac
+        resampled += neighbour  # interpolated along the upper row
+        bottom = np.take(flat[n_cols:], self.index)
+        np.take(flat[n_cols + 1:], self.index, out=neighbour)
+        neighbour -= bottom
+        neighbour *= self.col_frac
+        bottom += neighbour  # interpolated along the lower row
+        bottom -= resampled
+        bottom *= self.row_frac
+        resampled += bottom
+        resampled[~self.valid] = 0
+        return resampled
@@ -275,7 +275,7 @@ def xterm_to_hex(xterm):
 
 
 def hex_to_xterm(hex_val):
-    for i in range(len(CLUT)):
-        if int(CLUT[i][1]) == hex_val[1:]:
-            return CLUT[i][0]
-    return '256'
+    """ Returns the color index of the table color closest to hex_val, e.g. '#ff0000'. """
+    rgb = [int(hex_val[i:i + 2], 16) for i in (1, 3, 5)]
+    distances = [sum((int(h[i:i + 2], 16) - c) ** 2 for i, c in zip((0, 2, 4), rgb)) for _, h in CLUT]
+    return int(CLUT[distances.index(min(distances))][0])